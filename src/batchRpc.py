@@ -0,0 +1,180 @@
+import base64
+import decimal
+import http.client
+import itertools
+import json
+import os
+import queue
+import time
+import urllib.parse
+from bitcoinrpc.authproxy import AuthServiceProxy, JSONRPCException
+from metrics import registry
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_POOL_SIZE = 4
+# Seconds
+DEFAULT_RPC_TIMEOUT = 30
+
+RPC_SECONDS = registry.histogram(
+    'btc_etl_rpc_seconds', 'Latency of single JSON-RPC calls', ['method'])
+RPC_BATCH_SECONDS = registry.histogram(
+    'btc_etl_rpc_batch_seconds', 'Latency of JSON-RPC batch requests by their first method', ['method'])
+RPC_BATCH_CALLS = registry.counter(
+    'btc_etl_rpc_batch_calls_total', 'Calls sent inside JSON-RPC batch requests', ['method'])
+RPC_ERRORS = registry.counter(
+    'btc_etl_rpc_errors_total', 'JSON-RPC calls that returned an error', ['method'])
+
+
+def rpc_url_from_environ():
+    if ('RPC_USER' not in os.environ
+        or 'RPC_PASSWORD' not in os.environ
+        or 'RPC_HOST' not in os.environ
+            or 'RPC_PORT' not in os.environ):
+        raise Exception(
+            'Need to specify RPC_USER and RPC_PASSWORD, RPC_HOST, RPC_PORT environs')
+    return "http://%s:%s@%s:%s" % (os.environ['RPC_USER'], os.environ['RPC_PASSWORD'],  os.environ['RPC_HOST'], os.environ['RPC_PORT'])
+
+
+class InstrumentedRPC():
+    # AuthServiceProxy with a latency histogram per method, rpc.getblockcount() etc. work as before
+    def __init__(self, service_url, timeout=DEFAULT_RPC_TIMEOUT):
+        self.proxy = AuthServiceProxy(service_url, timeout=timeout)
+
+    def __getattr__(self, method):
+        if method.startswith('__'):
+            raise AttributeError(method)
+        call = getattr(self.proxy, method)
+
+        def timed_call(*args):
+            started_at = time.perf_counter()
+            try:
+                return call(*args)
+            except JSONRPCException:
+                RPC_ERRORS.inc(method)
+                raise
+            finally:
+                RPC_SECONDS.observe(
+                    time.perf_counter() - started_at, method)
+        return timed_call
+
+
+class BatchRPCClient():
+    # Sends JSON-RPC batch arrays over a pool of keep-alive connections.
+    # Per-call failures are returned in place as JSONRPCException instances.
+    def __init__(self, service_url, batch_size=DEFAULT_BATCH_SIZE, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_RPC_TIMEOUT):
+        url = urllib.parse.urlparse(service_url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.path = url.path or '/'
+        self.timeout = timeout
+        self.batch_size = batch_size
+        auth = ('%s:%s' % (urllib.parse.unquote(url.username or ''),
+                           urllib.parse.unquote(url.password or ''))).encode('utf-8')
+        self.auth_header = b'Basic ' + base64.b64encode(auth)
+        self.pool = queue.LifoQueue(maxsize=pool_size)
+        self.ids = itertools.count(1)
+
+    def _get_connection(self):
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _release_connection(self, connection):
+        try:
+            self.pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def _post(self, payload):
+        body = json.dumps(payload, default=_encode_decimal)
+        headers = {'Host': self.host, 'Authorization': self.auth_header,
+                   'Content-type': 'application/json', 'Connection': 'keep-alive'}
+        # A pooled connection may have been dropped by the node, retry once on a fresh one
+        for attempt in range(2):
+            connection = self._get_connection()
+            try:
+                connection.request('POST', self.path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                # OSError covers dropped connections and socket timeouts, the connection
+                # is never returned to the pool in an unknown state
+                connection.close()
+                if attempt == 1:
+                    raise e
+                continue
+            if response.will_close:
+                connection.close()
+            else:
+                self._release_connection(connection)
+            if response.getheader('Content-Type', '').split(';')[0] != 'application/json':
+                raise JSONRPCException({'code': -342, 'message': 'non-JSON HTTP response with \'%i %s\' from server' % (
+                    response.status, response.reason)})
+            return json.loads(data.decode('utf-8'), parse_float=decimal.Decimal)
+
+    def call(self, method, *params):
+        result = self.batch([(method, params)])[0]
+        if isinstance(result, JSONRPCException):
+            raise result
+        return result
+
+    def batch(self, calls, batch_size=None):
+        # calls is a list of (method, params) tuples, results are returned in the same order
+        batch_size = batch_size or self.batch_size
+        calls = list(calls)
+        results = []
+        for start in range(0, len(calls), batch_size):
+            chunk = calls[start:start + batch_size]
+            payload = []
+            positions = {}
+            for index, (method, params) in enumerate(chunk):
+                call_id = next(self.ids)
+                positions[call_id] = index
+                payload.append({'version': '1.1', 'method': method,
+                                'params': list(params), 'id': call_id})
+            started_at = time.perf_counter()
+            responses = self._post(payload)
+            RPC_BATCH_SECONDS.observe(
+                time.perf_counter() - started_at, chunk[0][0])
+            RPC_BATCH_CALLS.inc(chunk[0][0], amount=len(chunk))
+            if not isinstance(responses, list):
+                # Whole batch rejected (e.g. auth or parse error), report it for every call
+                error = JSONRPCException(responses.get('error') or {
+                                         'code': -343, 'message': 'invalid batch response'})
+                results.extend([error] * len(chunk))
+                continue
+            chunk_results = [JSONRPCException(
+                {'code': -344, 'message': 'missing response'})] * len(chunk)
+            for response in responses:
+                index = positions.get(response.get('id'))
+                if index is None:
+                    continue
+                if response.get('error') is not None:
+                    RPC_ERRORS.inc(chunk[index][0])
+                    chunk_results[index] = JSONRPCException(response['error'])
+                else:
+                    chunk_results[index] = response.get('result')
+            results.extend(chunk_results)
+        return results
+
+    def get_transactions(self, txids, batch_size=None, verbose=True):
+        # Verbose getrawtransaction decodes in the node, saving the decoderawtransaction round trip.
+        # Non verbose returns the much smaller raw hex for parsing locally.
+        return self.batch([('getrawtransaction', (txid, verbose)) for txid in txids], batch_size)
+
+    def get_block_stats(self, heights, batch_size=None):
+        return self.batch([('getblockstats', (height,)) for height in heights], batch_size)
+
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def _encode_decimal(o):
+    if isinstance(o, decimal.Decimal):
+        return float(round(o, 8))
+    raise TypeError(repr(o) + ' is not JSON serializable')
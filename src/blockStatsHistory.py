@@ -0,0 +1,211 @@
+import bisect
+import threading
+from array import array
+from blockStatsStore import BLOCK_STATS_COLUMNS, flatten_block_stats, list_columnar_chunks, ColumnarChunkReader
+
+# Columns and block windows (1 hour, 1 day, 1 week) of the rolling features kept at the tip
+ROLLING_FEATURE_COLUMNS = ['totalfee', 'avgfeerate', 'medianfee', 'txs', 'total_weight'] + \
+    ['feerate_percentiles_%d' % p for p in [10, 25, 50, 75, 90]]
+ROLLING_WINDOWS = [6, 144, 1008]
+
+
+class BlockStatsHistory():
+    # Block stats as contiguous int64 columns indexed by height - base_height. Means
+    # over any window are O(1) from running prefix sums, which are built the first
+    # time a column is asked for and extended as blocks are appended. Used by the
+    # live path, one append per block, and over backfilled column files alike.
+    def __init__(self):
+        self.names = [name for (name, fmt) in BLOCK_STATS_COLUMNS if fmt == 'q' and name != 'height']
+        self.base_height = None
+        self.columns = {name: array('q') for name in self.names}
+        self.blockhashes = []
+        # 1 for heights we have stats for, gaps are zero filled
+        self.present = array('q')
+        self.prefix_sums = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.present)
+
+    def tip(self):
+        if self.base_height == None:
+            return None
+        return self.base_height + len(self.present) - 1
+
+    def load(self, directory):
+        # Every backfilled chunk in the directory, chunk files are ordered by height
+        loaded = 0
+        for (low, high, path) in list_columnar_chunks(directory):
+            with ColumnarChunkReader(path) as reader:
+                heights = reader.column('height')
+                columns = {name: reader.column(name) for name in self.names}
+                blockhashes = reader.column('blockhash')
+                for index in range(reader.rows):
+                    row = {name: columns[name][index] for name in self.names}
+                    row['blockhash'] = bytes(
+                        blockhashes[index * 32:(index + 1) * 32]).hex()
+                    self.set_row(heights[index], row)
+                    loaded += 1
+        return loaded
+
+    def append(self, stats):
+        # getblockstats result, a block already stored with the same hash is a no-op
+        row = flatten_block_stats(stats)
+        self.set_row(stats['height'], row)
+
+    def set_row(self, height, row):
+        with self.lock:
+            if self.base_height == None:
+                self.base_height = height
+            if height < self.base_height:
+                self._prepend(self.base_height - height)
+            index = height - self.base_height
+            if index < len(self.present):
+                if self.present[index] and self.blockhashes[index] == row.get('blockhash'):
+                    return
+                if index < len(self.present) - 1:
+                    # Reorg or gap fill below the tip, sums past it no longer hold
+                    self.prefix_sums = {}
+            else:
+                self._extend(index + 1 - len(self.present))
+            for name in self.names:
+                self.columns[name][index] = int(row.get(name) or 0)
+            self.blockhashes[index] = row.get('blockhash')
+            self.present[index] = 1
+            if index == len(self.present) - 1:
+                for (name, sums) in self.prefix_sums.items():
+                    sums[index + 1] = sums[index] + self.values(name)[index]
+
+    def blockhash(self, height):
+        if self.base_height == None or not 0 <= height - self.base_height < len(self.present):
+            return None
+        return self.blockhashes[height - self.base_height]
+
+    def truncate(self, height):
+        # Drops every row above height, e.g. blocks of a chain that was reorged away
+        with self.lock:
+            if self.base_height == None or height >= self.tip():
+                return
+            keep = max(height - self.base_height + 1, 0)
+            for name in self.names:
+                del self.columns[name][keep:]
+            del self.present[keep:]
+            del self.blockhashes[keep:]
+            for sums in self.prefix_sums.values():
+                del sums[keep + 1:]
+            if keep == 0:
+                self.base_height = None
+                self.prefix_sums = {}
+
+    def _extend(self, count):
+        zeros = array('q', [0]) * count
+        for name in self.names:
+            self.columns[name].extend(zeros)
+        self.present.extend(zeros)
+        self.blockhashes.extend([None] * count)
+        for sums in self.prefix_sums.values():
+            sums.extend(array('d', [sums[-1]]) * count)
+
+    def _prepend(self, count):
+        zeros = array('q', [0]) * count
+        for name in self.names:
+            self.columns[name] = zeros + self.columns[name]
+        self.present = zeros + self.present
+        self.blockhashes = [None] * count + self.blockhashes
+        self.base_height -= count
+        self.prefix_sums = {}
+
+    def values(self, name):
+        if name == 'present':
+            return self.present
+        return self.columns[name]
+
+    def _prefix_sums(self, name):
+        sums = self.prefix_sums.get(name)
+        if sums == None:
+            values = self.values(name)
+            sums = array('d', [0.0]) * (len(values) + 1)
+            total = 0.0
+            for (index, value) in enumerate(values):
+                total += value
+                sums[index + 1] = total
+            self.prefix_sums[name] = sums
+        return sums
+
+    def _bounds(self, window, end_height):
+        # [start, end) indexes of the window ending at end_height, clipped to the history
+        end = len(self.present) if end_height == None else min(
+            end_height - self.base_height + 1, len(self.present))
+        return (max(end - window, 0), max(end, 0))
+
+    def window(self, name, window, end_height=None):
+        # Copy of the last window values up to end_height, gaps included as 0. Not a
+        # view, an exported buffer would stop the columns from growing.
+        with self.lock:
+            (start, end) = self._bounds(window, end_height)
+            return self.values(name)[start:end]
+
+    def rolling_mean(self, name, window, end_height=None):
+        # Mean over the blocks we have stats for in the window, None when there are none
+        with self.lock:
+            if self.base_height == None:
+                return None
+            (start, end) = self._bounds(window, end_height)
+            sums = self._prefix_sums(name)
+            present = self._prefix_sums('present')
+            count = present[end] - present[start]
+            if count == 0:
+                return None
+            return (sums[end] - sums[start]) / count
+
+    def rolling_means(self, name, window):
+        # Series over the whole history, element i is the mean of the window ending at base_height + i
+        with self.lock:
+            sums = self._prefix_sums(name)
+            present = self._prefix_sums('present')
+            means = array('d', [0.0]) * len(self.present)
+            for end in range(1, len(self.present) + 1):
+                start = max(end - window, 0)
+                count = present[end] - present[start]
+                means[end - 1] = (sums[end] - sums[start]) / count if count > 0 else float('nan')
+            return means
+
+    def percentile(self, name, q, window, end_height=None):
+        with self.lock:
+            if self.base_height == None:
+                return None
+            (start, end) = self._bounds(window, end_height)
+            values = sorted(value for (value, present) in zip(
+                self.values(name)[start:end], self.present[start:end]) if present)
+            return _percentile_of_sorted(values, q)
+
+    def rolling_percentiles(self, name, q, window):
+        # Series over the whole history, keeping the window sorted as it slides instead of re-sorting it
+        with self.lock:
+            values = self.values(name)
+            series = array('d', [0.0]) * len(self.present)
+            sorted_window = []
+            for index in range(len(self.present)):
+                if self.present[index]:
+                    bisect.insort(sorted_window, values[index])
+                leaving = index - window
+                if leaving >= 0 and self.present[leaving]:
+                    del sorted_window[bisect.bisect_left(sorted_window, values[leaving])]
+                percentile = _percentile_of_sorted(sorted_window, q)
+                series[index] = float('nan') if percentile == None else percentile
+            return series
+
+    def latest_features(self, names=ROLLING_FEATURE_COLUMNS, windows=ROLLING_WINDOWS):
+        # '<column>_mean_<window>' at the tip
+        return {'%s_mean_%d' % (name, window): self.rolling_mean(name, window)
+                for name in names for window in windows}
+
+
+def _percentile_of_sorted(values, q):
+    # Linear interpolation between closest ranks, q in [0, 100]
+    if len(values) == 0:
+        return None
+    rank = (len(values) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
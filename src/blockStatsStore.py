@@ -0,0 +1,180 @@
+import array
+import gzip
+import json
+import math
+import mmap
+import os
+import re
+import struct
+
+# Chunk file layout: magic, u32 header length, JSON header, then one contiguous
+# native (little-endian) column per field, each aligned to 8 bytes so it can be mmapped
+# and cast without copying. Columns are int64 ('q'), float64 ('d', NaN when missing)
+# or fixed width bytes from hex ('32s'). Cold chunks ending in .gz are gzipped whole
+# and read into memory instead.
+COLUMNAR_MAGIC = b'BSCOL\x00\x00\x01'
+COLUMNAR_VERSION = 1
+COLUMNAR_FILE_PATTERN = re.compile(r'^blocks_(\d+)_(\d+)\.col$')
+
+FEERATE_PERCENTILES = [10, 25, 50, 75, 90]
+
+# (column name, struct format) in file order
+BLOCK_STATS_COLUMNS = [('height', 'q'), ('time', 'q'), ('mediantime', 'q'), ('blockhash', '32s'),
+                       ('avgfee', 'q'), ('avgfeerate', 'q'), ('avgtxsize', 'q'),
+                       ('maxfee', 'q'), ('maxfeerate', 'q'), ('maxtxsize', 'q'),
+                       ('medianfee', 'q'), ('mediantxsize', 'q'),
+                       ('minfee', 'q'), ('minfeerate', 'q'), ('mintxsize', 'q'),
+                       ('totalfee', 'q'), ('subsidy', 'q'), ('total_out', 'q'),
+                       ('total_size', 'q'), ('total_weight', 'q'),
+                       ('swtotal_size', 'q'), ('swtotal_weight', 'q'), ('swtxs', 'q'),
+                       ('txs', 'q'), ('ins', 'q'), ('outs', 'q'),
+                       ('utxo_increase', 'q'), ('utxo_size_inc', 'q')] + \
+    [('feerate_percentiles_%d' % p, 'q') for p in FEERATE_PERCENTILES]
+
+
+def flatten_block_stats(stats):
+    row = dict(stats)
+    for (index, p) in enumerate(FEERATE_PERCENTILES):
+        row['feerate_percentiles_%d' % p] = stats['feerate_percentiles'][index]
+    return row
+
+
+class NDJSONWriter():
+    # One JSON line per block so memory stays flat whatever the range size. The file
+    # is truncated when a run starts, a rerun over the same range doesn't duplicate rows.
+    def __init__(self, path):
+        self.outfile = open(path, 'w')
+
+    def write(self, stats):
+        self.outfile.write(json.dumps(stats, default=str))
+        self.outfile.write('\n')
+        self.outfile.flush()
+
+    def close(self):
+        self.outfile.close()
+
+
+def write_columnar_chunk(path, rows, columns=BLOCK_STATS_COLUMNS, flatten=flatten_block_stats):
+    rows = [flatten(row) for row in rows]
+    header_columns = []
+    offset = 0
+    for (name, fmt) in columns:
+        header_columns.append({'name': name, 'format': fmt, 'offset': offset})
+        offset += _aligned(struct.calcsize(fmt) * len(rows))
+    header = json.dumps({'version': COLUMNAR_VERSION, 'rows': len(
+        rows), 'columns': header_columns}).encode('utf-8')
+    data_start = _aligned(len(COLUMNAR_MAGIC) + 4 + len(header))
+
+    # Write then rename so a crash never leaves a partial chunk behind
+    with (gzip.open(path + '.tmp', 'wb') if path.endswith('.gz') else open(path + '.tmp', 'wb')) as outfile:
+        outfile.write(COLUMNAR_MAGIC)
+        outfile.write(struct.pack('<I', len(header)))
+        outfile.write(header)
+        outfile.write(b'\x00' * (data_start - outfile.tell()))
+        for (name, fmt) in columns:
+            if fmt == 'q':
+                data = array.array('q', [int(row.get(name) or 0)
+                                         for row in rows]).tobytes()
+            elif fmt == 'd':
+                data = array.array('d', [_float_or_nan(row.get(name))
+                                         for row in rows]).tobytes()
+            else:
+                width = struct.calcsize(fmt)
+                data = b''.join(bytes.fromhex(row.get(name) or '').rjust(
+                    width, b'\x00') for row in rows)
+            outfile.write(data)
+            outfile.write(b'\x00' * (_aligned(len(data)) - len(data)))
+    fd = os.open(path + '.tmp', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(path + '.tmp', path)
+
+
+class ColumnarChunkReader():
+    def __init__(self, path):
+        self.infile = None
+        if path.endswith('.gz'):
+            with gzip.open(path, 'rb') as infile:
+                self.map = infile.read()
+        else:
+            self.infile = open(path, 'rb')
+            self.map = mmap.mmap(self.infile.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        if self.map[:len(COLUMNAR_MAGIC)] != COLUMNAR_MAGIC:
+            raise Exception('%s is not a column file' % path)
+        header_length = struct.unpack_from(
+            '<I', self.map, len(COLUMNAR_MAGIC))[0]
+        header_start = len(COLUMNAR_MAGIC) + 4
+        header = json.loads(
+            self.map[header_start:header_start + header_length].decode('utf-8'))
+        if header['version'] != COLUMNAR_VERSION:
+            raise Exception('Unsupported column file version %s' %
+                            header['version'])
+        self.rows = header['rows']
+        self.data_start = _aligned(header_start + header_length)
+        self.columns = {column['name']: column for column in header['columns']}
+        self.buffer = memoryview(self.map)
+        self.views = []
+
+    def column(self, name):
+        # Zero-copy view over the mmapped (or decompressed) column, numeric columns are cast to their format
+        column = self.columns[name]
+        width = struct.calcsize(column['format'])
+        start = self.data_start + column['offset']
+        view = self.buffer[start:start + width * self.rows]
+        self.views.append(view)
+        if column['format'] in ('q', 'd'):
+            view = view.cast(column['format'])
+            self.views.append(view)
+        return view
+
+    def close(self):
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        self.buffer.release()
+        if self.infile != None:
+            self.map.close()
+            self.infile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def list_columnar_chunks(directory, pattern=COLUMNAR_FILE_PATTERN):
+    chunks = []
+    if not os.path.isdir(directory):
+        return chunks
+    for name in os.listdir(directory):
+        match = pattern.match(name)
+        if match:
+            chunks.append((int(match.group(1)), int(
+                match.group(2)), os.path.join(directory, name)))
+    return sorted(chunks)
+
+
+def load_columns(directory, names, pattern=COLUMNAR_FILE_PATTERN):
+    # Concatenate a subset of numeric columns across every chunk, in file name order
+    columns = {}
+    for (low, high, path) in list_columnar_chunks(directory, pattern):
+        with ColumnarChunkReader(path) as reader:
+            for name in names:
+                view = reader.column(name)
+                columns.setdefault(name, array.array(view.format)).frombytes(view.tobytes())
+    return {name: columns.get(name, array.array('q')) for name in names}
+
+
+def _float_or_nan(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def _aligned(size):
+    return (size + 7) & ~7
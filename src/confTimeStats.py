@@ -0,0 +1,62 @@
+import math
+from array import array
+
+# Delay bins grow 20% each, bin i holds delays in (GROWTH^(i-1), GROWTH^i] seconds,
+# the last bin everything from about five months up
+DELAY_BIN_GROWTH = 1.2
+DELAY_BINS = 90
+# Forward decay weights are rescaled before they get near float overflow
+RESCALE_HALF_LIVES = 64
+
+
+def delay_bin(delay):
+    if delay <= 1:
+        return 0
+    return min(int(math.ceil(math.log(delay) / math.log(DELAY_BIN_GROWTH))), DELAY_BINS - 1)
+
+
+def delay_bin_bounds(index):
+    if index == 0:
+        return (0, 1)
+    return (DELAY_BIN_GROWTH ** (index - 1), DELAY_BIN_GROWTH ** index)
+
+
+class DecayingHistogram():
+    # Fixed size histogram of confirmation delays where a sample's weight halves
+    # every half life. Uses forward decay, new samples get exponentially larger
+    # weights instead of every bin being scaled down, so adding is O(1).
+    def __init__(self, half_life, now):
+        self.half_life = half_life
+        self.landmark = now
+        self.weights = array('d', [0.0]) * DELAY_BINS
+        self.total = 0.0
+
+    def add(self, delay, now):
+        if (now - self.landmark) / self.half_life > RESCALE_HALF_LIVES:
+            self.rescale(now)
+        weight = 2 ** ((now - self.landmark) / self.half_life)
+        self.weights[delay_bin(delay)] += weight
+        self.total += weight
+
+    def rescale(self, now):
+        scale = 2 ** (-(now - self.landmark) / self.half_life)
+        for index in range(DELAY_BINS):
+            self.weights[index] *= scale
+        self.total *= scale
+        self.landmark = now
+
+    def samples(self, now):
+        # Decayed number of samples, a sample weighs 1 when added
+        return self.total * 2 ** (-(now - self.landmark) / self.half_life)
+
+    def quantile(self, q):
+        if self.total == 0:
+            return None
+        target = q * self.total
+        cumulative = 0.0
+        for (index, weight) in enumerate(self.weights):
+            if weight > 0 and cumulative + weight >= target:
+                low, high = delay_bin_bounds(index)
+                return low + (target - cumulative) / weight * (high - low)
+            cumulative += weight
+        return delay_bin_bounds(DELAY_BINS - 1)[1]
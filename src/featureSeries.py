@@ -0,0 +1,71 @@
+import bisect
+from array import array
+
+
+class FeatureSeries():
+    # The mempool state features in effect over time, as parallel arrays sorted by
+    # refresh time and loaded from the db's feature points. An as-of lookup is one
+    # binary search plus a read of the (cached) snapshot it points at.
+    def __init__(self, rocks):
+        self.rocks = rocks
+        self.times = array('d')
+        self.snapshot_ids = array('q')
+        # Refresh time of the stalest feature at each point
+        self.refreshed_at = array('d')
+
+    def __len__(self):
+        return len(self.times)
+
+    def load(self, start=None, end=None):
+        # Snapshots written before the series existed stand in for the refreshes up to its first point
+        points = list(self.rocks.iter_feature_points(start, end))
+        first = points[0][0] if len(points) > 0 else None
+        seeded = [(snapshot['createdat'], snapshot_id, snapshot['createdat'])
+                  for (snapshot_id, snapshot) in self.rocks.iter_snapshots()
+                  if (first == None or snapshot['createdat'] < first)
+                  and (start == None or snapshot['createdat'] >= start)
+                  and (end == None or snapshot['createdat'] < end)]
+        for (ts, snapshot_id, refreshed_at) in sorted(seeded) + points:
+            self.append(ts, snapshot_id, refreshed_at)
+        return len(seeded) + len(points)
+
+    def append(self, ts, snapshot_id, refreshed_at):
+        index = len(self.times)
+        if index > 0 and ts < self.times[-1]:
+            index = bisect.bisect_right(self.times, ts)
+        self.times.insert(index, ts)
+        self.snapshot_ids.insert(index, snapshot_id)
+        self.refreshed_at.insert(index, refreshed_at)
+
+    def index_as_of(self, ts):
+        # Index of the latest point at or before ts, -1 before the first one
+        return bisect.bisect_right(self.times, ts) - 1
+
+    def snapshot_ids_as_of(self, timestamps):
+        # Snapshot id in effect at each timestamp, -1 before the first point
+        result = array('q', [-1]) * len(timestamps)
+        for (position, ts) in enumerate(timestamps):
+            index = bisect.bisect_right(self.times, ts) - 1
+            if index >= 0:
+                result[position] = self.snapshot_ids[index]
+        return result
+
+    def as_of(self, ts):
+        # Full feature row in effect at ts, e.g. a tx's mempooldate, None before the first point
+        index = self.index_as_of(ts)
+        if index < 0:
+            return None
+        snapshot = self.rocks.get_snapshot(self.snapshot_ids[index])
+        if snapshot == None:
+            return None
+        return {**snapshot['features'], 'snapshotid': self.snapshot_ids[index],
+                'featureage': int(ts - self.refreshed_at[index])}
+
+    def join(self, tx):
+        # Tx record with its features replaced by the ones in effect at its mempooldate
+        if tx == None or 'mempooldate' not in tx:
+            return tx
+        features = self.as_of(tx['mempooldate'])
+        if features == None:
+            return tx
+        return {**tx, **features}
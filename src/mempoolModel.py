@@ -0,0 +1,115 @@
+import math
+import threading
+import time
+
+SATS_PER_BTC = 100000000
+# Feerates at or above this (sat/vB) share the last histogram bucket
+HISTOGRAM_MAX_BUCKET = 1000
+
+
+class MempoolModel():
+    # In-process view of the node's mempool, kept current from ZMQ events with
+    # running aggregates so averages never need a full getrawmempool scan.
+    def __init__(self):
+        self.lock = threading.Lock()
+        # txid -> (fee in sats, vsize, time added)
+        self.entries = {}
+        # txid -> time removed, since the last reconciliation started
+        self.removed = {}
+        self.total_fee = 0
+        self.total_fee_rate = 0
+        self.total_vsize = 0
+        # floor(feerate) bucket -> [tx count, vbytes]
+        self.fee_rate_histogram = {}
+        self.last_reconciled_at = None
+
+    def _bucket(self, fee, vsize):
+        return min(math.floor(fee / vsize), HISTOGRAM_MAX_BUCKET)
+
+    def _add(self, txid, fee, vsize, added_at):
+        self.entries[txid] = (fee, vsize, added_at)
+        self.total_fee += fee
+        self.total_fee_rate += fee / vsize
+        self.total_vsize += vsize
+        bucket = self.fee_rate_histogram.setdefault(
+            self._bucket(fee, vsize), [0, 0])
+        bucket[0] += 1
+        bucket[1] += vsize
+
+    def _remove(self, txid, removed_at):
+        self.removed[txid] = removed_at
+        entry = self.entries.pop(txid, None)
+        if entry is None:
+            return
+        fee, vsize, added_at = entry
+        self.total_fee -= fee
+        self.total_fee_rate -= fee / vsize
+        self.total_vsize -= vsize
+        key = self._bucket(fee, vsize)
+        bucket = self.fee_rate_histogram[key]
+        bucket[0] -= 1
+        bucket[1] -= vsize
+        if bucket[0] == 0:
+            del self.fee_rate_histogram[key]
+
+    def add(self, txid, fee, vsize):
+        if vsize <= 0:
+            return
+        with self.lock:
+            if txid in self.entries:
+                return
+            self._add(txid, fee, vsize, time.time())
+
+    def remove(self, txid):
+        with self.lock:
+            self._remove(txid, time.time())
+
+    def remove_many(self, txids):
+        now = time.time()
+        with self.lock:
+            for txid in txids:
+                self._remove(txid, now)
+
+    def reconcile(self, mempool, started_at):
+        # mempool is a getrawmempool(True) snapshot requested at started_at. Txs added after
+        # that are kept, txs removed after that are not brought back by the stale snapshot.
+        with self.lock:
+            recent = [(txid, entry) for (txid, entry) in self.entries.items()
+                      if entry[2] >= started_at and txid not in mempool]
+            removed = {txid for (txid, removed_at) in self.removed.items()
+                       if removed_at >= started_at}
+            self.entries = {}
+            self.removed = {}
+            self.total_fee = 0
+            self.total_fee_rate = 0
+            self.total_vsize = 0
+            self.fee_rate_histogram = {}
+            for txid in mempool:
+                if txid in removed or mempool[txid]['vsize'] <= 0:
+                    continue
+                entry = mempool[txid]
+                fee = entry['fee'] if 'fee' in entry else entry['fees']['base']
+                self._add(txid, float(fee * SATS_PER_BTC),
+                          entry['vsize'], started_at)
+            for (txid, (fee, vsize, added_at)) in recent:
+                self._add(txid, fee, vsize, added_at)
+            self.last_reconciled_at = started_at
+
+    def size(self):
+        return len(self.entries)
+
+    def average_fee(self):
+        with self.lock:
+            if len(self.entries) == 0:
+                return 0
+            return self.total_fee / len(self.entries)
+
+    def average_fee_rate(self):
+        with self.lock:
+            if len(self.entries) == 0:
+                return 0
+            return self.total_fee_rate / len(self.entries)
+
+    def histogram(self):
+        with self.lock:
+            return {bucket: list(counts) for (bucket, counts) in self.fee_rate_histogram.items()}
@@ -1,28 +1,59 @@
 import asyncio
 import math
-import requests
+import random
 import os
 import json
 import datetime as dt
 from enum import Enum
 import time
-from bitcoinrpc.authproxy import AuthServiceProxy, JSONRPCException
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from batchRpc import BatchRPCClient, InstrumentedRPC, rpc_url_from_environ
+from mempoolModel import MempoolModel, HISTOGRAM_MAX_BUCKET
+from confTimeStats import DecayingHistogram
+from blockStatsHistory import BlockStatsHistory
+from tipFollower import TipFollower
+from metrics import registry
 
 SATS_PER_BTC = 100000000
 
 
 # Seconds
 GET_RESOURCES_TIMER = 60
+HTTP_TIMEOUT = 10
+RPC_TIMEOUT = 30
+ERROR_BACKOFF_BASE = 5
+ERROR_BACKOFF_MAX = 300
+# Fraction of a service's interval added or removed at random so refreshes don't line up
+REFRESH_JITTER = 0.1
+# Seconds for a conf time sample's weight to halve, overridable with CONF_TIME_HALF_LIFE environ
+CONF_TIME_HALF_LIFE = 6 * 3600
+# Buckets whose decayed sample count falls below this are dropped on update
+CONF_TIME_MIN_SAMPLES = 0.01
+# Backfilled block stats loaded into the history at startup, overridable with BLOCK_STATS_DIR environ
+BLOCK_STATS_DIR = 'block_stats'
+# 'full' fetches every service before starting, 'fast' restores the last persisted
+# snapshot and warms services in the background, overridable with STARTUP_MODE environ
+STARTUP_MODE = 'full'
+
+
+def http_get_json(url, timeout):
+    # Imported on first use, only the live feature services need requests
+    import requests
+    return requests.get(url, timeout=timeout).json()
 
 
 class MarketPriceService():
     resource_url = 'https://casa-crypto-price-service-staging.s3.amazonaws.com/v1/crypto-price-service.json'
+    timeout = HTTP_TIMEOUT
+    refresh_interval = GET_RESOURCES_TIMER
 
     def __init__(self):
-        self.update()
+        # Fetched by MempoolState on startup
+        self.market_price = None
 
     def update(self):
-        self.market_price = requests.get(self.resource_url).json()[
+        self.market_price = http_get_json(self.resource_url, self.timeout)[
             "median"]["BTC"]["USD"]
 
         return self.market_price
@@ -30,12 +61,16 @@ class MarketPriceService():
 
 class TotalHashRateService():
     resource_url = 'https://api.blockchain.info/charts/hash-rate?daysAverageString=7D&timespan=1year&sampled=true&metadata=false&cors=true&format=json'
+    # A year of chart data is a larger response than the other charts
+    timeout = 2 * HTTP_TIMEOUT
+    # Daily chart points, hourly is plenty
+    refresh_interval = 3600
 
     def __init__(self):
-        self.update()
+        self.total_hash_rate = None
 
     def update(self):
-        self.total_hash_rate = requests.get(self.resource_url).json()[
+        self.total_hash_rate = http_get_json(self.resource_url, self.timeout)[
             "values"][-1]["y"]
 
         return self.total_hash_rate
@@ -43,12 +78,14 @@ class TotalHashRateService():
 
 class MinerRevenueService():
     resource_url = 'https://api.blockchain.info/charts/miners-revenue?timespan=5days&sampled=true&metadata=false&cors=true&format=json'
+    timeout = HTTP_TIMEOUT
+    refresh_interval = 1800
 
     def __init__(self):
-        self.update()
+        self.miner_revenue = None
 
     def update(self):
-        self.miner_revenue = requests.get(self.resource_url).json()[
+        self.miner_revenue = http_get_json(self.resource_url, self.timeout)[
             "values"][-1]["y"]
 
         return self.miner_revenue
@@ -56,12 +93,14 @@ class MinerRevenueService():
 
 class MempoolGrowthRateService():
     resource_url = 'https://api.blockchain.info/charts/mempool-growth?timespan=5days&sampled=true&metadata=false&cors=true&format=json'
+    timeout = HTTP_TIMEOUT
+    refresh_interval = 600
 
     def __init__(self):
-        self.update()
+        self.growth_rate = None
 
     def update(self):
-        self.growth_rate = requests.get(self.resource_url).json()[
+        self.growth_rate = http_get_json(self.resource_url, self.timeout)[
             "values"][-1]["y"]
 
         return self.growth_rate
@@ -69,12 +108,14 @@ class MempoolGrowthRateService():
 
 class AverageConfirmationService():
     resource_url = 'https://api.blockchain.info/charts/avg-confirmation-time?timespan=5days&sampled=true&metadata=false&cors=true&format=json'
+    timeout = HTTP_TIMEOUT
+    refresh_interval = 600
 
     def __init__(self):
-        self.update()
+        self.average_confirmation_time = None
 
     def update(self):
-        self.average_confirmation_time = requests.get(self.resource_url).json()[
+        self.average_confirmation_time = http_get_json(self.resource_url, self.timeout)[
             "values"][-1]["y"]
 
         return self.average_confirmation_time
@@ -82,78 +123,138 @@ class AverageConfirmationService():
 
 class MedianConfirmationService():
     resource_url = 'https://api.blockchain.info/charts/median-confirmation-time?timespan=5days&sampled=true&metadata=false&cors=true&format=json'
+    timeout = HTTP_TIMEOUT
+    refresh_interval = 600
 
     def __init__(self):
-        self.update()
+        self.median_confirmation_time = None
 
     def update(self):
-        self.median_confirmation_time = requests.get(self.resource_url).json()[
+        self.median_confirmation_time = http_get_json(self.resource_url, self.timeout)[
             "values"][-1]["y"]
 
         return self.median_confirmation_time
 
 
 class ConfTimePerFeeRate():
-    # UPDATE_THRESHOLD = 1800  # Seconds
+    # A decaying conf time histogram per fee rate bucket, memory is fixed however long
+    # it runs. The scheduler calls update once per interval to drop decayed buckets.
+    refresh_interval = 1800
 
-    def __init__(self):
+    def __init__(self, half_life=CONF_TIME_HALF_LIFE):
+        self.half_life = half_life
         self.last_updated_at = None
         self.conf_times_per_fee_bucket = {}
+        self.lock = threading.Lock()
         self.update()
 
-    def update_conf_times_per_fee(self, rate, time_to_conf):
-        if rate in self.conf_times_per_fee_bucket:
-            self.conf_times_per_fee_bucket[rate].append(time_to_conf)
-        else:
-            self.conf_times_per_fee_bucket[rate] = [time_to_conf]
+    def update_conf_times_per_fee(self, rate, time_to_conf, now=None):
+        now = now or time.time()
+        rate = min(rate, HISTOGRAM_MAX_BUCKET)
+        with self.lock:
+            if rate not in self.conf_times_per_fee_bucket:
+                self.conf_times_per_fee_bucket[rate] = DecayingHistogram(
+                    self.half_life, now)
+            self.conf_times_per_fee_bucket[rate].add(max(time_to_conf, 0), now)
+
+    def summary(self, rate, now=None):
+        # Compact conf time stats of one bucket, as stored on confirmed tx records
+        now = now or time.time()
+        with self.lock:
+            histogram = self.conf_times_per_fee_bucket.get(
+                min(rate, HISTOGRAM_MAX_BUCKET))
+            if histogram == None:
+                return {}
+            return {
+                'confp50': int(round(histogram.quantile(0.5))),
+                'confp90': int(round(histogram.quantile(0.9))),
+                'confsamples': histogram.samples(now)
+            }
 
     def update(self):
-        current_time = int(time.time())
-        if self.last_updated_at == None or abs(current_time - self.last_updated_at) < UPDATE_THRESHOLD:
-            print('DEBUG not updating conf time fee buckets')
-            return
-        self.last_updated_at = current_time
-        self.conf_times_per_fee_bucket = {}
+        now = time.time()
+        self.last_updated_at = int(now)
+        with self.lock:
+            self.conf_times_per_fee_bucket = {rate: histogram for (rate, histogram) in self.conf_times_per_fee_bucket.items()
+                                              if histogram.samples(now) >= CONF_TIME_MIN_SAMPLES}
 
 
 class FeeBucketsService():
     resource_url = 'https://api.blockchain.info/charts/mempool-state-by-fee-level/interval?cors=true'
+    timeout = HTTP_TIMEOUT
+    refresh_interval = GET_RESOURCES_TIMER
 
     def __init__(self):
-        self.update()
+        self.fee_buckets = None
 
     def update(self):
         # Most current bucket fees is at the end of the list
         # Rates are structured as the following: [feePerByte, Total bytes of txs in mempool paying this rate, Total # of txs in memepool paying this rate]
-        rates = requests.get(self.resource_url).json()['interval'][-1]['rates']
+        rates = http_get_json(self.resource_url, self.timeout)['interval'][-1]['rates']
         print(rates)
-        self.fee_buckets = {}
+        # Build aside and swap so readers on other threads never see a partial dict
+        fee_buckets = {}
         for rate in rates:
-            self.fee_buckets[rate[0]] = {
+            fee_buckets[rate[0]] = {
                 'totalbytes': rate[1], 'totaltxs': rate[2]}
+        self.fee_buckets = fee_buckets
 
         return self.fee_buckets
 
 
 class NetworkDifficultyService():
+    timeout = RPC_TIMEOUT
+    # Fallback poll, new blocks update it through the tip follower
+    refresh_interval = 600
+
     def __init__(self, rpc_connection):
         self.rpc_connection = rpc_connection
-        self.update()
+        self.network_difficulty = None
 
     def update(self):
-        difficulty = self.rpc_connection.getbestblockhash()
-        self.network_difficulty = difficulty
-        return difficulty
+        header = self.rpc_connection.getblockheader(
+            self.rpc_connection.getbestblockhash())
+        return self.set_difficulty(header['difficulty'])
+
+    def set_difficulty(self, difficulty):
+        self.network_difficulty = float(difficulty)
+        return self.network_difficulty
+
+    def on_tip(self, header, stats):
+        self.set_difficulty(header['difficulty'])
 
 
 class BlockStatsService():
-    def __init__(self, rpc_connection):
+    timeout = RPC_TIMEOUT
+    # Fallback poll when following the tip, new blocks arrive through the tip follower
+    refresh_interval = GET_RESOURCES_TIMER
+
+    def __init__(self, rpc_connection, tip_follower=None):
         self.rpc_connection = rpc_connection
+        self.tip_follower = tip_follower
+        self.rolling_features = {}
+        self.stats = None
+        if self.tip_follower != None:
+            self.refresh_interval = 600
+            self.tip_follower.add_listener(self.on_tip)
 
     def update(self, block_height=None):
+        if block_height == None and self.tip_follower != None:
+            # A no-op unless a block notification was missed
+            self.tip_follower.on_block(self.rpc_connection.getbestblockhash())
+            return self.stats
         if (block_height == None):
             block_height = self.rpc_connection.getblockcount()
         stats = self.rpc_connection.getblockstats(block_height)
+        self.set_stats(stats)
+        return stats
+
+    def on_tip(self, header, stats):
+        self.set_stats(stats)
+        self.stats = stats
+        self.rolling_features = self.tip_follower.history.latest_features()
+
+    def set_stats(self, stats):
         self.avg_fee = stats['avgfee']
         self.avg_fee_rate = stats['avgfeerate']
         self.avg_tx_size = stats['avgtxsize']
@@ -176,9 +277,13 @@ class BlockStatsService():
 
 
 class MempoolSizeService():
+    timeout = RPC_TIMEOUT
+    refresh_interval = 10
+
     def __init__(self, rpc_connection):
         self.rpc_connection = rpc_connection
-        self.update()
+        self.mempool_size = None
+        self.average_mempool_tx_size = None
 
     def update(self):
         mempool_info = self.rpc_connection.getmempoolinfo()
@@ -193,35 +298,40 @@ class MempoolSizeService():
 
 
 class MempoolFeeInfoService():
-    def __init__(self, rpc_connection):
+    # Verbose getrawmempool can be very large
+    timeout = 2 * RPC_TIMEOUT
+    refresh_interval = 10
+    # Full snapshot to correct drift from evictions and replacements ZMQ doesn't report
+    reconcile_interval = 600
+
+    def __init__(self, rpc_connection, mempool_model):
         self.rpc_connection = rpc_connection
-        self.update()
+        self.mempool_model = mempool_model
+        self.average_fee = None
+        self.average_fee_rate = None
+        self.fee_rate_histogram = None
 
     def update(self):
-        mempool = self.rpc_connection.getrawmempool(True)
-        running_fee = 0
-        running_fee_rate = 0
-
-        for txId in mempool:
-            fee = mempool[txId]['fee'] * SATS_PER_BTC
-            running_fee += fee
-            running_fee_rate += fee / mempool[txId]['vsize']
-        if len(mempool) > 0:
-            self.average_fee = running_fee / len(mempool)
-            self.average_fee_rate = running_fee_rate / len(mempool)
-        else:
-            self.average_fee = 0
-            self.average_fee_rate = 0
+        last_reconciled_at = self.mempool_model.last_reconciled_at
+        if last_reconciled_at == None or time.time() - last_reconciled_at >= self.reconcile_interval:
+            started_at = time.time()
+            self.mempool_model.reconcile(
+                self.rpc_connection.getrawmempool(True), started_at)
+        self.average_fee = self.mempool_model.average_fee()
+        self.average_fee_rate = self.mempool_model.average_fee_rate()
+        self.fee_rate_histogram = self.mempool_model.histogram()
 
 
 class FeeService():
     resource_url = 'https://bitcoiner.live/api/fees/estimates/latest'
+    timeout = HTTP_TIMEOUT
+    refresh_interval = GET_RESOURCES_TIMER
 
     def __init__(self):
-        self.update()
+        self.rates = None
 
     def update(self):
-        response = requests.get(self.resource_url).json()
+        response = http_get_json(self.resource_url, self.timeout)
         # Sats per vbyte
         self.rates = [response['estimates']['30']['sat_per_vbyte'], response['estimates']['60']['sat_per_vbyte'],
                       response['estimates']['120']['sat_per_vbyte'], response['estimates']['180']['sat_per_vbyte'],
@@ -229,8 +339,12 @@ class FeeService():
 
 
 class DatesService():
+    refresh_interval = GET_RESOURCES_TIMER
+
     def __init__(self):
-        self.update()
+        self.day_of_week = None
+        self.hour_of_day = None
+        self.month_of_year = None
 
     def update(self):
         self.day_of_week = dt.datetime.today().weekday()
@@ -239,20 +353,33 @@ class DatesService():
 
 
 class MempoolState():
-    def __init__(self, logging):
-        if ('RPC_USER' not in os.environ
-            or 'RPC_PASSWORD' not in os.environ
-            or 'RPC_HOST' not in os.environ
-                or 'RPC_PORT' not in os.environ):
-            raise Exception(
-                'Need to specify RPC_USER and RPC_PASSWORD, RPC_HOST, RPC_PORT environs')
-        self.rpc_connection = AuthServiceProxy("http://%s:%s@%s:%s" %
-                                               (os.environ['RPC_USER'], os.environ['RPC_PASSWORD'],  os.environ['RPC_HOST'], os.environ['RPC_PORT']))
+    def __init__(self, logging, rocks=None):
+        # Raises if the RPC environs are missing
+        self.rpc_url = rpc_url_from_environ()
+        self.batch_rpc = BatchRPCClient(self.rpc_url)
 
         self.logging = logging
 
-        self.block_stats_service = BlockStatsService(self.rpc_connection)
-        self.network_difficulty = NetworkDifficultyService(self.rpc_connection)
+        # Services refresh concurrently, so each RPC backed one gets its own connection
+        self.fast_start = os.environ.get(
+            'STARTUP_MODE', STARTUP_MODE) == 'fast'
+        self.block_stats_history = BlockStatsHistory()
+        if self.fast_start:
+            # Blocks the tip follower adds meanwhile are merged in by height
+            threading.Thread(target=self.load_block_stats_history,
+                             name='HistoryLoader', daemon=True).start()
+        else:
+            self.load_block_stats_history()
+        # Driven by ZMQHandler's block stage, the services' polls are only a fallback
+        self.tip_follower = TipFollower(
+            self.new_rpc_connection(), self.batch_rpc, self.block_stats_history, logging)
+        self.block_stats_service = BlockStatsService(
+            self.new_rpc_connection(), self.tip_follower)
+        self.network_difficulty = NetworkDifficultyService(
+            self.new_rpc_connection())
+        self.tip_follower.add_listener(self.network_difficulty.on_tip)
+        # After the services' own listeners, so their new values are in place
+        self.tip_follower.add_listener(self.on_tip)
         self.date_service = DatesService()
         self.fee_service = FeeService()
         self.median_confirmation_time_service = MedianConfirmationService()
@@ -261,29 +388,203 @@ class MempoolState():
         self.miner_revenue_service = MinerRevenueService()
         self.total_hash_rate_service = TotalHashRateService()
         self.market_price_service = MarketPriceService()
-        self.mempool_size_service = MempoolSizeService(self.rpc_connection)
-        self.mempool_fee_service = MempoolFeeInfoService(self.rpc_connection)
+        self.mempool_size_service = MempoolSizeService(
+            self.new_rpc_connection())
+        # Kept current by ZMQHandler from rawtx and rawblock events
+        self.mempool_model = MempoolModel()
+        self.mempool_fee_service = MempoolFeeInfoService(
+            self.new_rpc_connection(), self.mempool_model)
         self.fee_bucket_service = FeeBucketsService()
-        self.conf_time_per_fee_rate_service = ConfTimePerFeeRate()
+        self.conf_time_per_fee_rate_service = ConfTimePerFeeRate(
+            float(os.environ.get('CONF_TIME_HALF_LIFE', CONF_TIME_HALF_LIFE)))
 
         self.resources = [self.block_stats_service, self.network_difficulty, self.date_service, self.fee_service, self.median_confirmation_time_service,
                           self.average_confirmation_time_service, self.mempool_growth_rate_service, self.miner_revenue_service, self.total_hash_rate_service,
                           self.market_price_service, self.mempool_size_service, self.mempool_fee_service, self.fee_bucket_service, self.conf_time_per_fee_rate_service]
 
-        self.loop = asyncio.get_event_loop()
+        # Blocking updates run here so a slow source never stalls the event loop
+        self.executor = ThreadPoolExecutor(max_workers=len(self.resources))
+        self.in_flight = {}
+        self.failures = {resource: 0 for resource in self.resources}
+
+        # Tx feature name -> (service, attribute)
+        self.feature_sources = {
+            'mempoolgrowthrate': (self.mempool_growth_rate_service, 'growth_rate'),
+            'networkdifficulty': (self.network_difficulty, 'network_difficulty'),
+            'averageconfirmationtime': (self.average_confirmation_time_service, 'average_confirmation_time'),
+            'mempoolsize': (self.mempool_size_service, 'mempool_size'),
+            # TODO  'feeRateBuckets': (self.fee_bucket_service, 'fee_buckets'),
+            'minerrevenue': (self.miner_revenue_service, 'miner_revenue'),
+            'totalhashrate': (self.total_hash_rate_service, 'total_hash_rate'),
+            'marketprice': (self.market_price_service, 'market_price'),
+            'dayofweek': (self.date_service, 'day_of_week'),
+            'hourofday': (self.date_service, 'hour_of_day'),
+            'monthofyear': (self.date_service, 'month_of_year'),
+            'averagemempoolfee': (self.mempool_fee_service, 'average_fee'),
+            'averagemempoolfeerate': (self.mempool_fee_service, 'average_fee_rate'),
+            'averagemempooltxsize': (self.mempool_size_service, 'average_mempool_tx_size'),
+            'recommendedfeerates': (self.fee_service, 'rates')
+        }
+
+        # Tx records reference the snapshot of features in effect instead of copying them
+        self.rocks = rocks
+        self.snapshot_id = None
+        self.snapshot_features = None
+        # Snapshots are updated from the event loop and, on new blocks, the ZMQ block stage
+        self.snapshot_lock = threading.Lock()
+        if self.rocks != None:
+            self.snapshot_id = self.rocks.get_last_snapshot_id()
+        now = time.time()
+        self.refreshed_at = {resource: now for resource in self.resources}
+        if self.fast_start:
+            self.restore_snapshot()
+        else:
+            self.fetch_all()
+            self.update_snapshot()
 
-    def get_resources(self):
-        self.logging.info('[Mempool State]: Updating resources')
-        for resource in self.resources:
-            resource.update()
+        self.loop = asyncio.get_event_loop()
+        self.register_metrics()
+
+    def register_metrics(self):
+        registry.gauge('btc_etl_feature_age_seconds', 'Seconds since each feature was refreshed', ['feature'],
+                       lambda: {(feature,): time.time() - updated_at for (feature, updated_at) in self.get_feature_updated_at().items()})
+        registry.gauge('btc_etl_service_failures', 'Consecutive failed refreshes of each service', ['service'],
+                       lambda: {(type(resource).__name__,): failures for (resource, failures) in self.failures.items()})
+        registry.gauge('btc_etl_mempool_txs', 'Txs in the in memory mempool model',
+                       callback=self.mempool_model.size)
+        registry.gauge('btc_etl_tip_follower', 'Chain tip follower heights and reorg count', ['stat'],
+                       lambda: {(name,): value for (name, value) in self.tip_follower.stats().items()})
+
+    def load_block_stats_history(self):
+        loaded = self.block_stats_history.load(
+            os.environ.get('BLOCK_STATS_DIR', BLOCK_STATS_DIR))
+        self.logging.info('[Mempool State]: Loaded %d blocks of stats history' % loaded)
+
+    def fetch_all(self):
+        # Every service once before starting, concurrently, any failure stops startup
+        started_at = time.time()
+        futures = [self.executor.submit(resource.update)
+                   for resource in self.resources]
+        for future in futures:
+            future.result()
+        self.logging.info('[Mempool State]: Fetched every service in %.2fs' %
+                          (time.time() - started_at))
+
+    def restore_snapshot(self):
+        # The last persisted features stand in until each service's first refresh,
+        # which handle() starts right away. Their age counts from when they were
+        # really fetched, features without a snapshot count as never refreshed.
+        for (service, attribute) in self.feature_sources.values():
+            self.refreshed_at[service] = 0
+        snapshot = None if self.snapshot_id == None else self.rocks.get_snapshot(
+            self.snapshot_id)
+        if snapshot == None:
+            self.logging.info(
+                '[Mempool State]: No snapshot to restore, features are empty until fetched')
+            return
+        point = self.rocks.get_feature_point_as_of(time.time())
+        refreshed_at = point[2] if point != None and point[1] == self.snapshot_id else snapshot['createdat']
+        for (feature, value) in snapshot['features'].items():
+            if feature in self.feature_sources:
+                (service, attribute) = self.feature_sources[feature]
+                setattr(service, attribute, value)
+                self.refreshed_at[service] = refreshed_at
+        self.snapshot_features = self.get_features()
+        self.logging.info('[Mempool State]: Restored snapshot %d, %.0fs old' %
+                          (self.snapshot_id, time.time() - refreshed_at))
+
+    def new_rpc_connection(self):
+        return InstrumentedRPC(self.rpc_url, timeout=RPC_TIMEOUT)
+
+    async def update_resource(self, resource):
+        name = type(resource).__name__
+        # An update that outlived its timeout is still running, don't stack another on it
+        if resource in self.in_flight and not self.in_flight[resource].done():
+            self.logging.info(
+                '[Mempool State]: %s still updating, skipping' % name)
+            return
+        future = self.executor.submit(resource.update)
+        self.in_flight[resource] = future
+        try:
+            await asyncio.wait_for(asyncio.wrap_future(future), getattr(resource, 'timeout', RPC_TIMEOUT))
+            self.refreshed_at[resource] = time.time()
+            self.failures[resource] = 0
+            self.update_snapshot()
+            self.record_feature_point()
+            return True
+        except Exception as e:
+            # Attributes are only replaced on success, so the last known value is kept
+            self.failures[resource] += 1
+            self.logging.info(
+                '[Mempool State]: Failed to update %s, keeping last value: %r' % (name, e))
+            return False
+
+    def on_tip(self, header, stats):
+        # The tip follower refreshed these services outside update_resource
+        now = time.time()
+        for resource in (self.block_stats_service, self.network_difficulty):
+            self.refreshed_at[resource] = now
+            self.failures[resource] = 0
+        self.update_snapshot()
+        self.record_feature_point()
+
+    def next_refresh_delay(self, resource):
+        interval = getattr(resource, 'refresh_interval', GET_RESOURCES_TIMER)
+        failures = self.failures[resource]
+        if failures > 0:
+            # Retry failing sources sooner than their interval, doubling the wait on each failure
+            return min(ERROR_BACKOFF_BASE * 2 ** (failures - 1), max(interval, ERROR_BACKOFF_MAX))
+        return interval * random.uniform(1 - REFRESH_JITTER, 1 + REFRESH_JITTER)
+
+    async def schedule_resource(self, resource, warm=False):
+        if warm:
+            await self.update_resource(resource)
+        while True:
+            await asyncio.sleep(self.next_refresh_delay(resource))
+            await self.update_resource(resource)
+
+    def get_features(self):
+        return {feature: getattr(service, attribute) for (feature, (service, attribute)) in self.feature_sources.items()}
+
+    def get_feature_updated_at(self):
+        return {feature: self.refreshed_at[service] for (feature, (service, attribute)) in self.feature_sources.items()}
+
+    def update_snapshot(self):
+        # Persist a new snapshot only when a feature value actually changed
+        if self.rocks == None:
+            return
+        with self.snapshot_lock:
+            features = self.get_features()
+            if features == self.snapshot_features:
+                return
+            snapshot_id = 0 if self.snapshot_id == None else self.snapshot_id + 1
+            self.rocks.write_snapshot(
+                snapshot_id, {'createdat': int(time.time()), 'features': features})
+            # Written before it's published so readers never reference a missing snapshot
+            self.snapshot_features = features
+            self.snapshot_id = snapshot_id
+
+    def record_feature_point(self):
+        # Every refresh goes into the feature series, so the features in effect at any
+        # time can be rebuilt later without the external sources, see FeatureSeries
+        if self.rocks == None or self.snapshot_id == None:
+            return
+        now = time.time()
+        self.rocks.write_feature_point(
+            now, self.snapshot_id, now - self.get_feature_age(now))
 
-        self.logging.info('[Mempool State]: Done update resources')
+    def get_feature_age(self, now=None):
+        # Age in seconds of the stalest feature
+        if now == None:
+            now = time.time()
+        return now - min(self.refreshed_at[service] for (service, attribute) in self.feature_sources.values())
 
     async def handle(self):
         self.logging.info('[Mempool State]: Starting gather mempool status')
-        self.get_resources()
-        await asyncio.sleep(GET_RESOURCES_TIMER)
-        asyncio.ensure_future(self.handle())
+        # Each service refreshes on its own interval
+        for resource in self.resources:
+            asyncio.ensure_future(self.schedule_resource(
+                resource, warm=self.fast_start))
 
     def start(self):
         self.logging.info('[Mempool State]: Starting event loop')
@@ -292,3 +593,4 @@ class MempoolState():
 
     def stop(self):
         self.loop.stop()
+        self.executor.shutdown(wait=False)
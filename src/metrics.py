@@ -0,0 +1,216 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Served on METRICS_HOST:METRICS_PORT, a port of 0 turns the endpoint off
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 8090
+# Seconds
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+# Messages per key per interval let through by LogRateLimiter, overridable with LOG_RATE_LIMIT environ
+LOG_RATE_LIMIT = 10
+LOG_RATE_INTERVAL = 60
+
+
+def _format_labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for (name, value) in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter():
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        for (label_values, value) in sorted(self.values.items()):
+            lines.append('%s%s %s' % (self.name, _format_labels(
+                self.label_names, label_values), _format_value(value)))
+        return lines
+
+
+class Gauge():
+    # Either set directly or read from a callback at scrape time. A callback returns a
+    # number, or a dict of label values tuple -> number for labelled gauges.
+    def __init__(self, name, help, label_names=(), callback=None):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.callback = callback
+        self.values = {}
+
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s gauge' % self.name]
+        values = self.values
+        if self.callback != None:
+            try:
+                values = self.callback()
+            except Exception:
+                values = {}
+            if not isinstance(values, dict):
+                values = {(): values}
+        for (label_values, value) in sorted(values.items()):
+            if value == None:
+                continue
+            lines.append('%s%s %s' % (self.name, _format_labels(
+                self.label_names, label_values), _format_value(value)))
+        return lines
+
+
+class Histogram():
+    def __init__(self, name, help, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = list(buckets)
+        # label values -> [bucket counts..., +Inf count, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts == None:
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, *label_values):
+        return _Timer(self, label_values)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            values = {label_values: list(counts) for (label_values, counts) in self.values.items()}
+        for (label_values, counts) in sorted(values.items()):
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + [float('inf')], counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name, _format_labels(
+                    self.label_names, label_values, 'le="%s"' % _format_value(bound)), cumulative))
+            labels = _format_labels(self.label_names, label_values)
+            lines.append('%s_sum%s %s' % (self.name, labels, repr(counts[-1])))
+            lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+        return lines
+
+
+class _Timer():
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.started_at, *self.label_values)
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        # Re-registering a name replaces the metric, e.g. a callback gauge of a new instance
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, label_names=()):
+        return self.register(Counter(name, help, label_names))
+
+    def gauge(self, name, help, label_names=(), callback=None):
+        return self.register(Gauge(name, help, label_names, callback))
+
+    def histogram(self, name, help, label_names=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, label_names, buckets))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+LOG_SUPPRESSED = registry.counter(
+    'btc_etl_log_suppressed_total', 'Log lines dropped by rate limiting', ['key'])
+
+
+class LogRateLimiter():
+    # Lets through at most limit lines per key each interval, the first line after a
+    # quiet period says how many were dropped
+    def __init__(self, logging, limit=LOG_RATE_LIMIT, interval=LOG_RATE_INTERVAL):
+        self.logging = logging
+        self.limit = limit
+        self.interval = interval
+        # key -> [window start, lines logged, lines suppressed]
+        self.windows = {}
+
+    def info(self, key, message, *args):
+        now = time.time()
+        window = self.windows.get(key)
+        if window == None or now - window[0] >= self.interval:
+            suppressed = window[2] if window != None else 0
+            window = self.windows[key] = [now, 0, 0]
+            if suppressed > 0:
+                message = message + ' (%d similar suppressed)' % suppressed
+        if window[1] >= self.limit:
+            window[2] += 1
+            LOG_SUPPRESSED.inc(key)
+            return
+        window[1] += 1
+        self.logging.info(message, *args)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(
+        target=server.serve_forever, name='Metrics', daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,62 @@
+import asyncio
+import time
+from metrics import registry
+
+STAGE_SECONDS = registry.histogram(
+    'btc_etl_pipeline_stage_seconds', 'Time a pipeline stage spends on one item', ['stage'])
+
+
+class PipelineStage():
+    # A pool of coroutine workers pulling from a bounded queue, running a blocking
+    # handler on an executor and pushing non-None results to the next stage.
+    def __init__(self, name, handler, workers, queue_size, logging, next_stage=None):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.logging = logging
+        self.next_stage = next_stage
+        self.processed = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.max_depth = 0
+        self.started_at = time.time()
+
+    async def put(self, item):
+        await self.queue.put(item)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    async def work(self, loop, executor):
+        while True:
+            item = await self.queue.get()
+            started_at = time.time()
+            try:
+                result = await loop.run_in_executor(executor, self.handler, item)
+                self.processed += 1
+                if result is not None and self.next_stage is not None:
+                    # Blocks when the next stage is full, which in turn fills this queue
+                    await self.next_stage.put(result)
+            except Exception as e:
+                self.errors += 1
+                self.logging.info('[Pipeline]: %s stage failed: %r' % (self.name, e))
+            finally:
+                elapsed = time.time() - started_at
+                self.busy_seconds += elapsed
+                STAGE_SECONDS.observe(elapsed, self.name)
+                self.queue.task_done()
+
+    def start(self, loop, executor):
+        self.started_at = time.time()
+        return [loop.create_task(self.work(loop, executor)) for worker in range(self.workers)]
+
+    def stats(self):
+        elapsed = time.time() - self.started_at
+        return {
+            'workers': self.workers,
+            'depth': self.queue.qsize(),
+            'maxdepth': self.max_depth,
+            'processed': self.processed,
+            'errors': self.errors,
+            'persecond': self.processed / elapsed if elapsed > 0 else 0,
+            'avgseconds': self.busy_seconds / self.processed if self.processed > 0 else 0
+        }
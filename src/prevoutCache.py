@@ -0,0 +1,74 @@
+from collections import OrderedDict
+import threading
+from txParser import output_value_sats
+
+# Max number of (txid, vout) entries kept in memory
+DEFAULT_PREVOUT_CACHE_SIZE = 500000
+
+
+def tx_outputs(serialized_tx):
+    # (txid, output values in sats by vout) of a decoded tx, compact enough to send
+    # between processes
+    return (serialized_tx['txid'], [output_value_sats(vout) for vout in serialized_tx['vout']])
+
+
+class PrevoutCache():
+    def __init__(self, max_size=DEFAULT_PREVOUT_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, txid, vout):
+        key = (txid, vout)
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, txid, vout, value):
+        key = (txid, vout)
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def add_tx(self, serialized_tx):
+        # Cache every output of a decoded tx, in sats, so children spending it need no RPC
+        for vout in serialized_tx['vout']:
+            self.put(serialized_tx['txid'], vout['n'], output_value_sats(vout))
+
+    def add_block(self, block):
+        # Block as returned by getblock with verbosity 2
+        for serialized_tx in block['tx']:
+            self.add_tx(serialized_tx)
+
+    def add_outputs(self, outputs):
+        # outputs as made by tx_outputs
+        for (txid, values) in outputs:
+            for (n, value) in enumerate(values):
+                self.put(txid, n, value)
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0
+        return self.hits / total
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'maxsize': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hitratio': self.hit_ratio()
+        }
@@ -0,0 +1,164 @@
+import os
+import re
+import threading
+import time
+from itertools import islice
+from blockStatsStore import write_columnar_chunk, load_columns
+from metrics import registry
+from rocksclient import time_index_key
+from txExport import TX_EXPORT_COLUMNS, flatten_tx
+
+# Retention defaults, overridable with RETENTION_* environs. A TTL or archive age of
+# 0 days and a compaction interval of 0 turn that part off.
+UNCONFIRMED_TTL_DAYS = 14
+ARCHIVE_AFTER_DAYS = 0
+ARCHIVE_DIR = 'tx_archive'
+# Seconds
+RETENTION_INTERVAL = 3600
+COMPACTION_INTERVAL = 86400
+RETENTION_BATCH_SIZE = 10000
+ARCHIVE_FILE_PATTERN = re.compile(r'^txs_archive_(\d+)_(\d+)\.col\.gz$')
+
+RETENTION_RECORDS = registry.counter(
+    'btc_etl_retention_records_total', 'Tx records removed by retention', ['action'])
+SECONDS_PER_DAY = 86400
+
+
+class RetentionService():
+    # Ages records out of the hot db on a schedule: unconfirmed txs older than the TTL
+    # (evicted from the mempool, they'll never get a conf) are deleted, confirmed txs
+    # older than the archive age are moved to gzipped column files, and the key ranges
+    # are compacted afterwards so deletes don't linger as tombstones.
+    def __init__(self, rocks, logging, unconfirmed_ttl_days=UNCONFIRMED_TTL_DAYS, archive_after_days=ARCHIVE_AFTER_DAYS,
+                 archive_dir=ARCHIVE_DIR, interval=RETENTION_INTERVAL, compaction_interval=COMPACTION_INTERVAL,
+                 batch_size=RETENTION_BATCH_SIZE):
+        self.rocks = rocks
+        self.logging = logging
+        self.unconfirmed_ttl_days = unconfirmed_ttl_days
+        self.archive_after_days = archive_after_days
+        self.archive_dir = archive_dir
+        self.interval = interval
+        self.compaction_interval = compaction_interval
+        self.batch_size = batch_size
+        self.last_compacted_at = time.time()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.stats = {'expired': 0, 'archived': 0, 'archivefiles': 0, 'compactions': 0, 'lastrunseconds': 0.0}
+
+    @classmethod
+    def from_environ(cls, rocks, logging):
+        return cls(rocks, logging,
+                   unconfirmed_ttl_days=float(os.environ.get(
+                       'RETENTION_UNCONFIRMED_TTL_DAYS', UNCONFIRMED_TTL_DAYS)),
+                   archive_after_days=float(os.environ.get(
+                       'RETENTION_ARCHIVE_AFTER_DAYS', ARCHIVE_AFTER_DAYS)),
+                   archive_dir=os.environ.get(
+                       'RETENTION_ARCHIVE_DIR', ARCHIVE_DIR),
+                   interval=float(os.environ.get(
+                       'RETENTION_INTERVAL', RETENTION_INTERVAL)),
+                   compaction_interval=float(os.environ.get('RETENTION_COMPACTION_INTERVAL', COMPACTION_INTERVAL)))
+
+    def expire_unconfirmed(self, before):
+        # Deletes txs that entered the mempool before `before` and never confirmed
+        expired = 0
+        start = 0
+        while True:
+            entries = list(islice(self.rocks.iter_txids_by_mempool_date(
+                start, before, confirmed=False), self.batch_size))
+            if len(entries) == 0:
+                break
+            txs = self.rocks.get_txs([txid for (txid, mempool_date, conf) in entries])
+            # Records confirmed since their index entry was read are kept, index
+            # entries whose record is already gone are dropped as well
+            unconfirmed = [tx for tx in txs.values() if 'conf' not in tx]
+            stale = [time_index_key(mempool_date, txid) for (
+                txid, mempool_date, conf) in entries if txid not in txs]
+            self.rocks.delete_txs(unconfirmed, stale)
+            expired += len(unconfirmed)
+            # Everything deleted is before this date, step past it if nothing could be
+            start = entries[-1][1] if len(unconfirmed) + len(stale) > 0 else entries[-1][1] + 1
+            if len(entries) < self.batch_size:
+                break
+        RETENTION_RECORDS.inc('expired', amount=expired)
+        return expired
+
+    def archive_confirmed(self, before):
+        # Moves confirmed txs that entered the mempool before `before` into
+        # txs_archive_<before>_<part>.col.gz files, joined with their features.
+        # Each file is fsynced before its records are deleted.
+        archived = 0
+        part = 0
+        start = 0
+        os.makedirs(self.archive_dir, exist_ok=True)
+        while True:
+            entries = list(islice(self.rocks.iter_txids_by_mempool_date(
+                start, before, confirmed=True), self.batch_size))
+            if len(entries) == 0:
+                break
+            txs = list(self.rocks.fetch_txs(
+                [txid for (txid, mempool_date, conf) in entries], with_features=True))
+            # A file per run and part, parts of an earlier run with the same cutoff are kept
+            while os.path.exists(self.archive_path(before, part)):
+                part += 1
+            if len(txs) > 0:
+                write_columnar_chunk(self.archive_path(
+                    before, part), txs, TX_EXPORT_COLUMNS, flatten_tx)
+                part += 1
+                self.stats['archivefiles'] += 1
+            found = set(tx['txid'] for tx in txs)
+            self.rocks.delete_txs(txs, [time_index_key(mempool_date, txid) for (
+                txid, mempool_date, conf) in entries if txid not in found])
+            archived += len(txs)
+            start = entries[-1][1]
+            if len(entries) < self.batch_size:
+                break
+        RETENTION_RECORDS.inc('archived', amount=archived)
+        return archived
+
+    def archive_path(self, before, part):
+        return os.path.join(self.archive_dir, 'txs_archive_%d_%d.col.gz' % (int(before), part))
+
+    def run_once(self, now=None):
+        now = now or time.time()
+        started_at = time.time()
+        if self.unconfirmed_ttl_days > 0:
+            expired = self.expire_unconfirmed(
+                now - self.unconfirmed_ttl_days * SECONDS_PER_DAY)
+            self.stats['expired'] += expired
+            self.logging.info(
+                '[Retention]: Expired %d unconfirmed txs' % expired)
+        if self.archive_after_days > 0:
+            archived = self.archive_confirmed(
+                now - self.archive_after_days * SECONDS_PER_DAY)
+            self.stats['archived'] += archived
+            self.logging.info(
+                '[Retention]: Archived %d confirmed txs to %s' % (archived, self.archive_dir))
+        if self.compaction_interval > 0 and now - self.last_compacted_at >= self.compaction_interval:
+            self.rocks.compact()
+            self.last_compacted_at = now
+            self.stats['compactions'] += 1
+            self.logging.info('[Retention]: Compacted tx and index ranges')
+        self.stats['lastrunseconds'] = time.time() - started_at
+        return self.stats
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                self.logging.info('[Retention]: Failed: %r' % e)
+
+    def start(self):
+        if self.unconfirmed_ttl_days <= 0 and self.archive_after_days <= 0 and self.compaction_interval <= 0:
+            return
+        self.thread = threading.Thread(
+            target=self.run, name='Retention', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def load_archive(archive_dir, names):
+    # Columns of every archive file as arrays, like txExport.load_export
+    return load_columns(archive_dir, names, ARCHIVE_FILE_PATTERN)
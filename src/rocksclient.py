@@ -1,54 +1,371 @@
 import json
+import os
+import queue
 import rocksdb
+import struct
 import threading
-import decimal
+import time
+from collections import OrderedDict
+from metrics import registry
+from txidFilter import RotatingTxidFilter, DEFAULT_TXID_FILTER_CAPACITY, DEFAULT_TXID_FILTER_FP_RATE, \
+    DEFAULT_TXID_FILTER_WINDOW_DAYS, DEFAULT_TXID_FILTER_GENERATIONS
+from txCodec import encode_tx, decode_tx, txid_to_key_bytes, key_bytes_to_txid, DecimalEncoder
+
+# Key namespaces. Tx keys are the prefix followed by the 32 raw txid bytes.
+# Records from before the binary format are keyed by the ascii hex txid, which
+# never starts with one of these prefixes.
+TX_KEY_PREFIX = b't'
+# Followed by the big-endian u64 snapshot id so snapshots sort by id
+SNAPSHOT_KEY_PREFIX = b's'
+SNAPSHOT_CACHE_SIZE = 1024
+# Secondary indexes, valued by the big-endian u64 conf time or 0 while unconfirmed.
+# Mempool date index: prefix, u64 mempooldate, raw txid
+TIME_INDEX_PREFIX = b'm'
+# Fee rate index: prefix, u32 floor(fee / vsize) in sat/vB, u64 mempooldate, raw txid
+FEERATE_INDEX_PREFIX = b'r'
+# Feature series, one entry per mempool state refresh: prefix, big-endian u64 refresh
+# time in microseconds. Valued by the u64 snapshot id in effect and the f64 refresh
+# time of the stalest feature.
+FEATURE_POINT_PREFIX = b'p'
+# Set once records written before the indexes existed have been indexed
+INDEXES_BUILT_KEY = b'~indexes'
+
+# Database location and tuning, overridable with ROCKS_* environs
+DB_PATH = 'test.db'
+BLOCK_CACHE_MB = 2048
+BLOCK_CACHE_COMPRESSED_MB = 500
+MAX_OPEN_FILES = 300000
+WRITE_BUFFER_MB = 64
+MAX_WRITE_BUFFERS = 3
+TARGET_FILE_MB = 64
+BLOOM_BITS_PER_KEY = 10
+
+# Async write path defaults, overridable with ROCKS_WRITE_* environs
+WRITE_QUEUE_SIZE = 10000
+WRITE_BATCH_SIZE = 500
+# Seconds
+WRITE_FLUSH_INTERVAL = 1.0
+WRITE_STATS_INTERVAL = 60
+# Keys of legacy records sort within this range
+LEGACY_KEY_RANGE = (b'0', b'g')
+MIGRATION_BATCH_SIZE = 10000
+ROCKS_SECONDS = registry.histogram(
+    'btc_etl_rocks_seconds', 'RocksDB operation latency, lock wait excluded', ['op'])
+ROCKS_LOCK_WAIT_SECONDS = registry.histogram(
+    'btc_etl_rocks_lock_wait_seconds', 'Time spent waiting for the RocksDB client lock', ['op'])
+# Merge operands carrying a conf time. Tx records start with their codec
+# version or '{' so the two can't be confused.
+CONF_OPERAND_PREFIX = b'\xffc'
+_feature_point = struct.Struct('>Qd')
+
+
+def tx_key(txid):
+    return TX_KEY_PREFIX + txid_to_key_bytes(txid)
+
+
+def txid_from_key(key):
+    return key_bytes_to_txid(key[len(TX_KEY_PREFIX):])
+
+
+def time_index_key(mempool_date, txid):
+    return TIME_INDEX_PREFIX + struct.pack('>Q', int(mempool_date)) + txid_to_key_bytes(txid)
+
+
+def snapshot_key(snapshot_id):
+    return SNAPSHOT_KEY_PREFIX + struct.pack('>Q', snapshot_id)
+
+
+def feature_point_key(ts):
+    return FEATURE_POINT_PREFIX + struct.pack('>Q', int(ts * 1000000))
+
+
+def prefix_end(prefix):
+    # First key past every key starting with a one byte prefix
+    return bytes([prefix[0] + 1])
+
+
+def feerate_bucket(fee_rate):
+    return min(max(int(fee_rate), 0), 2 ** 32 - 1)
+
+
+def vsize_fee_rate(tx):
+    # sat/vB, the record's feerate is per serialized byte. Records without a vsize
+    # predate segwit fields, their size is their vsize.
+    return tx['fee'] / (tx.get('vsize') or tx['size'])
+
+
+def index_entries(tx):
+    # (key, value) of every index entry of a tx record
+    if 'mempooldate' not in tx or 'fee' not in tx or not (tx.get('vsize') or tx.get('size')):
+        return []
+    raw_txid = txid_to_key_bytes(tx['txid'])
+    mempool_date = int(tx['mempooldate'])
+    value = struct.pack('>Q', int(tx.get('conf') or 0))
+    return [(TIME_INDEX_PREFIX + struct.pack('>Q', mempool_date) + raw_txid, value),
+            (FEERATE_INDEX_PREFIX + struct.pack('>IQ', feerate_bucket(vsize_fee_rate(tx)), mempool_date) + raw_txid, value)]
+
+
+def conf_operand(conf_ts, conf_summary):
+    return CONF_OPERAND_PREFIX + json.dumps({**conf_summary, 'conf': int(conf_ts)}, cls=DecimalEncoder).encode('utf-8')
 
 
 class MergeOp(rocksdb.interfaces.AssociativeMergeOperator):
-    def merge(self, key, existing_tx, conf_ts):
-        if existing_tx != None:
-            tx = json.loads(existing_tx)
-            # Don't over write a conf time
-            if('conf' not in tx):
-                tx['conf'] = conf_ts
-            return (True, str(json.dumps(tx)).encode('ascii'))
-        return (True, conf_ts)
+    def merge(self, key, existing_value, operand):
+        if existing_value == None or existing_value.startswith(CONF_OPERAND_PREFIX):
+            # Nothing to attach to or two operands being combined, the first conf wins
+            return (True, existing_value or operand)
+        tx = decode_tx(existing_value, txid_from_key(key))
+        # Don't over write a conf time
+        if('conf' not in tx):
+            tx.update(json.loads(operand[len(CONF_OPERAND_PREFIX):]))
+        return (True, encode_tx(tx))
 
     def name(self):
         return b'MergeOp'
 
 
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, decimal.Decimal):
-            return str(o)
-        return super(DecimalEncoder, self).default(o)
+class WriteQueue():
+    # Bounded queue drained by one writer thread into WriteBatch commits, flushed
+    # when the batch is full or the flush interval has passed.
+    def __init__(self, client, logging, max_size=WRITE_QUEUE_SIZE, batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL):
+        self.client = client
+        self.logging = logging
+        self.queue = queue.Queue(maxsize=max_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # txid -> record queued but not yet committed, so reads see their own writes
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        # Held from registering a put in pending until it's queued, so an op that saw the
+        # pending record (e.g. a block's conf merge) can't be queued ahead of its put
+        self.put_lock = threading.Lock()
+        self.thread = None
+        self.stats = {'enqueued': 0, 'written': 0, 'merged': 0, 'batches': 0, 'maxdepth': 0,
+                      'blockedputs': 0, 'blockedseconds': 0.0, 'lastflushseconds': 0.0}
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name='RocksWriter', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # Drains everything already queued before returning
+        if self.thread == None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def put(self, op):
+        with self.put_lock:
+            if op[0] == 'put':
+                with self.pending_lock:
+                    self.pending[op[1]] = op[2]
+            try:
+                self.queue.put_nowait(op)
+            except queue.Full:
+                # Backpressure: the producer waits for the writer to catch up. The writer
+                # never takes put_lock, so it keeps draining meanwhile.
+                started_at = time.time()
+                self.queue.put(op)
+                self.stats['blockedputs'] += 1
+                self.stats['blockedseconds'] += time.time() - started_at
+        self.stats['enqueued'] += 1
+        self.stats['maxdepth'] = max(self.stats['maxdepth'], self.queue.qsize())
+
+    def get_pending(self, txid):
+        with self.pending_lock:
+            return self.pending.get(txid)
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def get_stats(self):
+        return {**self.stats, 'depth': self.queue.qsize()}
+
+    def run(self):
+        batch_txs = {}
+        batch_merges = []
+        deadline = time.time() + self.flush_interval
+        last_stats_at = time.time()
+        running = True
+        while running:
+            try:
+                op = self.queue.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                op = False
+            if op == None:
+                running = False
+            elif op:
+                self.apply(op, batch_txs, batch_merges)
+            if len(batch_txs) + len(batch_merges) >= self.batch_size or time.time() >= deadline or not running:
+                self.flush(batch_txs, batch_merges)
+                batch_txs = {}
+                batch_merges = []
+                deadline = time.time() + self.flush_interval
+            if time.time() - last_stats_at >= WRITE_STATS_INTERVAL:
+                self.logging.info('[rocks]: Write queue %s' % self.get_stats())
+                last_stats_at = time.time()
+
+    def apply(self, op, batch_txs, batch_merges):
+        if op[0] == 'put':
+            batch_txs[op[1]] = op[2]
+        elif op[0] == 'confs':
+            # No reads needed, merges are applied by MergeOp
+            confirmed, conf_ts = op[1:]
+            for (confirmed_tx, conf_summary) in confirmed:
+                tx = batch_txs.get(confirmed_tx['txid'])
+                if tx == None:
+                    batch_merges.append(
+                        (confirmed_tx, conf_operand(conf_ts, conf_summary), int(conf_ts)))
+                elif 'conf' not in tx:
+                    tx.update(conf_summary)
+                    tx['conf'] = int(conf_ts)
+
+    def flush(self, batch_txs, batch_merges):
+        if len(batch_txs) == 0 and len(batch_merges) == 0:
+            return
+        started_at = time.time()
+        batch = rocksdb.WriteBatch()
+        for (txid, tx) in batch_txs.items():
+            batch.put(tx_key(txid), encode_tx(tx))
+            for (key, value) in index_entries(tx):
+                batch.put(key, value)
+        for (tx, operand, conf_ts) in batch_merges:
+            batch.merge(tx_key(tx['txid']), operand)
+            for (key, value) in index_entries({**tx, 'conf': conf_ts}):
+                batch.put(key, value)
+        self.client.acquire('write')
+        try:
+            with ROCKS_SECONDS.time('write'):
+                self.client.db.write(batch)
+        except Exception as e:
+            self.logging.info('[rocks]: Failed to write batch')
+            self.logging.info(e)
+        finally:
+            self.client.lock.release()
+        with self.pending_lock:
+            for (txid, tx) in batch_txs.items():
+                if self.pending.get(txid) is tx:
+                    del self.pending[txid]
+        self.stats['written'] += len(batch_txs)
+        self.stats['merged'] += len(batch_merges)
+        self.stats['batches'] += 1
+        self.stats['lastflushseconds'] = time.time() - started_at
 
 
 class RocksDBClient():
-    def __init__(self, lock, logging):
+    def __init__(self, lock, logging, read_only=False):
         opts = rocksdb.Options()
         opts.create_if_missing = True
-        opts.max_open_files = 300000
-        opts.write_buffer_size = 67108864
-        opts.max_write_buffer_number = 3
-        opts.target_file_size_base = 67108864
+        opts.max_open_files = int(os.environ.get(
+            'ROCKS_MAX_OPEN_FILES', MAX_OPEN_FILES))
+        opts.write_buffer_size = int(os.environ.get(
+            'ROCKS_WRITE_BUFFER_MB', WRITE_BUFFER_MB)) * 1024 ** 2
+        opts.max_write_buffer_number = int(os.environ.get(
+            'ROCKS_MAX_WRITE_BUFFERS', MAX_WRITE_BUFFERS))
+        opts.target_file_size_base = int(os.environ.get(
+            'ROCKS_TARGET_FILE_MB', TARGET_FILE_MB)) * 1024 ** 2
         opts.merge_operator = MergeOp()
 
+        block_cache_compressed_mb = int(os.environ.get(
+            'ROCKS_BLOCK_CACHE_COMPRESSED_MB', BLOCK_CACHE_COMPRESSED_MB))
         opts.table_factory = rocksdb.BlockBasedTableFactory(
-            filter_policy=rocksdb.BloomFilterPolicy(10),
-            block_cache=rocksdb.LRUCache(2 * (1024 ** 3)),
-            block_cache_compressed=rocksdb.LRUCache(500 * (1024 ** 2)))
+            filter_policy=rocksdb.BloomFilterPolicy(
+                int(os.environ.get('ROCKS_BLOOM_BITS_PER_KEY', BLOOM_BITS_PER_KEY))),
+            block_cache=rocksdb.LRUCache(
+                int(os.environ.get('ROCKS_BLOCK_CACHE_MB', BLOCK_CACHE_MB)) * 1024 ** 2),
+            block_cache_compressed=rocksdb.LRUCache(block_cache_compressed_mb * 1024 ** 2) if block_cache_compressed_mb > 0 else None)
 
-        self.db = rocksdb.DB("test.db", opts)
+        # Read only instances can be opened alongside the collector, e.g. by exports
+        self.db = rocksdb.DB(os.environ.get('ROCKS_DB_PATH', DB_PATH),
+                             opts, read_only=read_only)
         self.lock = lock
         self.logging = logging
+        # Snapshots never change once written
+        self.snapshot_cache = OrderedDict()
+        # Every stored or queued txid, so lookups of unseen txs skip the db
+        # The filter only has to remember txids retention still keeps unconfirmed, so its
+        # window follows the unconfirmed TTL unless that's off
+        window_days = float(os.environ.get('TXID_FILTER_WINDOW_DAYS', os.environ.get(
+            'RETENTION_UNCONFIRMED_TTL_DAYS', DEFAULT_TXID_FILTER_WINDOW_DAYS))) or DEFAULT_TXID_FILTER_WINDOW_DAYS
+        self.txid_filter = RotatingTxidFilter(int(os.environ.get('TXID_FILTER_CAPACITY', DEFAULT_TXID_FILTER_CAPACITY)),
+                                              float(os.environ.get('TXID_FILTER_FP_RATE', DEFAULT_TXID_FILTER_FP_RATE)),
+                                              window_days,
+                                              int(os.environ.get('TXID_FILTER_GENERATIONS', DEFAULT_TXID_FILTER_GENERATIONS)))
+        # Until warm_txid_filter has run the filter can't rule anything out
+        self.txid_filter_warm = False
+        self.write_queue = WriteQueue(self, logging,
+                                      max_size=int(os.environ.get(
+                                          'ROCKS_WRITE_QUEUE_SIZE', WRITE_QUEUE_SIZE)),
+                                      batch_size=int(os.environ.get(
+                                          'ROCKS_WRITE_BATCH_SIZE', WRITE_BATCH_SIZE)),
+                                      flush_interval=float(os.environ.get('ROCKS_WRITE_FLUSH_INTERVAL', WRITE_FLUSH_INTERVAL)))
+        self.register_metrics()
 
-    def get_tx(self, txid):
-        tx = None
+    def acquire(self, op):
+        waited_at = time.perf_counter()
         self.lock.acquire()
+        ROCKS_LOCK_WAIT_SECONDS.observe(time.perf_counter() - waited_at, op)
+
+    def register_metrics(self):
+        registry.gauge('btc_etl_rocks_write_queue_depth', 'Ops waiting for the RocksDB writer',
+                       callback=self.write_queue.depth)
+        registry.gauge('btc_etl_rocks_write_queue', 'RocksDB write queue counters', ['stat'],
+                       lambda: {(name,): value for (name, value) in self.write_queue.get_stats().items()})
+        registry.gauge('btc_etl_txid_filter', 'Known txid filter counters and false positive rates', ['stat'],
+                       lambda: {(name,): value for (name, value) in self.txid_filter.stats().items()})
+        registry.gauge('btc_etl_snapshot_cache_size', 'Feature snapshots cached in memory',
+                       callback=lambda: len(self.snapshot_cache))
+
+    def start_writer(self):
+        self.write_queue.start()
+
+    def stop_writer(self):
+        self.write_queue.stop()
+        self.logging.info('[rocks]: Write queue flushed %s' %
+                          self.write_queue.get_stats())
+
+    def warm_txid_filter(self):
+        # Only txids that entered the mempool inside the filter's window, each into the
+        # generation of its mempooldate
+        started_at = time.time()
+        self.txid_filter.rotate(started_at)
+        prefix_length = len(TIME_INDEX_PREFIX)
+        for (key, conf) in self.iter_index(TIME_INDEX_PREFIX + struct.pack('>Q', max(int(started_at - self.txid_filter.window), 0)),
+                                           prefix_end(TIME_INDEX_PREFIX)):
+            self.txid_filter.add(key[prefix_length + 8:], struct.unpack_from('>Q', key, prefix_length)[0])
+        self.txid_filter_warm = True
+        self.logging.info('[rocks]: Loaded %d txids into filter in %.1fs %s' % (
+            self.txid_filter.size, time.time() - started_at, self.txid_filter.stats()))
+        if self.txid_filter.over_capacity():
+            self.logging.info(
+                '[rocks]: Txid filter is over capacity, raise TXID_FILTER_CAPACITY to keep its false positive rate')
+
+    def queue_mempool_tx(self, tx):
+        self.txid_filter.add(txid_to_key_bytes(tx['txid']), tx.get('mempooldate'))
+        self.write_queue.put(('put', tx['txid'], tx))
+
+    def queue_block_conf_times(self, confirmed, conf_ts):
+        # (tx, conf summary) pairs, txs being stored or queued records as returned by
+        # get_txs. Their mempooldate and feerate locate the index entries to update.
+        self.write_queue.put(('confs', confirmed, conf_ts))
+
+    def get_tx(self, txid):
+        # Returns the decoded tx record or None
+        tx = self.write_queue.get_pending(txid)
+        if tx != None:
+            return dict(tx)
+        if self.txid_filter_warm and not self.txid_filter.might_contain(txid_to_key_bytes(txid)):
+            return None
+        self.acquire('get')
         try:
-            tx = self.db.get(bytes(txid, encoding='utf-8'))
+            with ROCKS_SECONDS.time('get'):
+                data = self.db.get(tx_key(txid))
+            if data != None and not data.startswith(CONF_OPERAND_PREFIX):
+                tx = decode_tx(data, txid)
+            elif self.txid_filter_warm:
+                self.txid_filter.record_false_positive()
         except Exception as e:
             self.logging.info('[rocks]: Failed to get tx')
             self.logging.info(e)
@@ -56,53 +373,271 @@ class RocksDBClient():
             self.lock.release()
         return tx
 
-    def write_mempool_tx(self, tx):
-        self.lock.acquire()
+    def get_txs(self, txids):
+        # Returns txid -> decoded tx record for the txids that are known, with one multi_get
+        txs = {}
+        missing = []
+        for txid in txids:
+            tx = self.write_queue.get_pending(txid)
+            if tx != None:
+                txs[txid] = dict(tx)
+            elif not self.txid_filter_warm or self.txid_filter.might_contain(txid_to_key_bytes(txid)):
+                missing.append(txid)
+        if len(missing) == 0:
+            return txs
+        self.acquire('multiget')
         try:
-            self.db.put(
-                bytes(tx['txid'], encoding='utf-8'),
-                bytes(json.dumps(tx, cls=DecimalEncoder), encoding='utf-8'))
-        except Exception as e:
-            self.logging.info('[rocks]: Create mempool entry')
-            self.logging.info(e)
+            with ROCKS_SECONDS.time('multiget'):
+                found = self.db.multi_get([tx_key(txid) for txid in missing])
         finally:
             self.lock.release()
+        for (key, data) in found.items():
+            if data != None and not data.startswith(CONF_OPERAND_PREFIX):
+                txid = txid_from_key(key)
+                txs[txid] = decode_tx(data, txid)
+            elif self.txid_filter_warm:
+                self.txid_filter.record_false_positive()
+        return txs
 
-    def update_tx_conf_time(self, txid, conf_ts, conf_per_fee_rate):
-        self.lock.acquire()
+    def write_snapshot(self, snapshot_id, snapshot):
+        self.acquire('snapshot')
         try:
-            tx = json.loads(self.db.get(bytes(txid, encoding='utf-8')))
-            if tx == None or 'conf' in tx:
-                self.logging.info(
-                    '[rocks]: Tx not valid. Aborting addding conf time')
-                return
-            tx['conf'] = conf_ts
-            tx['confperfeerate'] = conf_per_fee_rate
-            self.db.put(
-                bytes(txid, encoding='utf-8'),
-                bytes(json.dumps(tx, cls=DecimalEncoder), encoding='utf-8'))
-        except Exception as e:
-            self.logging.info('[rocks]: Could not perform merge')
-            self.logging.info(e)
+            self.db.put(snapshot_key(snapshot_id), json.dumps(
+                snapshot, cls=DecimalEncoder).encode('utf-8'))
+        finally:
+            self.lock.release()
+
+    def get_last_snapshot_id(self):
+        it = self.db.iterkeys()
+        it.seek_for_prev(snapshot_key(2 ** 64 - 1))
+        key = next(it, None)
+        if key == None or not key.startswith(SNAPSHOT_KEY_PREFIX):
+            return None
+        return struct.unpack('>Q', key[len(SNAPSHOT_KEY_PREFIX):])[0]
+
+    def get_snapshot(self, snapshot_id):
+        snapshot = self.snapshot_cache.get(snapshot_id)
+        if snapshot != None:
+            self.snapshot_cache.move_to_end(snapshot_id)
+            return snapshot
+        data = self.db.get(snapshot_key(snapshot_id))
+        if data == None:
+            return None
+        snapshot = json.loads(data)
+        self.snapshot_cache[snapshot_id] = snapshot
+        if len(self.snapshot_cache) > SNAPSHOT_CACHE_SIZE:
+            self.snapshot_cache.popitem(last=False)
+        return snapshot
+
+    def iter_snapshots(self):
+        # (snapshot id, snapshot) in id order
+        it = self.db.iteritems()
+        it.seek(SNAPSHOT_KEY_PREFIX)
+        for (key, value) in it:
+            if not key.startswith(SNAPSHOT_KEY_PREFIX):
+                break
+            yield (struct.unpack('>Q', key[len(SNAPSHOT_KEY_PREFIX):])[0], json.loads(value))
+
+    def write_feature_point(self, ts, snapshot_id, refreshed_at):
+        self.acquire('featurepoint')
+        try:
+            self.db.put(feature_point_key(ts), _feature_point.pack(
+                snapshot_id, refreshed_at))
         finally:
             self.lock.release()
 
+    def iter_feature_points(self, start=None, end=None):
+        # (refresh time, snapshot id, stalest refresh time) in time order, start inclusive, end exclusive
+        it = self.db.iteritems()
+        it.seek(FEATURE_POINT_PREFIX if start == None else feature_point_key(start))
+        stop_key = prefix_end(FEATURE_POINT_PREFIX) if end == None else feature_point_key(end)
+        for (key, value) in it:
+            if key >= stop_key:
+                break
+            (snapshot_id, refreshed_at) = _feature_point.unpack(value)
+            yield (struct.unpack('>Q', key[len(FEATURE_POINT_PREFIX):])[0] / 1000000, snapshot_id, refreshed_at)
+
+    def get_feature_point_as_of(self, ts):
+        # Latest feature point at or before ts, None before the first one
+        it = self.db.iteritems()
+        it.seek_for_prev(feature_point_key(ts))
+        item = next(it, None)
+        if item == None or not item[0].startswith(FEATURE_POINT_PREFIX):
+            return None
+        (snapshot_id, refreshed_at) = _feature_point.unpack(item[1])
+        return (struct.unpack('>Q', item[0][len(FEATURE_POINT_PREFIX):])[0] / 1000000, snapshot_id, refreshed_at)
+
+    def join_features(self, tx):
+        # Rebuild the full feature row of a tx record that references a snapshot
+        if tx == None or 'snapshotid' not in tx:
+            return tx
+        snapshot = self.get_snapshot(tx['snapshotid'])
+        if snapshot == None:
+            return tx
+        return {**snapshot['features'], **tx}
+
+    def get_tx_with_features(self, txid):
+        return self.join_features(self.get_tx(txid))
+
+    def migrate_legacy_records(self):
+        # Rewrite JSON records keyed by hex txid into the binary format, a no-op once done
+        migrated = 0
+        while True:
+            it = self.db.iteritems()
+            it.seek(LEGACY_KEY_RANGE[0])
+            batch = rocksdb.WriteBatch()
+            count = 0
+            for (key, data) in it:
+                if key >= LEGACY_KEY_RANGE[1] or count == MIGRATION_BATCH_SIZE:
+                    break
+                txid = key.decode('utf-8')
+                batch.put(tx_key(txid), encode_tx(decode_tx(data, txid)))
+                batch.delete(key)
+                count += 1
+            if count == 0:
+                break
+            self.acquire('migrate')
+            try:
+                with ROCKS_SECONDS.time('migrate'):
+                    self.db.write(batch)
+            finally:
+                self.lock.release()
+            migrated += count
+        if migrated > 0:
+            self.logging.info(
+                '[rocks]: Migrated %d legacy JSON records' % migrated)
+        return migrated
+
+    def build_indexes(self):
+        # Index records stored before the indexes existed, a no-op once done
+        if self.db.get(INDEXES_BUILT_KEY) != None:
+            return 0
+        indexed = 0
+        batch = rocksdb.WriteBatch()
+        for tx in self.iter_txs():
+            for (key, value) in index_entries(tx):
+                batch.put(key, value)
+            indexed += 1
+            if indexed % MIGRATION_BATCH_SIZE == 0:
+                self.write_batch(batch)
+                batch = rocksdb.WriteBatch()
+        batch.put(INDEXES_BUILT_KEY, b'1')
+        self.write_batch(batch)
+        self.logging.info('[rocks]: Indexed %d tx records' % indexed)
+        return indexed
+
+    def delete_txs(self, txs, index_keys=()):
+        # Removes tx records with their index entries, plus any index keys given whose
+        # record is already gone
+        batch = rocksdb.WriteBatch()
+        for tx in txs:
+            batch.delete(tx_key(tx['txid']))
+            for (key, value) in index_entries(tx):
+                batch.delete(key)
+        for key in index_keys:
+            batch.delete(key)
+        self.acquire('delete')
+        try:
+            with ROCKS_SECONDS.time('delete'):
+                self.db.write(batch)
+        finally:
+            self.lock.release()
+
+    def compact(self, prefixes=(TX_KEY_PREFIX, TIME_INDEX_PREFIX, FEERATE_INDEX_PREFIX)):
+        # Range compaction of each key namespace, drops the tombstones deletes leave behind
+        for prefix in prefixes:
+            with ROCKS_SECONDS.time('compact'):
+                self.db.compact_range(begin=prefix, end=prefix_end(prefix))
+
+    def write_batch(self, batch):
+        self.acquire('batch')
+        try:
+            with ROCKS_SECONDS.time('batch'):
+                self.db.write(batch)
+        finally:
+            self.lock.release()
+
+    def iter_index(self, start_key, stop_key, confirmed=None):
+        # Yields (key, conf) of index entries in [start_key, stop_key), conf is 0 while
+        # unconfirmed. confirmed filters on it when not None.
+        it = self.db.iteritems()
+        it.seek(start_key)
+        for (key, value) in it:
+            if key >= stop_key:
+                break
+            conf = struct.unpack('>Q', value)[0]
+            if confirmed == None or confirmed == (conf != 0):
+                yield (key, conf)
+
+    def iter_txids_by_mempool_date(self, start, end, confirmed=None):
+        # Yields (txid, mempooldate, conf) of txs entering the mempool in [start, end)
+        prefix_length = len(TIME_INDEX_PREFIX)
+        for (key, conf) in self.iter_index(TIME_INDEX_PREFIX + struct.pack('>Q', max(int(start), 0)),
+                                           TIME_INDEX_PREFIX + struct.pack('>Q', max(int(end), 0)), confirmed):
+            yield (key_bytes_to_txid(key[prefix_length + 8:]),
+                   struct.unpack_from('>Q', key, prefix_length)[0], conf)
+
+    def iter_txids_by_feerate(self, low, high, confirmed=None):
+        # Yields (txid, sat/vB bucket, mempooldate, conf) of txs whose floor(fee / vsize)
+        # is within [low, high] sat/vB
+        prefix_length = len(FEERATE_INDEX_PREFIX)
+        high = feerate_bucket(high)
+        stop_key = FEERATE_INDEX_PREFIX + \
+            struct.pack('>I', high + 1) if high < 2 ** 32 - 1 else prefix_end(FEERATE_INDEX_PREFIX)
+        for (key, conf) in self.iter_index(FEERATE_INDEX_PREFIX + struct.pack('>I', feerate_bucket(low)),
+                                           stop_key, confirmed):
+            bucket, mempool_date = struct.unpack_from('>IQ', key, prefix_length)
+            yield (key_bytes_to_txid(key[prefix_length + 12:]), bucket, mempool_date, conf)
+
+    def get_txs_by_mempool_date(self, start, end, confirmed=None, with_features=False):
+        return self.fetch_indexed_txs(self.iter_txids_by_mempool_date(start, end, confirmed), with_features)
+
+    def get_txs_by_feerate(self, low, high, confirmed=None, with_features=False):
+        return self.fetch_indexed_txs(self.iter_txids_by_feerate(low, high, confirmed), with_features)
+
+    def fetch_indexed_txs(self, entries, with_features=False):
+        # Resolves index entries to records, MIGRATION_BATCH_SIZE multi_gets at a time
+        txids = []
+        for entry in entries:
+            txids.append(entry[0])
+            if len(txids) == MIGRATION_BATCH_SIZE:
+                yield from self.fetch_txs(txids, with_features)
+                txids = []
+        yield from self.fetch_txs(txids, with_features)
+
+    def fetch_txs(self, txids, with_features=False):
+        txs = self.get_txs(txids)
+        for txid in txids:
+            if txid in txs:
+                yield self.join_features(txs[txid]) if with_features else txs[txid]
+
+    def iter_txs(self, with_features=False):
+        return self.iter_tx_range(TX_KEY_PREFIX, prefix_end(TX_KEY_PREFIX), with_features)
+
+    def iter_tx_range(self, start_key, stop_key, with_features=False, snapshot=None):
+        # Decoded records with keys in [start_key, stop_key), read from snapshot if given
+        it = self.db.iteritems(snapshot=snapshot)
+        it.seek(start_key)
+        for (key, data) in it:
+            if key >= stop_key:
+                break
+            if data.startswith(CONF_OPERAND_PREFIX):
+                continue
+            tx = decode_tx(data, txid_from_key(key))
+            yield self.join_features(tx) if with_features else tx
+
     # TODO DELETE THESE DEBUGGIN FUNCTIONS
 
     def print_all_keys(self):
-        it = self.db.iterkeys()
-        it.seek_to_first()
-        txs = list(it)
-        print(self.db.get(txs[0]))
-        # print(  txs)
+        print(next(self.iter_txs(), None))
 
     def get_all_conf_keys(self):
-        it = self.db.iterkeys()
-        it.seek_to_first()
-        txs = list(it)
-        print(len(txs))
-        # for txid in txs:
-        #     tx = json.loads(self.db.get(txid))
-        #     if('conf' in tx):
-        #         print(tx)
-        print(len(list(filter(lambda txid: 'conf' in json.loads(self.db.get(txid)), txs))))
+        # Index values alone say whether a tx confirmed, no records are decoded
+        total = 0
+        confirmed = 0
+        for (key, conf) in self.iter_index(TIME_INDEX_PREFIX, prefix_end(TIME_INDEX_PREFIX)):
+            total += 1
+            if conf != 0:
+                confirmed += 1
+        print(total)
+        print(confirmed)
@@ -1,39 +1,140 @@
 # Collect statistcal information from a starting block, traversing to gensis block
 
-import json
+import argparse
+import logging
 import os
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from mempoolState import BlockStatsService
+from blockStatsStore import NDJSONWriter, write_columnar_chunk, COLUMNAR_FILE_PATTERN
+from blockStatsHistory import BlockStatsHistory, ROLLING_FEATURE_COLUMNS, ROLLING_WINDOWS
+from batchRpc import BatchRPCClient, DEFAULT_BATCH_SIZE, rpc_url_from_environ
 from bitcoinrpc.authproxy import AuthServiceProxy, JSONRPCException
 
+BACKFILL_DIR = 'block_stats'
+BACKFILL_CHUNK_SIZE = 1000
+BACKFILL_WORKERS = 4
+DUMP_FILE = 'block_stats_dump.ndjson'
+FEATURES_FILE = 'block_features.col'
+
 
 class BlockStatsCollector():
-    def __init__(self):
-        if ('RPC_USER' not in os.environ
-            or 'RPC_PASSWORD' not in os.environ
-            or 'RPC_HOST' not in os.environ
-                or 'RPC_PORT' not in os.environ):
-            raise Exception(
-                'Need to specify RPC_USER and RPC_PASSWORD, RPC_HOST, RPC_PORT environs')
-
-        self.rpc_connection = AuthServiceProxy("http://%s:%s@%s:%s"
-                                               % (os.environ['RPC_USER'], os.environ['RPC_PASSWORD'],  os.environ['RPC_HOST'], os.environ['RPC_PORT']))
-        self.blocks = []
+    def __init__(self, output_dir=BACKFILL_DIR):
+        # Raises if the RPC environs are missing
+        self.rpc_connection = AuthServiceProxy(rpc_url_from_environ())
         self.blockStatsService = BlockStatsService(self.rpc_connection)
-
-    def save(self):
-        with open('block_stats_dump.json', 'w') as outfile:
-            outfile.write(json.dumps(self.blocks))
+        self.output_dir = output_dir
+        # One RPC connection per backfill worker thread
+        self.worker_state = threading.local()
 
     def start(self, start_height, stop_height=0):
+        # Stream each block to disk as it arrives instead of holding the whole range in memory
+        writer = NDJSONWriter(DUMP_FILE)
         height = start_height
-        while True:
-            self.blocks.append(self.blockStatsService.update(
-                block_height=height))
-            height -= 1
-            if (height == stop_height):
-                break
-        self.save()
+        try:
+            while True:
+                writer.write(self.blockStatsService.update(
+                    block_height=height))
+                height -= 1
+                if (height == stop_height):
+                    break
+        finally:
+            writer.close()
+
+    def completed_heights(self):
+        # Every chunk file on disk is a checkpoint for the heights it covers
+        completed = set()
+        if not os.path.isdir(self.output_dir):
+            return completed
+        for name in os.listdir(self.output_dir):
+            match = COLUMNAR_FILE_PATTERN.match(name)
+            if match:
+                completed.update(
+                    range(int(match.group(1)), int(match.group(2)) + 1))
+        return completed
+
+    def worker_rpc(self):
+        if not hasattr(self.worker_state, 'rpc'):
+            self.worker_state.rpc = BatchRPCClient(
+                rpc_url_from_environ(), batch_size=self.batch_size, pool_size=1)
+        return self.worker_state.rpc
+
+    def collect_chunk(self, heights):
+        results = self.worker_rpc().get_block_stats(heights)
+        failed = [height for (height, stats) in zip(
+            heights, results) if isinstance(stats, JSONRPCException)]
+        if len(failed) > 0:
+            raise Exception('Failed to get block stats for %d heights in %d-%d, first error at %d: %s' % (
+                len(failed), heights[0], heights[-1], failed[0], results[heights.index(failed[0])]))
+        self.write_chunk(heights, results)
+        return len(heights)
+
+    def write_chunk(self, heights, results):
+        write_columnar_chunk(os.path.join(
+            self.output_dir, 'blocks_%d_%d.col' % (heights[0], heights[-1])), results)
+
+    def backfill(self, start_height, stop_height=0, workers=BACKFILL_WORKERS, chunk_size=BACKFILL_CHUNK_SIZE, batch_size=DEFAULT_BATCH_SIZE):
+        # Same range as start(): from start_height down to, but excluding, stop_height
+        self.batch_size = batch_size
+        os.makedirs(self.output_dir, exist_ok=True)
+        completed = self.completed_heights()
+        pending = [height for height in range(
+            stop_height + 1, start_height + 1) if height not in completed]
+        logging.info('[Block Collector]: %d heights pending, %d already checkpointed' % (
+            len(pending), start_height - stop_height - len(pending)))
+
+        # Chunks are aligned to multiples of chunk_size so reruns produce the same files
+        chunks = {}
+        for height in pending:
+            chunks.setdefault(height // chunk_size, []).append(height)
+
+        started_at = time.time()
+        done = 0
+        failures = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.collect_chunk, chunks[key])
+                       for key in sorted(chunks, reverse=True)]
+            for future in as_completed(futures):
+                try:
+                    done += future.result()
+                except Exception as e:
+                    failures += 1
+                    logging.info('[Block Collector]: %s' % e)
+                    continue
+                elapsed = time.time() - started_at
+                rate = done / elapsed if elapsed > 0 else 0
+                remaining = (len(pending) - done) / rate if rate > 0 else 0
+                logging.info('[Block Collector]: %d/%d blocks, %.1f blocks/sec, %ds remaining' % (
+                    done, len(pending), rate, remaining))
+
+        if failures > 0:
+            logging.info(
+                '[Block Collector]: %d chunks failed, rerun to resume' % failures)
+        return failures == 0
+
+
+def write_rolling_features(directory):
+    # Rolling means over the whole backfilled history, same engine the live collector uses
+    history = BlockStatsHistory()
+    history.load(directory)
+    if len(history) == 0:
+        logging.info('[Block Collector]: No block stats in %s' % directory)
+        return
+    columns = [('height', 'q')]
+    series = {}
+    for name in ROLLING_FEATURE_COLUMNS:
+        for window in ROLLING_WINDOWS:
+            feature = '%s_mean_%d' % (name, window)
+            columns.append((feature, 'd'))
+            series[feature] = history.rolling_means(name, window)
+    rows = [{**{feature: values[index] for (feature, values) in series.items()}, 'height': history.base_height + index}
+            for index in range(len(history))]
+    write_columnar_chunk(os.path.join(directory, FEATURES_FILE),
+                         rows, columns, lambda row: row)
+    logging.info('[Block Collector]: Wrote %d features for heights %d-%d' % (
+        len(series), history.base_height, history.tip()))
 
 
 if __name__ == "__main__":
@@ -41,5 +142,33 @@ if __name__ == "__main__":
         print("Only works with Python 3.5 and greater")
         sys.exit(1)
 
-    blockCollector = BlockStatsCollector()
-    blockCollector.start(start_height=727_609, stop_height=717_609)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--start-height', type=int, default=727_609)
+    parser.add_argument('--stop-height', type=int, default=717_609)
+    parser.add_argument('--backfill', action='store_true',
+                        help='Fetch the range in parallel, checkpointing each chunk so reruns resume')
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS)
+    parser.add_argument('--chunk-size', type=int, default=BACKFILL_CHUNK_SIZE)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--output-dir', default=BACKFILL_DIR)
+    parser.add_argument('--features', action='store_true',
+                        help='Write rolling block stats features over the backfilled history to %s' % FEATURES_FILE)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, format='%(relativeCreated)6d %(threadName)s %(message)s')
+
+    if args.features and not args.backfill:
+        write_rolling_features(args.output_dir)
+        sys.exit(0)
+
+    blockCollector = BlockStatsCollector(output_dir=args.output_dir)
+    if args.backfill:
+        if not blockCollector.backfill(args.start_height, args.stop_height, workers=args.workers,
+                                       chunk_size=args.chunk_size, batch_size=args.batch_size):
+            sys.exit(1)
+        if args.features:
+            write_rolling_features(args.output_dir)
+    else:
+        blockCollector.start(start_height=args.start_height,
+                             stop_height=args.stop_height)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# Export every tx record with its features to columnar training files
+
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from txExport import export_range, key_ranges, EXPORT_DIR, EXPORT_ROWS_PER_FILE, EXPORT_FILE_PATTERN
+
+EXPORT_WORKERS = 4
+EXPORT_SHARDS = 16
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output-dir', default=EXPORT_DIR)
+    parser.add_argument('--workers', type=int, default=EXPORT_WORKERS)
+    parser.add_argument('--shards', type=int, default=EXPORT_SHARDS,
+                        help='Key ranges the tx keyspace is split into, at most 256')
+    parser.add_argument('--rows-per-file', type=int,
+                        default=EXPORT_ROWS_PER_FILE)
+    parser.add_argument('--confirmed-only', action='store_true',
+                        help='Skip txs without a conf time')
+    parser.add_argument('--as-of-features', action='store_true',
+                        help='Rebuild each tx\'s features as of its mempooldate from the feature series')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, format='%(relativeCreated)6d %(processName)s %(message)s')
+    if not 1 <= args.shards <= 256:
+        print('--shards must be between 1 and 256')
+        sys.exit(1)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    stale = [name for name in os.listdir(
+        args.output_dir) if EXPORT_FILE_PATTERN.match(name)]
+    if len(stale) > 0:
+        print('%s already holds %d export files, remove them or pick another --output-dir' %
+              (args.output_dir, len(stale)))
+        sys.exit(1)
+
+    started_at = time.time()
+    exported = 0
+    files = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(export_range, shard, start_key, stop_key, args.output_dir,
+                                   args.rows_per_file, args.confirmed_only, args.as_of_features)
+                   for (shard, (start_key, stop_key)) in enumerate(key_ranges(args.shards))]
+        for future in as_completed(futures):
+            shard_exported, shard_files = future.result()
+            exported += shard_exported
+            files += shard_files
+            elapsed = time.time() - started_at
+            logging.info('[Export]: %d txs in %d files, %.0f txs/sec' %
+                         (exported, files, exported / elapsed if elapsed > 0 else 0))
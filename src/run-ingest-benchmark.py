@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# Benchmark the full ingest pipeline (decode -> fees -> persist -> RocksDB) offline by
+# replaying a ZMQ capture against a stub RPC server answering from its fixture
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zmq
+from blockStatsHistory import BlockStatsHistory
+from mempoolModel import MempoolModel
+from mempoolState import ConfTimePerFeeRate
+from rocksclient import RocksDBClient
+from tipFollower import TipFollower
+from zeroMQ import ZMQHandler
+from batchRpc import BatchRPCClient, InstrumentedRPC, rpc_url_from_environ
+from zmqCapture import read_fixture, start_stub_rpc_server, replay
+
+
+class OfflineMempoolState():
+    # What ZMQHandler reads from MempoolState, without the external feature sources
+    def __init__(self, rpc_connection, batch_rpc, features):
+        self.mempool_model = MempoolModel()
+        self.conf_time_per_fee_rate_service = ConfTimePerFeeRate()
+        self.tip_follower = TipFollower(
+            rpc_connection, batch_rpc, BlockStatsHistory(), logging)
+        self.snapshot_id = None
+        self.features = features
+
+    def get_features(self):
+        return dict(self.features)
+
+    def get_feature_age(self, now):
+        return 0
+
+
+def percentile(sorted_values, q):
+    if len(sorted_values) == 0:
+        return 0
+    return sorted_values[min(int(len(sorted_values) * q / 100), len(sorted_values) - 1)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('capture', help='File recorded with ZMQ_CAPTURE_FILE')
+    parser.add_argument('--fixture', required=True,
+                        help='Built with run-zmq-replay.py --build-fixture')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='Multiple of the recorded rate, 0 replays as fast as possible')
+    parser.add_argument('--zmq-port', type=int, default=28399)
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='Seconds to wait for the pipeline to drain')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='Sharded ingest worker processes, 0 runs the in process pipeline')
+    parser.add_argument('--scaling', metavar='COUNTS',
+                        help='Comma separated worker process counts to run one after another, e.g. 0,1,2,4,8')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as one JSON object')
+    args = parser.parse_args()
+
+    if args.scaling:
+        # Each count runs in a fresh interpreter with a fresh db
+        print('%9s %10s %10s %8s %8s %8s' %
+              ('processes', 'tx/s', 'rawtx/s', 'p50 ms', 'p99 ms', 'max ms'))
+        baseline = None
+        for processes in [int(count) for count in args.scaling.split(',')]:
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), args.capture, '--fixture', args.fixture,
+                                     '--speed', str(args.speed), '--zmq-port', str(args.zmq_port), '--timeout', str(args.timeout),
+                                     '--processes', str(processes), '--json'], capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            baseline = baseline or result['txpersecond']
+            print('%9d %10.1f %10.1f %8.1f %8.1f %8.1f  %.2fx' % (processes, result['txpersecond'], result['rawtxpersecond'],
+                                                               result['p50'] * 1000, result['p99'] * 1000, result['max'] * 1000,
+                                                               result['txpersecond'] / baseline))
+        sys.exit(0)
+
+    logging.basicConfig(
+        level=logging.WARNING, format='%(relativeCreated)6d %(threadName)s %(message)s')
+    capture_path = os.path.abspath(args.capture)
+    fixture = read_fixture(args.fixture)
+    server = start_stub_rpc_server(fixture)
+    os.environ.update({'RPC_USER': 'bench', 'RPC_PASSWORD': 'bench', 'RPC_HOST': '127.0.0.1',
+                       'RPC_PORT': str(server.server_address[1]),
+                       'ZMQ_HOST': '127.0.0.1', 'ZMQ_PORT': str(args.zmq_port),
+                       'METRICS_PORT': '0', 'ZMQ_INGEST_PROCESSES': str(args.processes)})
+    os.environ.pop('ZMQ_CAPTURE_FILE', None)
+
+    class BenchmarkZMQHandler(ZMQHandler):
+        # Counts items leaving each stage and times every tx from arrival to its write being queued
+        def __init__(self, *args):
+            self.decoded = 0
+            self.built = 0
+            self.received_at = {}
+            self.latencies = []
+            ZMQHandler.__init__(self, *args)
+
+        def decode_tx(self, item):
+            result = ZMQHandler.decode_tx(self, item)
+            if result != None:
+                self.decoded += 1
+            return result
+
+        def build_tx(self, serialized_tx, received_at=None):
+            txid = serialized_tx['txid']
+            tx = ZMQHandler.build_tx(self, serialized_tx, received_at)
+            if tx != None:
+                self.received_at[txid] = received_at
+                self.built += 1
+            return tx
+
+        def admit_tx(self, item):
+            tx = ZMQHandler.admit_tx(self, item)
+            if tx != None:
+                self.received_at[tx['txid']] = item[1]
+                self.built += 1
+            return tx
+
+        def persist_tx(self, tx):
+            ZMQHandler.persist_tx(self, tx)
+            self.latencies.append(
+                time.time() - self.received_at.pop(tx['txid']))
+
+        def drained(self, rawtxs, blocks):
+            if self.sharded_ingest != None:
+                return (self.sharded_ingest.processed >= rawtxs
+                        and self.admit_stage.processed + self.admit_stage.errors >= self.sharded_ingest.built
+                        and self.persist_stage.processed + self.persist_stage.errors >= self.built
+                        and self.block_stage.processed + self.block_stage.errors >= blocks)
+            return (self.decode_stage.processed + self.decode_stage.errors >= rawtxs
+                    and self.fee_stage.processed + self.fee_stage.errors >= self.decoded
+                    and self.persist_stage.processed + self.persist_stage.errors >= self.built
+                    and self.block_stage.processed + self.block_stage.errors >= blocks)
+
+    db_dir = tempfile.mkdtemp(prefix='ingest-benchmark-')
+    os.environ['ROCKS_DB_PATH'] = os.path.join(db_dir, 'bench.db')
+    rocks = RocksDBClient(threading.Lock(), logging)
+    rocks.warm_txid_filter()
+    rocks.start_writer()
+    mempool_state = OfflineMempoolState(InstrumentedRPC(rpc_url_from_environ()),
+                                        BatchRPCClient(rpc_url_from_environ()), fixture.get('features', {}))
+    handler = BenchmarkZMQHandler(logging, rocks, mempool_state)
+    threading.Thread(target=handler.start, daemon=True).start()
+
+    context = zmq.Context()
+    socket = context.socket(zmq.PUB)
+    socket.setsockopt(zmq.SNDHWM, 0)
+    socket.bind('tcp://127.0.0.1:%d' % args.zmq_port)
+    # PUB drops messages until the handler's subscription arrives
+    time.sleep(1)
+    started_at = time.time()
+    sent = replay(capture_path, socket, args.speed)
+    rawtxs = sent.get(b'rawtx', 0)
+    blocks = sent.get(b'rawblock', 0)
+    while not handler.drained(rawtxs, blocks):
+        if time.time() - started_at > args.timeout:
+            print('Timed out, pipeline %s' % handler.pipeline_stats())
+            sys.exit(1)
+        time.sleep(0.01)
+    elapsed = time.time() - started_at
+    flush_started_at = time.time()
+    rocks.stop_writer()
+    flush_elapsed = time.time() - flush_started_at
+    if handler.sharded_ingest != None:
+        handler.sharded_ingest.stop()
+
+    latencies = sorted(handler.latencies)
+    if args.json:
+        print(json.dumps({'processes': args.processes, 'rawtx': rawtxs, 'rawblock': blocks, 'ingested': len(latencies),
+                          'seconds': elapsed, 'txpersecond': len(latencies) / elapsed, 'rawtxpersecond': rawtxs / elapsed,
+                          'flushseconds': flush_elapsed, **{name: percentile(latencies, q) for (name, q) in [('p50', 50), ('p90', 90), ('p99', 99), ('max', 100)]}}))
+        sys.exit(0)
+    print('Replayed %d rawtx and %d rawblock messages at speed %s' %
+          (rawtxs, blocks, args.speed or 'max'))
+    print('%d new txs ingested in %.2fs, %.1f tx/s (%.1f rawtx/s), writer drained in %.2fs' % (
+        len(latencies), elapsed, len(latencies) / elapsed, rawtxs / elapsed, flush_elapsed))
+    print('Per tx latency p50 %.1fms p90 %.1fms p99 %.1fms max %.1fms' % tuple(
+        percentile(latencies, q) * 1000 for q in [50, 90, 99, 100]))
+    print('Stub RPC calls %d, pipeline %s' %
+          (server.stub.calls, handler.pipeline_stats()))
@@ -1,14 +1,22 @@
 #!/usr/bin/env python3
+import os
 import sys
 from zeroMQ import ZMQHandler
 import threading
 from rocksclient import RocksDBClient
-from mempoolState import MempoolState
+from mempoolState import MempoolState, STARTUP_MODE
+from metrics import registry, start_metrics_server, METRICS_HOST, METRICS_PORT
+from retention import RetentionService
 
 import logging
-import binascii
+import signal
+import time
+
+STARTUP_SECONDS = registry.gauge(
+    'btc_etl_startup_seconds', 'Seconds from process start until each startup phase finished', ['phase'])
 
 if __name__ == "__main__":
+    started_at = time.time()
     if (sys.version_info.major, sys.version_info.minor) < (3, 5):
         print("Only works with Python 3.5 and greater")
         sys.exit(1)
@@ -16,16 +24,50 @@ if __name__ == "__main__":
     thread_pool = []
     logging.basicConfig(
         level=logging.INFO, format='%(relativeCreated)6d %(threadName)s %(message)s')
+    metrics_port = int(os.environ.get('METRICS_PORT', METRICS_PORT))
+    if metrics_port != 0:
+        start_metrics_server(os.environ.get(
+            'METRICS_HOST', METRICS_HOST), metrics_port)
+        logging.info('Serving metrics on port %d' % metrics_port)
+    fast_start = os.environ.get('STARTUP_MODE', STARTUP_MODE) == 'fast'
     lock = threading.Lock()
     rocks = RocksDBClient(lock, logging)
+    rocks.migrate_legacy_records()
+    rocks.build_indexes()
+    if fast_start:
+        # Lookups go to the db until the filter is loaded
+        thread_pool.append(threading.Thread(
+            target=rocks.warm_txid_filter, name='FilterWarmer', daemon=True))
+    else:
+        rocks.warm_txid_filter()
+    rocks.start_writer()
+    retention = RetentionService.from_environ(rocks, logging)
+    retention.start()
+    STARTUP_SECONDS.set(time.time() - started_at, 'db')
 
-    mempoolState = MempoolState(logging)
-    zeroMQ = ZMQHandler(logging, rocks, mempoolState)
-    # Set up threads
-    thread_pool.append(threading.Thread(target=mempoolState.start))
-    thread_pool.append(threading.Thread(target=zeroMQ.start))
+    mempoolState = MempoolState(logging, rocks)
+    STARTUP_SECONDS.set(time.time() - started_at, 'mempoolstate')
+    zeroMQ = ZMQHandler(logging, rocks, mempoolState, started_at)
+    # Set up threads, daemonized so an interrupt only has to flush pending writes
+    thread_pool.append(threading.Thread(
+        target=mempoolState.start, daemon=True))
+    thread_pool.append(threading.Thread(target=zeroMQ.start, daemon=True))
     for t in thread_pool:
         t.start()
+    STARTUP_SECONDS.set(time.time() - started_at, 'ready')
+    logging.info('Started in %.2fs (%s startup)' %
+                 (time.time() - started_at, 'fast' if fast_start else 'full'))
+    # Treat SIGTERM like an interrupt so queued writes are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-    for index, t in enumerate(thread_pool):
-        t.join()
+    try:
+        for index, t in enumerate(thread_pool):
+            t.join()
+    except KeyboardInterrupt:
+        logging.info('Shutting down')
+    finally:
+        retention.stop()
+        # Waits for the handler to stop receiving before its capture is closed and
+        # before the writer's last flush
+        zeroMQ.stop()
+        rocks.stop_writer()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# Benchmark the in process tx parser against bitcoind's decoderawtransaction
+
+import argparse
+import binascii
+import os
+import sys
+import time
+from batchRpc import BatchRPCClient, rpc_url_from_environ
+from bitcoinrpc.authproxy import AuthServiceProxy, JSONRPCException
+from txParser import parse_tx, output_value_sats
+
+COMPARED_FIELDS = ['txid', 'hash', 'size', 'vsize', 'weight', 'locktime']
+
+
+def load_mempool_txs(count):
+    rpc = BatchRPCClient(rpc_url_from_environ())
+    txids = rpc.call('getrawmempool')[:count]
+    return [bytes.fromhex(raw) for raw in rpc.get_transactions(txids, verbose=False)
+            if not isinstance(raw, JSONRPCException)]
+
+
+def load_hex_file(path):
+    with open(path) as infile:
+        return [bytes.fromhex(line.strip()) for line in infile if line.strip()]
+
+
+def bench(name, fn, raw_txs, rounds):
+    started_at = time.perf_counter()
+    for round in range(rounds):
+        for raw in raw_txs:
+            fn(raw)
+    elapsed = time.perf_counter() - started_at
+    count = len(raw_txs) * rounds
+    print('%-24s %8d txs %10.1f tx/s %8.1f us/tx' %
+          (name, count, count / elapsed, elapsed / count * 1e6))
+
+
+def compare(rpc_connection, raw_txs):
+    mismatches = 0
+    for raw in raw_txs:
+        expected = rpc_connection.decoderawtransaction(
+            binascii.hexlify(raw).decode('utf-8'))
+        parsed = parse_tx(raw)
+        same = all(expected[field] == parsed[field] for field in COMPARED_FIELDS) \
+            and [output_value_sats(vout) for vout in expected['vout']] == [vout['valuesat'] for vout in parsed['vout']] \
+            and [(vin.get('txid'), vin.get('vout')) for vin in expected['vin']] == [(vin.get('txid'), vin.get('vout')) for vin in parsed['vin']]
+        if not same:
+            mismatches += 1
+            print('Mismatch for %s' % expected['txid'])
+    print('%d/%d parsed txs match decoderawtransaction' %
+          (len(raw_txs) - mismatches, len(raw_txs)))
+    return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=1000,
+                        help='Number of mempool txs to benchmark with')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--hex-file',
+                        help='Raw tx hex fixture, one per line. Only the parser is benchmarked without RPC environs')
+    args = parser.parse_args()
+
+    has_rpc = all(name in os.environ for name in [
+                  'RPC_USER', 'RPC_PASSWORD', 'RPC_HOST', 'RPC_PORT'])
+    raw_txs = load_hex_file(
+        args.hex_file) if args.hex_file else load_mempool_txs(args.count)
+    if len(raw_txs) == 0:
+        print('No transactions to benchmark')
+        sys.exit(1)
+
+    bench('txParser.parse_tx', parse_tx, raw_txs, args.rounds)
+    if has_rpc:
+        rpc_connection = AuthServiceProxy(rpc_url_from_environ())
+        bench('decoderawtransaction', lambda raw: rpc_connection.decoderawtransaction(
+            binascii.hexlify(raw).decode('utf-8')), raw_txs, 1)
+        if compare(rpc_connection, raw_txs) > 0:
+            sys.exit(1)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# Replay a ZMQ capture (ZMQ_CAPTURE_FILE) on a local PUB socket, optionally serving
+# the node RPCs the collector makes from a fixture so no node is needed
+
+import argparse
+import sys
+import time
+import zmq
+from batchRpc import BatchRPCClient, rpc_url_from_environ
+from zmqCapture import build_fixture, write_fixture, read_fixture, start_stub_rpc_server, replay
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('capture', help='File recorded with ZMQ_CAPTURE_FILE')
+    parser.add_argument('--bind', default='tcp://127.0.0.1:28332',
+                        help='Address the PUB socket binds, point ZMQ_HOST/ZMQ_PORT at it')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Multiple of the recorded rate, 0 replays as fast as possible')
+    parser.add_argument('--build-fixture', metavar='PATH',
+                        help='Fetch the txs, prevouts and blocks the capture needs from the node (RPC_* environs) into PATH and exit')
+    parser.add_argument('--fixture', help='Fixture to answer RPCs from')
+    parser.add_argument('--rpc-port', type=int, default=18332,
+                        help='Port of the stub RPC server when --fixture is given')
+    args = parser.parse_args()
+
+    if args.build_fixture:
+        batch_rpc = BatchRPCClient(rpc_url_from_environ())
+        fixture = build_fixture(args.capture, batch_rpc)
+        write_fixture(args.build_fixture, fixture)
+        print('Wrote %d txs and %d blocks to %s' % (len(fixture['transactions']), len(
+            fixture['blockheaders']), args.build_fixture))
+        sys.exit(0)
+
+    if args.fixture:
+        server = start_stub_rpc_server(
+            read_fixture(args.fixture), port=args.rpc_port)
+        print('Serving stub RPC on port %d' % server.server_address[1])
+
+    context = zmq.Context()
+    socket = context.socket(zmq.PUB)
+    socket.setsockopt(zmq.SNDHWM, 0)
+    socket.bind(args.bind)
+    # Give subscribers time to connect, PUB drops messages nobody is subscribed to yet
+    time.sleep(1)
+    started_at = time.time()
+    sent = replay(args.capture, socket, args.speed)
+    elapsed = time.time() - started_at
+    print('Replayed %s in %.1fs' % (', '.join('%d %s' % (count, topic.decode())
+          for (topic, count) in sent.items()), elapsed))
+    # Lets the last messages leave before the socket closes
+    socket.close(linger=5000)
+    context.term()
+    if args.fixture:
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,254 @@
+import json
+import logging
+import multiprocessing
+import queue
+import struct
+import time
+import zlib
+from collections import OrderedDict
+from multiprocessing import shared_memory
+from batchRpc import BatchRPCClient, InstrumentedRPC, DEFAULT_BATCH_SIZE
+from metrics import LogRateLimiter
+from prevoutCache import PrevoutCache, DEFAULT_PREVOUT_CACHE_SIZE, tx_outputs
+from txBuilder import FeeResolver, build_tx_record, is_coinbase
+from txParser import parse_tx
+
+# rawtx messages sent to a worker in one queue put, and max seconds one waits to fill
+INGEST_BATCH_SIZE = 64
+INGEST_BATCH_INTERVAL = 0.005
+# Batches queued per worker before submit pushes back
+INGEST_QUEUE_SIZE = 256
+# Txids each worker remembers, rawtx is published again when a tx confirms
+WORKER_SEEN_TXIDS = 200000
+SHARED_FEATURES_SIZE = 65536
+# Seconds stop waits on each worker before terminating it
+WORKER_STOP_TIMEOUT = 5
+# Seconds a connected block's outputs wait on a full worker queue before that worker
+# goes without them
+BLOCK_OUTPUTS_PUT_TIMEOUT = 1
+
+# Seqlock guarded header: u64 sequence (odd while being written), i64 snapshot id
+# (-1 for none), f64 refresh time of the stalest feature, u32 length of the JSON
+# encoded features that follow, only set while there is no snapshot
+_features_header = struct.Struct('<QqdI')
+
+
+class SharedFeatures():
+    # Mempool state features published by the collector process for ingest workers
+    def __init__(self, name=None):
+        if name == None:
+            self.memory = shared_memory.SharedMemory(
+                create=True, size=SHARED_FEATURES_SIZE)
+            _features_header.pack_into(self.memory.buf, 0, 0, -1, 0.0, 0)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.name = self.memory.name
+        self.sequence = 0
+
+    def publish(self, snapshot_id, refreshed_at, features=None):
+        encoded = b'' if snapshot_id != None else json.dumps(
+            features, default=float).encode('utf-8')
+        if _features_header.size + len(encoded) > self.memory.size:
+            raise Exception('Features do not fit in %d bytes of shared memory' % self.memory.size)
+        self.sequence += 1
+        # Odd while the body and the rest of the header change, the even sequence goes
+        # in last on its own so a reader that sees it also sees everything before it
+        struct.pack_into('<Q', self.memory.buf, 0, self.sequence * 2 - 1)
+        self.memory.buf[_features_header.size:_features_header.size +
+                        len(encoded)] = encoded
+        struct.pack_into('<qdI', self.memory.buf, 8,
+                         -1 if snapshot_id == None else snapshot_id, refreshed_at, len(encoded))
+        struct.pack_into('<Q', self.memory.buf, 0, self.sequence * 2)
+
+    def read(self):
+        # (features to merge into a tx record, stalest refresh time), retried while a publish is in progress
+        while True:
+            (sequence, snapshot_id, refreshed_at, length) = _features_header.unpack_from(
+                self.memory.buf, 0)
+            encoded = bytes(
+                self.memory.buf[_features_header.size:_features_header.size + length])
+            if sequence % 2 == 0 and struct.unpack_from('<Q', self.memory.buf, 0)[0] == sequence:
+                break
+            time.sleep(0)
+        if snapshot_id >= 0:
+            return ({'snapshotid': snapshot_id}, refreshed_at)
+        return (json.loads(encoded) if length > 0 else {}, refreshed_at)
+
+    def close(self, unlink=False):
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+def shard_of(body, shards):
+    # The txid needs a full parse to compute, the raw tx hashes to the same shard
+    # every time it's published so each worker sees all notifications of its txs
+    return zlib.crc32(body) % shards
+
+
+def ingest_worker(shard, rpc_url, batch_size, prevout_cache_size, features_name, inbox, outbox):
+    # Parses and resolves fees for its shard of rawtx messages, built records go back
+    # to the collector process which owns the db
+    logging.basicConfig(
+        level=logging.INFO, format='%(relativeCreated)6d %(processName)s %(message)s')
+    features = SharedFeatures(features_name)
+    rpc_connection = InstrumentedRPC(rpc_url)
+    fee_resolver = FeeResolver(PrevoutCache(prevout_cache_size), BatchRPCClient(rpc_url, batch_size=batch_size, pool_size=1),
+                               lambda: rpc_connection, LogRateLimiter(logging))
+    seen = OrderedDict()
+    while True:
+        batch = inbox.get()
+        if batch == None:
+            break
+        if isinstance(batch, tuple):
+            # ('outputs', outputs) of txs parsed by other shards or of a connected block,
+            # a child usually lands on a different shard than its parent
+            fee_resolver.prevout_cache.add_outputs(batch[1])
+            continue
+        built = []
+        outputs = []
+        errors = 0
+        for (body, received_at) in batch:
+            try:
+                serialized_tx = parse_tx(body)
+                fee_resolver.prevout_cache.add_tx(serialized_tx)
+                if serialized_tx['txid'] in seen or is_coinbase(serialized_tx):
+                    continue
+                seen[serialized_tx['txid']] = True
+                if len(seen) > WORKER_SEEN_TXIDS:
+                    seen.popitem(last=False)
+                outputs.append(tx_outputs(serialized_tx))
+                fees = fee_resolver.get_transaction_fees(serialized_tx)
+                (tx_features, refreshed_at) = features.read()
+                built.append((build_tx_record(serialized_tx, fees, received_at, tx_features,
+                                              received_at - refreshed_at), received_at))
+            except Exception as e:
+                errors += 1
+                logging.info('[Ingest Worker]: %d failed on tx: %r' % (shard, e))
+        outbox.put((shard, len(batch), errors, built, outputs))
+    features.close()
+
+
+class ShardedIngest():
+    # Fans rawtx messages out to worker processes by shard. Submitting, batching and
+    # collecting happen in the collector process, parsing and fee resolution don't.
+    def __init__(self, processes, rpc_url, logging, batch_size=INGEST_BATCH_SIZE, rpc_batch_size=DEFAULT_BATCH_SIZE,
+                 prevout_cache_size=DEFAULT_PREVOUT_CACHE_SIZE, queue_size=INGEST_QUEUE_SIZE):
+        self.processes = processes
+        self.logging = logging
+        self.batch_size = batch_size
+        self.features = SharedFeatures()
+        # spawn so workers don't inherit the collector's threads, locks and sockets
+        context = multiprocessing.get_context('spawn')
+        self.inboxes = [context.Queue(queue_size) for shard in range(processes)]
+        self.outbox = context.Queue()
+        self.pending = [[] for shard in range(processes)]
+        self.pending_since = [None] * processes
+        self.workers = [context.Process(target=ingest_worker, name='IngestWorker-%d' % shard, daemon=True,
+                                        args=(shard, rpc_url, rpc_batch_size, prevout_cache_size,
+                                              self.features.name, self.inboxes[shard], self.outbox))
+                        for shard in range(processes)]
+        self.submitted = 0
+        self.processed = 0
+        self.errors = 0
+        self.built = 0
+        self.blocked_puts = 0
+        self.dropped_outputs = 0
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        self.logging.info('[Sharded Ingest]: Started %d worker processes' % self.processes)
+
+    def submit(self, body, received_at):
+        # False when the shard's full batch couldn't be queued yet, it stays pending for flush
+        shard = shard_of(body, self.processes)
+        if len(self.pending[shard]) == 0:
+            self.pending_since[shard] = received_at
+        self.pending[shard].append((body, received_at))
+        self.submitted += 1
+        if len(self.pending[shard]) >= self.batch_size:
+            return self.send(shard)
+        return True
+
+    def flush(self, max_age=INGEST_BATCH_INTERVAL):
+        # Sends partial batches older than max_age, False if a worker's queue is full
+        sent = True
+        now = time.time()
+        for shard in range(self.processes):
+            if len(self.pending[shard]) > 0 and now - self.pending_since[shard] >= max_age:
+                sent = self.send(shard) and sent
+        return sent
+
+    def send(self, shard):
+        try:
+            self.inboxes[shard].put_nowait(self.pending[shard])
+        except queue.Full:
+            # Kept pending, the caller backs off and flushes again
+            self.blocked_puts += 1
+            return False
+        self.pending[shard] = []
+        return True
+
+    def collect(self, timeout=0.1):
+        # Blocks for the next worker batch, returns its (tx record, received at) pairs
+        try:
+            (shard, processed, errors, built, outputs) = self.outbox.get(timeout=timeout)
+        except queue.Empty:
+            return []
+        self.processed += processed
+        self.errors += errors
+        self.built += len(built)
+        if len(outputs) > 0:
+            self.share_outputs(outputs, shard)
+        return built
+
+    def share_outputs(self, outputs, from_shard=None, timeout=0):
+        # Hands tx outputs to every other worker's prevout cache. A full queue drops
+        # them for that worker, which then resolves those prevouts over RPC.
+        for (shard, inbox) in enumerate(self.inboxes):
+            if shard == from_shard:
+                continue
+            try:
+                inbox.put(('outputs', outputs), timeout > 0, timeout or None)
+            except queue.Full:
+                self.dropped_outputs += 1
+
+    def publish_features(self, snapshot_id, refreshed_at, features=None):
+        self.features.publish(snapshot_id, refreshed_at, features)
+
+    def stats(self):
+        return {
+            'processes': self.processes,
+            'alive': sum(1 for worker in self.workers if worker.is_alive()),
+            'submitted': self.submitted,
+            'processed': self.processed,
+            'errors': self.errors,
+            'built': self.built,
+            'blockedputs': self.blocked_puts,
+            'droppedoutputs': self.dropped_outputs
+        }
+
+    def stop(self, timeout=WORKER_STOP_TIMEOUT):
+        # Called once nothing submits or collects anymore. The shared feature block is
+        # unlinked whatever state the workers are in, or it outlives the process in /dev/shm.
+        try:
+            for (shard, inbox) in enumerate(self.inboxes):
+                try:
+                    inbox.put(None, timeout=timeout)
+                except queue.Full:
+                    self.logging.info('[Sharded Ingest]: Worker %d inbox is full, terminating it' % shard)
+                    self.workers[shard].terminate()
+            for worker in self.workers:
+                if worker.pid == None:
+                    continue
+                worker.join(timeout)
+                if worker.is_alive():
+                    self.logging.info('[Sharded Ingest]: %s did not exit, terminating it' % worker.name)
+                    worker.terminate()
+                    worker.join(timeout)
+        finally:
+            for inbox in self.inboxes:
+                inbox.cancel_join_thread()
+            self.features.close(unlink=True)
+        self.logging.info('[Sharded Ingest]: Stopped %d worker processes %s' % (self.processes, self.stats()))
@@ -0,0 +1,86 @@
+import threading
+from bitcoinrpc.authproxy import JSONRPCException
+from blockStatsHistory import ROLLING_WINDOWS
+
+# Deepest the follower walks back from a new block, enough to refill the widest rolling window
+TIP_FOLLOWER_MAX_DEPTH = max(ROLLING_WINDOWS)
+
+
+class TipFollower():
+    # Follows the best chain from block notifications. Walks back from a new block
+    # through getblockheader until it meets a block already in the history, so only
+    # new heights, and on a reorg only the replaced ones, get their stats fetched.
+    def __init__(self, rpc_connection, batch_rpc, history, logging, max_depth=TIP_FOLLOWER_MAX_DEPTH):
+        self.rpc_connection = rpc_connection
+        self.batch_rpc = batch_rpc
+        self.history = history
+        self.logging = logging
+        self.max_depth = max_depth
+        self.tip_header = None
+        self.reorgs = 0
+        # Called with the tip header and its getblockstats result after each change
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def on_block(self, block_hash):
+        # Returns the heights whose stats were (re)fetched
+        with self.lock:
+            if self.tip_header != None and self.tip_header['hash'] == block_hash:
+                return []
+            header = self.rpc_connection.getblockheader(block_hash)
+            if self.history.blockhash(header['height']) == block_hash and self.tip_header != None:
+                # Stale notification for a block we already have
+                return []
+            headers = self.walk_back(header)
+
+            old_tip = self.history.tip()
+            replaced = [h['height'] for h in headers if self.history.blockhash(
+                h['height']) not in (None, h['hash'])]
+            if len(replaced) > 0 or (old_tip != None and header['height'] < old_tip):
+                self.reorgs += 1
+                self.logging.info('[Tip Follower]: Reorg at height %d, %d blocks replaced, new tip %s' % (
+                    headers[-1]['height'], len(replaced), block_hash))
+            # Heights past the new tip belonged to the old chain
+            self.history.truncate(header['height'])
+
+            results = self.batch_rpc.batch(
+                [('getblockstats', [h['hash']]) for h in reversed(headers)])
+            tip_stats = None
+            for stats in results:
+                if isinstance(stats, JSONRPCException):
+                    self.logging.info(
+                        '[Tip Follower]: Failed to get block stats %s' % stats.error)
+                    continue
+                self.history.append(stats)
+                if stats['blockhash'] == block_hash:
+                    tip_stats = stats
+            self.tip_header = header
+            if tip_stats != None:
+                for listener in self.listeners:
+                    listener(header, tip_stats)
+            return [h['height'] for h in reversed(headers)]
+
+    def walk_back(self, header):
+        # Headers from the new block down to the first one whose parent is in the history
+        headers = [header]
+        while 'previousblockhash' in headers[-1]:
+            parent_height = headers[-1]['height'] - 1
+            if (self.history.tip() == None
+                or parent_height < self.history.base_height
+                    or header['height'] - parent_height >= self.max_depth):
+                break
+            if self.history.blockhash(parent_height) == headers[-1]['previousblockhash']:
+                break
+            headers.append(self.rpc_connection.getblockheader(
+                headers[-1]['previousblockhash']))
+        return headers
+
+    def stats(self):
+        return {
+            'tip': None if self.tip_header == None else self.tip_header['height'],
+            'historytip': self.history.tip(),
+            'reorgs': self.reorgs
+        }
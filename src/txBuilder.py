@@ -0,0 +1,81 @@
+from bitcoinrpc.authproxy import JSONRPCException
+from txParser import parse_tx, output_value_sats
+
+
+class FeeResolver():
+    # Fee of a parsed tx from its prevouts, looked up in the cache first and fetched
+    # from the node in one batch otherwise. Used by the in process pipeline and by
+    # each sharded ingest worker with its own cache and connections.
+    def __init__(self, prevout_cache, batch_rpc, rpc, log_sampler):
+        self.prevout_cache = prevout_cache
+        self.batch_rpc = batch_rpc
+        # Returns the calling thread's connection
+        self.rpc = rpc
+        self.log_sampler = log_sampler
+
+    def get_input_value(self, txid, vout):
+        value = self.prevout_cache.get(txid, vout)
+        if value is not None:
+            return value
+
+        serialized_tx = parse_tx(bytes.fromhex(
+            self.rpc().getrawtransaction(txid)))
+        # Siblings of this output are likely to be spent soon as well
+        self.prevout_cache.add_tx(serialized_tx)
+        output = next((d for (index, d) in enumerate(
+            serialized_tx['vout']) if d["n"] == vout), None)
+        return output_value_sats(output)
+
+    def get_transaction_fees(self, tx):
+        # Add up output values, all values are in sats
+        output_value = 0
+        [output_value := output_value + output_value_sats(vout) for vout in tx['vout']]
+        # Add up input values, resolving every uncached prevout in one batch
+        input_values = [self.prevout_cache.get(
+            vin['txid'], vin['vout']) for vin in tx['vin']]
+        missing_txids = list(dict.fromkeys(
+            vin['txid'] for (vin, value) in zip(tx['vin'], input_values) if value is None))
+        resolved = {}
+        if len(missing_txids) > 0:
+            for raw_tx in self.batch_rpc.get_transactions(missing_txids, verbose=False):
+                if isinstance(raw_tx, JSONRPCException):
+                    self.log_sampler.info('prevout',
+                                          '[ZMQ]: Failed to fetch prevout tx %s' % raw_tx.error)
+                    continue
+                parent_tx = parse_tx(bytes.fromhex(raw_tx))
+                self.prevout_cache.add_tx(parent_tx)
+                for vout in parent_tx['vout']:
+                    resolved[(parent_tx['txid'], vout['n'])] = vout['valuesat']
+        input_value = 0
+        for (vin, value) in zip(tx['vin'], input_values):
+            if value is None:
+                value = resolved.get((vin['txid'], vin['vout']))
+            if value is None:
+                # Falls back to a single lookup if the batch call failed for this input
+                value = self.get_input_value(vin['txid'], vin['vout'])
+            input_value += value
+
+        # Or equal case added, b/c some tx are not going to spend any funds
+        # assert(input_value >= output_value)
+        return float(input_value - output_value)
+
+
+def is_coinbase(serialized_tx):
+    return len(serialized_tx['vin']) == 1 and 'coinbase' in serialized_tx['vin'][0]
+
+
+def build_tx_record(serialized_tx, fees, now, features, feature_age):
+    fee_rate = fees / serialized_tx['size']
+    # Delete inputs and outputs to perserve space
+    serialized_tx.pop('vin', None)
+    serialized_tx.pop('vout', None)
+    serialized_tx.pop('hex', None)
+    # Concat tx obj with mempool state
+    return (
+        {**{
+            'feerate': float(fee_rate),
+            'fee': float(fees),
+            'mempooldate': int(now),
+            # Seconds since the stalest mempool state feature was refreshed
+            'featureage': int(feature_age)
+        }, **features, **serialized_tx})
@@ -0,0 +1,179 @@
+import decimal
+import json
+import struct
+
+# Record layout, little-endian:
+#   u8 version | u64 presence mask | fixed fields (schema order) | u32 extras length | extras JSON
+# A fixed field whose value is missing or doesn't fit its type has its presence bit
+# cleared and is carried in extras instead, so encoding is always lossless.
+RECORD_VERSION = 1
+# Length of the recommendedfeerates feature
+RECOMMENDED_FEE_RATES = 7
+
+# (field, struct format), append only. Per tx fields only: network wide features live
+# in the snapshot record the tx references, records carrying them inline (no snapshot
+# yet, or converted from JSON) keep them in extras.
+RECORD_SCHEMA = [('hash', '32s'), ('version', 'i'), ('size', 'I'), ('vsize', 'I'), ('weight', 'I'), ('locktime', 'I'),
+                 ('feerate', 'd'), ('fee', 'd'), ('mempooldate', 'q'), ('featureage', 'q'), ('conf', 'q'),
+                 ('snapshotid', 'q'),
+                 # Compact conf time summary of the tx's fee rate bucket
+                 ('confp50', 'q'), ('confp90', 'q'), ('confsamples', 'd')]
+
+INT_RANGES = {'B': (0, 2 ** 8 - 1), 'i': (-2 ** 31, 2 ** 31 - 1),
+              'I': (0, 2 ** 32 - 1), 'q': (-2 ** 63, 2 ** 63 - 1)}
+
+
+class DecimalEncoder(json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, decimal.Decimal):
+            return str(o)
+        return super(DecimalEncoder, self).default(o)
+
+
+class RecordCodec():
+    def __init__(self, version, schema):
+        self.version = version
+        self.schema = schema
+        self.field_set = set(field for (field, fmt) in schema)
+        self.header = struct.Struct('<BQ')
+        self.body = struct.Struct(
+            '<' + ''.join(fmt for (field, fmt) in schema))
+        self.extras_length = struct.Struct('<I')
+        self.defaults = [_default(fmt) for (field, fmt) in schema]
+        self.scalar_plan = []
+        self.special_plan = []
+        position = 0
+        for (index, (field, fmt)) in enumerate(schema):
+            if fmt[-1] == 's' or _count(fmt) > 1:
+                self.special_plan.append(
+                    (1 << index, field, position, _count(fmt), fmt[-1]))
+            else:
+                self.scalar_plan.append((1 << index, field, position))
+            position += _count(fmt)
+        self.converters = [(field, _converter(fmt), self.defaults[index], _count(fmt) > 1, 1 << index)
+                           for (index, (field, fmt)) in enumerate(schema)]
+
+    def encode(self, tx):
+        mask = 0
+        values = []
+        extras = {}
+        known = 1 if 'txid' in tx else 0
+        for (field, convert, default, is_list, bit) in self.converters:
+            value = tx.get(field)
+            packed = None if value is None else convert(value)
+            if packed is None:
+                if field in tx:
+                    extras[field] = value
+                    known += 1
+                packed = default
+            else:
+                mask |= bit
+                known += 1
+            if is_list:
+                values.extend(packed)
+            else:
+                values.append(packed)
+        if len(tx) > known:
+            for field in tx:
+                # txid lives in the key
+                if field != 'txid' and field not in self.field_set:
+                    extras[field] = tx[field]
+
+        extras_data = json.dumps(extras, cls=DecimalEncoder).encode(
+            'utf-8') if len(extras) > 0 else b''
+        return self.header.pack(self.version, mask) + self.body.pack(*values) + self.extras_length.pack(len(extras_data)) + extras_data
+
+    def decode(self, data, txid=None):
+        version, mask = self.header.unpack_from(data, 0)
+        values = self.body.unpack_from(data, self.header.size)
+        tx = {} if txid is None else {'txid': txid}
+        tx.update({field: values[position] for (bit, field, position)
+                   in self.scalar_plan if mask & bit})
+        for (bit, field, position, count, kind) in self.special_plan:
+            if mask & bit:
+                if kind == 's':
+                    tx[field] = values[position].hex()
+                else:
+                    tx[field] = list(values[position:position + count])
+        offset = self.header.size + self.body.size
+        extras_length = self.extras_length.unpack_from(data, offset)[0]
+        if extras_length > 0:
+            offset += self.extras_length.size
+            tx.update(json.loads(
+                bytes(data[offset:offset + extras_length]).decode('utf-8')))
+        return tx
+
+
+def _count(fmt):
+    return int(fmt[:-1]) if fmt[-1] != 's' and len(fmt) > 1 else 1
+
+
+def _default(fmt):
+    if fmt[-1] == 's':
+        return b''
+    if _count(fmt) > 1:
+        return [_default(fmt[-1])] * _count(fmt)
+    if fmt[-1] == 'd':
+        return 0.0
+    return 0
+
+
+def _converter(fmt):
+    # Returns a function mapping a value to its packable form, or None if it doesn't fit
+    kind = fmt[-1]
+    count = _count(fmt)
+    if kind == 's':
+        width = struct.calcsize(fmt)
+
+        def convert(value):
+            if type(value) is str and len(value) == 2 * width:
+                try:
+                    return bytes.fromhex(value)
+                except ValueError:
+                    return None
+            return None
+    elif count > 1:
+        convert_item = _converter(kind)
+
+        def convert(value):
+            if type(value) not in (list, tuple) or len(value) != count:
+                return None
+            packed = [convert_item(item) for item in value]
+            if None in packed:
+                return None
+            return packed
+    elif kind == 'd':
+        def convert(value):
+            if type(value) in (float, int, decimal.Decimal):
+                return float(value)
+            return None
+    else:
+        low, high = INT_RANGES[kind]
+
+        def convert(value):
+            if type(value) is int and low <= value <= high:
+                return value
+            return None
+    return convert
+
+
+CODECS = {RECORD_VERSION: RecordCodec(RECORD_VERSION, RECORD_SCHEMA)}
+
+
+def encode_tx(tx):
+    return CODECS[RECORD_VERSION].encode(tx)
+
+
+def decode_tx(data, txid=None):
+    # Records written before the binary format are JSON documents
+    if data[:1] == b'{':
+        return json.loads(data)
+    return CODECS[data[0]].decode(data, txid)
+
+
+def txid_to_key_bytes(txid):
+    return bytes.fromhex(txid)
+
+
+def key_bytes_to_txid(key):
+    return bytes(key).hex()
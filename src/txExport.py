@@ -0,0 +1,80 @@
+import logging
+import os
+import re
+import threading
+from blockStatsStore import write_columnar_chunk, load_columns
+from featureSeries import FeatureSeries
+from rocksclient import RocksDBClient, TX_KEY_PREFIX, prefix_end
+from txCodec import RECOMMENDED_FEE_RATES
+
+EXPORT_DIR = 'tx_export'
+EXPORT_ROWS_PER_FILE = 100000
+EXPORT_FILE_PATTERN = re.compile(r'^txs_(\d+)_(\d+)\.col$')
+
+# Flattened training row, (column name, struct format). Missing int64 values are 0,
+# missing float64 values NaN. conf is 0 until the tx confirmed.
+TX_EXPORT_COLUMNS = [('txid', '32s'), ('hash', '32s'),
+                     ('version', 'q'), ('size', 'q'), ('vsize', 'q'), ('weight', 'q'), ('locktime', 'q'),
+                     ('feerate', 'd'), ('fee', 'd'), ('mempooldate', 'q'), ('featureage', 'q'),
+                     ('conf', 'q'), ('confp50', 'q'), ('confp90', 'q'), ('confsamples', 'd'),
+                     ('snapshotid', 'q'),
+                     ('mempoolgrowthrate', 'd'), ('networkdifficulty', 'd'), ('averageconfirmationtime', 'd'),
+                     ('mempoolsize', 'q'), ('minerrevenue', 'd'), ('totalhashrate', 'd'), ('marketprice', 'd'),
+                     ('dayofweek', 'q'), ('hourofday', 'q'), ('monthofyear', 'q'),
+                     ('averagemempoolfee', 'd'), ('averagemempoolfeerate', 'd'), ('averagemempooltxsize', 'd')] + \
+    [('recommendedfeerates_%d' % index, 'd')
+     for index in range(RECOMMENDED_FEE_RATES)]
+
+
+def flatten_tx(tx):
+    row = dict(tx)
+    rates = tx.get('recommendedfeerates')
+    for index in range(RECOMMENDED_FEE_RATES):
+        row['recommendedfeerates_%d' % index] = rates[index] if rates and index < len(
+            rates) else None
+    return row
+
+
+def key_ranges(shards):
+    # Splits the tx keyspace on the first txid byte, txids being uniformly distributed
+    bounds = [index * 256 // shards for index in range(shards)] + [256]
+    return [(TX_KEY_PREFIX + bytes([low]), TX_KEY_PREFIX + bytes([high]) if high < 256 else prefix_end(TX_KEY_PREFIX))
+            for (low, high) in zip(bounds, bounds[1:])]
+
+
+def export_range(shard, start_key, stop_key, output_dir, rows_per_file=EXPORT_ROWS_PER_FILE, confirmed_only=False, as_of_features=False):
+    # Runs in its own process with its own read only instance. The snapshot gives
+    # the shard a consistent view while the collector keeps writing.
+    rocks = RocksDBClient(threading.Lock(), logging, read_only=True)
+    snapshot = rocks.db.snapshot()
+    series = None
+    if as_of_features:
+        # Features as of each tx's mempooldate rather than the ones it was stored with
+        series = FeatureSeries(rocks)
+        series.load()
+    rows = []
+    exported = 0
+    files = 0
+    for tx in rocks.iter_tx_range(start_key, stop_key, with_features=True, snapshot=snapshot):
+        if confirmed_only and 'conf' not in tx:
+            continue
+        if series != None:
+            tx = series.join(tx)
+        rows.append(tx)
+        if len(rows) == rows_per_file:
+            write_columnar_chunk(os.path.join(output_dir, 'txs_%d_%d.col' % (
+                shard, files)), rows, TX_EXPORT_COLUMNS, flatten_tx)
+            exported += len(rows)
+            files += 1
+            rows = []
+    if len(rows) > 0:
+        write_columnar_chunk(os.path.join(output_dir, 'txs_%d_%d.col' % (
+            shard, files)), rows, TX_EXPORT_COLUMNS, flatten_tx)
+        exported += len(rows)
+        files += 1
+    return (exported, files)
+
+
+def load_export(output_dir, names):
+    # Columns of a finished export as arrays, e.g. to wrap with numpy.frombuffer
+    return load_columns(output_dir, names, EXPORT_FILE_PATTERN)
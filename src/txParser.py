@@ -0,0 +1,157 @@
+import decimal
+import hashlib
+import struct
+
+SATS_PER_BTC = 100000000
+
+_uint32 = struct.Struct('<I')
+_int32 = struct.Struct('<i')
+_uint64 = struct.Struct('<Q')
+_uint16 = struct.Struct('<H')
+_COINBASE_PREVOUT = b'\x00' * 32
+_BTC = decimal.Decimal(1).scaleb(-8)
+
+
+class TxParseError(Exception):
+    pass
+
+
+def _read_varint(data, offset):
+    prefix = data[offset]
+    if prefix < 0xfd:
+        return prefix, offset + 1
+    if prefix == 0xfd:
+        return _uint16.unpack_from(data, offset + 1)[0], offset + 3
+    if prefix == 0xfe:
+        return _uint32.unpack_from(data, offset + 1)[0], offset + 5
+    return _uint64.unpack_from(data, offset + 1)[0], offset + 9
+
+
+def _double_sha256(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part)
+    return hashlib.sha256(h.digest()).digest()
+
+
+def _hash_to_hex(digest):
+    # Hashes are displayed byte reversed
+    return digest[::-1].hex()
+
+
+def parse_tx_at(data, offset=0):
+    # Parses one serialized tx starting at offset of a bytes-like object without
+    # copying it. Returns the tx dict, shaped like decoderawtransaction's, and
+    # the offset just past the tx.
+    data = memoryview(data)
+    start = offset
+    try:
+        version = _int32.unpack_from(data, offset)[0]
+        offset += 4
+        segwit = data[offset] == 0 and data[offset + 1] != 0
+        if segwit:
+            offset += 2
+        body_start = offset
+
+        vin = []
+        count, offset = _read_varint(data, offset)
+        for index in range(count):
+            prevout = data[offset:offset + 32]
+            vout = _uint32.unpack_from(data, offset + 32)[0]
+            script_length, offset = _read_varint(data, offset + 36)
+            script = data[offset:offset + script_length]
+            offset += script_length
+            sequence = _uint32.unpack_from(data, offset)[0]
+            offset += 4
+            if prevout == _COINBASE_PREVOUT and vout == 0xffffffff:
+                vin.append({'coinbase': script.hex(), 'sequence': sequence})
+            else:
+                vin.append({'txid': _hash_to_hex(bytes(prevout)),
+                            'vout': vout, 'sequence': sequence})
+
+        outputs = []
+        count, offset = _read_varint(data, offset)
+        for n in range(count):
+            value = _uint64.unpack_from(data, offset)[0]
+            script_length, offset = _read_varint(data, offset + 8)
+            outputs.append({'value': value * _BTC, 'valuesat': value, 'n': n,
+                            'scriptPubKey': {'hex': data[offset:offset + script_length].hex()}})
+            offset += script_length
+        body_end = offset
+
+        if segwit:
+            # Witness stacks are skipped, only their length matters for weight
+            for index in range(len(vin)):
+                items, offset = _read_varint(data, offset)
+                for item in range(items):
+                    item_length, offset = _read_varint(data, offset)
+                    offset += item_length
+
+        locktime = _uint32.unpack_from(data, offset)[0]
+        offset += 4
+    except (IndexError, struct.error) as e:
+        raise TxParseError('Truncated transaction at byte %d: %s' %
+                           (offset - start, e))
+    if offset > len(data):
+        raise TxParseError('Truncated transaction')
+
+    size = offset - start
+    txid = _double_sha256(data[start:start + 4], data[body_start:body_end],
+                          data[offset - 4:offset])
+    if segwit:
+        base_size = 4 + (body_end - body_start) + 4
+        wtxid = _double_sha256(data[start:offset])
+    else:
+        base_size = size
+        wtxid = txid
+    weight = base_size * 3 + size
+    tx = {
+        'txid': _hash_to_hex(txid),
+        'hash': _hash_to_hex(wtxid),
+        'version': version,
+        'size': size,
+        'vsize': (weight + 3) // 4,
+        'weight': weight,
+        'locktime': locktime,
+        'vin': vin,
+        'vout': outputs
+    }
+    return tx, offset
+
+
+def parse_tx(raw):
+    tx, end = parse_tx_at(raw)
+    if end != len(raw):
+        raise TxParseError('%d trailing bytes after transaction' %
+                           (len(raw) - end))
+    return tx
+
+
+def parse_block(raw):
+    # Header fields plus every tx, as returned by getblock with verbosity 2
+    data = memoryview(raw)
+    if len(data) < 80:
+        raise TxParseError('Truncated block header')
+    header = data[:80]
+    count, offset = _read_varint(data, 80)
+    txs = []
+    for index in range(count):
+        tx, offset = parse_tx_at(data, offset)
+        txs.append(tx)
+    return {
+        'hash': _hash_to_hex(_double_sha256(header)),
+        'version': _int32.unpack_from(header, 0)[0],
+        'previousblockhash': _hash_to_hex(bytes(header[4:36])),
+        'merkleroot': _hash_to_hex(bytes(header[36:68])),
+        'time': _uint32.unpack_from(header, 68)[0],
+        'bits': '%08x' % _uint32.unpack_from(header, 72)[0],
+        'nonce': _uint32.unpack_from(header, 76)[0],
+        'tx': txs
+    }
+
+
+def output_value_sats(vout):
+    # Parsed outputs carry integer sats, RPC decoded ones a Decimal BTC value
+    if 'valuesat' in vout:
+        return vout['valuesat']
+    return int(vout['value'] * SATS_PER_BTC)
@@ -0,0 +1,182 @@
+import math
+import threading
+import time
+
+# Txids the filter is sized for over its window and the false positive rate it's sized
+# to, overridable with TXID_FILTER_CAPACITY and TXID_FILTER_FP_RATE environs. Memory is
+# about capacity * 1.44 * log2(1 / fp rate) bits, plus one generation while rotating.
+DEFAULT_TXID_FILTER_CAPACITY = 8000000
+DEFAULT_TXID_FILTER_FP_RATE = 0.001
+# The window matches the retention default for unconfirmed txs, anything older has
+# been confirmed or deleted and won't be looked up again
+DEFAULT_TXID_FILTER_WINDOW_DAYS = 14
+DEFAULT_TXID_FILTER_GENERATIONS = 4
+
+
+class TxidFilter():
+    # Bloom filter over txids. Never gives a false negative, so a miss means the
+    # txid was never added and the database doesn't need to be asked. Past its
+    # capacity the false positive rate climbs but memory stays the same.
+    def __init__(self, capacity=DEFAULT_TXID_FILTER_CAPACITY, fp_rate=DEFAULT_TXID_FILTER_FP_RATE):
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.num_bits = max(int(-capacity * math.log(fp_rate) / (math.log(2) ** 2)), 64)
+        self.num_hashes = max(int(round(self.num_bits / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.lock = threading.Lock()
+        self.size = 0
+        self.lookups = 0
+        self.definite_misses = 0
+        self.false_positives = 0
+
+    def indexes(self, key):
+        # Txids are already uniformly distributed hashes, so two 64 bit slices of the
+        # raw bytes are enough for double hashing
+        h1 = int.from_bytes(key[0:8], 'little')
+        h2 = int.from_bytes(key[8:16], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        # key is the 32 raw txid bytes
+        with self.lock:
+            for index in self.indexes(key):
+                self.bits[index >> 3] |= 1 << (index & 7)
+            self.size += 1
+
+    def might_contain(self, key):
+        self.lookups += 1
+        bits = self.bits
+        for index in self.indexes(key):
+            if not bits[index >> 3] & (1 << (index & 7)):
+                self.definite_misses += 1
+                return False
+        return True
+
+    def record_false_positive(self):
+        self.false_positives += 1
+
+    def expected_fp_rate(self):
+        return (1 - math.exp(-self.num_hashes * self.size / self.num_bits)) ** self.num_hashes
+
+    def observed_fp_rate(self):
+        negatives = self.false_positives + self.definite_misses
+        if negatives == 0:
+            return 0
+        return self.false_positives / negatives
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'capacity': self.capacity,
+            'bytes': len(self.bits),
+            'hashes': self.num_hashes,
+            'lookups': self.lookups,
+            'definitemisses': self.definite_misses,
+            'falsepositives': self.false_positives,
+            'fprate': self.observed_fp_rate(),
+            'expectedfprate': self.expected_fp_rate()
+        }
+
+
+class RotatingTxidFilter():
+    # Txid filter over a sliding window of mempool dates. Each generation is a Bloom
+    # filter for txids first seen in one window / generations slice of time, a txid
+    # goes to the generation of its mempooldate and generations whose slice is wholly
+    # past the window are dropped. No false negatives for txids inside the window.
+    def __init__(self, capacity=DEFAULT_TXID_FILTER_CAPACITY, fp_rate=DEFAULT_TXID_FILTER_FP_RATE,
+                 window_days=DEFAULT_TXID_FILTER_WINDOW_DAYS, generations=DEFAULT_TXID_FILTER_GENERATIONS):
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.window = window_days * 86400
+        self.num_generations = max(generations, 1)
+        self.slot_seconds = self.window / self.num_generations
+        self.generation_capacity = max(int(math.ceil(capacity / self.num_generations)), 1)
+        self.lock = threading.Lock()
+        # (slot, TxidFilter) oldest first, replaced rather than mutated so lookups can
+        # walk it without the lock
+        self.generations = []
+        self.lookups = 0
+        self.definite_misses = 0
+        self.false_positives = 0
+
+    @property
+    def size(self):
+        return sum(generation.size for (slot, generation) in self.generations)
+
+    def slot_of(self, ts):
+        return int(ts // self.slot_seconds)
+
+    def in_window(self, ts, now=None):
+        return self.slot_of(ts) >= self.slot_of((now or time.time()) - self.window)
+
+    def rotate(self, now=None):
+        first_slot = self.slot_of((now or time.time()) - self.window)
+        with self.lock:
+            self.generations = [(slot, generation) for (slot, generation) in self.generations
+                                if slot >= first_slot]
+
+    def generation_for(self, ts):
+        slot = self.slot_of(ts)
+        for (generation_slot, generation) in reversed(self.generations):
+            if generation_slot == slot:
+                return generation
+        with self.lock:
+            for (generation_slot, generation) in self.generations:
+                if generation_slot == slot:
+                    return generation
+            generation = TxidFilter(self.generation_capacity, self.fp_rate)
+            first_slot = self.slot_of(time.time() - self.window)
+            self.generations = sorted([(generation_slot, existing) for (generation_slot, existing)
+                                       in self.generations if generation_slot >= first_slot] +
+                                      [(slot, generation)], key=lambda item: item[0])
+            return generation
+
+    def add(self, key, ts=None):
+        # key is the 32 raw txid bytes, ts its mempooldate
+        if ts == None:
+            ts = time.time()
+        if not self.in_window(ts):
+            return
+        self.generation_for(ts).add(key)
+
+    def might_contain(self, key):
+        self.lookups += 1
+        for (slot, generation) in reversed(self.generations):
+            if generation.might_contain(key):
+                return True
+        self.definite_misses += 1
+        return False
+
+    def record_false_positive(self):
+        self.false_positives += 1
+
+    def expected_fp_rate(self):
+        miss = 1
+        for (slot, generation) in self.generations:
+            miss *= 1 - generation.expected_fp_rate()
+        return 1 - miss
+
+    def observed_fp_rate(self):
+        negatives = self.false_positives + self.definite_misses
+        if negatives == 0:
+            return 0
+        return self.false_positives / negatives
+
+    def over_capacity(self):
+        return any(generation.size > generation.capacity for (slot, generation) in self.generations)
+
+    def stats(self):
+        generations = self.generations
+        return {
+            'size': sum(generation.size for (slot, generation) in generations),
+            'capacity': self.capacity,
+            'bytes': sum(len(generation.bits) for (slot, generation) in generations),
+            'hashes': generations[-1][1].num_hashes if generations else 0,
+            'generations': len(generations),
+            'windowdays': self.window / 86400,
+            'lookups': self.lookups,
+            'definitemisses': self.definite_misses,
+            'falsepositives': self.false_positives,
+            'fprate': self.observed_fp_rate(),
+            'expectedfprate': self.expected_fp_rate()
+        }
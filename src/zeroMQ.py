@@ -1,151 +1,436 @@
 #!/usr/bin/env python3
 
 import time
-import json
-import binascii
 import asyncio
 import zmq
 import zmq.asyncio
-import signal
 import math
 import struct
-import sys
 import os
-from bitcoinrpc.authproxy import AuthServiceProxy, JSONRPCException
-from enum import Enum
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from bitcoinrpc.authproxy import JSONRPCException
+from prevoutCache import PrevoutCache, DEFAULT_PREVOUT_CACHE_SIZE, tx_outputs
+from batchRpc import BatchRPCClient, InstrumentedRPC, DEFAULT_BATCH_SIZE, rpc_url_from_environ
+from pipeline import PipelineStage
+from txParser import parse_tx, parse_block
+from txBuilder import FeeResolver, build_tx_record, is_coinbase
+from metrics import registry, LogRateLimiter, LOG_RATE_LIMIT
+from zmqCapture import CaptureWriter
+from shardedIngest import ShardedIngest, INGEST_BATCH_INTERVAL, BLOCK_OUTPUTS_PUT_TIMEOUT
 
 SATS_PER_BTC = 100000000
 
+# Concurrent workers per pipeline stage and the bound of each stage's input queue,
+# overridable with ZMQ_*_WORKERS and ZMQ_STAGE_QUEUE_SIZE environs
+DECODE_WORKERS = 4
+FEE_WORKERS = 8
+PERSIST_WORKERS = 1
+STAGE_QUEUE_SIZE = 1000
+# Worker processes rawtx decoding and fee resolution are sharded over, 0 keeps them in
+# the decode and fee stages, overridable with ZMQ_INGEST_PROCESSES environ
+INGEST_PROCESSES = 0
+# Seconds
+PIPELINE_STATS_INTERVAL = 60
+FEATURES_PUBLISH_INTERVAL = 1
+# Max seconds stop waits for the event loop to exit
+STOP_TIMEOUT = 10
+# Seconds a block's txids are kept to confirm txs still in the pipeline when it arrived
+RECENT_CONFS_SECONDS = 600
+
+ZMQ_MESSAGES = registry.counter(
+    'btc_etl_zmq_messages_total', 'ZMQ messages received', ['topic'])
+ZMQ_MISSED = registry.counter(
+    'btc_etl_zmq_missed_messages_total', 'ZMQ messages skipped according to their sequence numbers', ['topic'])
+TIME_TO_FIRST_TX = registry.gauge(
+    'btc_etl_time_to_first_tx_seconds', 'Seconds from process start until the first new tx was queued for write')
+TX_INGEST_SECONDS = registry.histogram(
+    'btc_etl_tx_ingest_seconds', 'Time from a rawtx arriving to its record being queued for write')
 
-class ZMQHandler():
-    def __init__(self, logging, rocks, mempool_state):
-        if ('RPC_USER' not in os.environ
-            or 'RPC_PASSWORD' not in os.environ
-            or 'RPC_HOST' not in os.environ
-                or 'RPC_PORT' not in os.environ):
-            raise Exception(
-                'Need to specify RPC_USER and RPC_PASSWORD, RPC_HOST, RPC_PORT environs')
 
+class ZMQHandler():
+    def __init__(self, logging, rocks, mempool_state, started_at=None):
+        # Raises if the RPC environs are missing
+        rpc_url = rpc_url_from_environ()
         if 'ZMQ_PORT' not in os.environ or 'ZMQ_HOST' not in os.environ:
             raise Exception('Need to specify ZMQ_PORT and ZMQ_HOST environs')
 
-        self.rpc_connection = AuthServiceProxy("http://%s:%s@%s:%s" %
-                                               (os.environ['RPC_USER'], os.environ['RPC_PASSWORD'],  os.environ['RPC_HOST'], os.environ['RPC_PORT']))
-        self.loop = asyncio.get_event_loop()
+        # AuthServiceProxy isn't thread safe, pipeline workers each get their own
+        self.rpc_state = threading.local()
+
+        decode_workers = int(os.environ.get(
+            'ZMQ_DECODE_WORKERS', DECODE_WORKERS))
+        fee_workers = int(os.environ.get('ZMQ_FEE_WORKERS', FEE_WORKERS))
+        persist_workers = int(os.environ.get(
+            'ZMQ_PERSIST_WORKERS', PERSIST_WORKERS))
+        queue_size = int(os.environ.get(
+            'ZMQ_STAGE_QUEUE_SIZE', STAGE_QUEUE_SIZE))
+        self.batch_rpc = BatchRPCClient(rpc_url, batch_size=int(
+            os.environ.get('RPC_BATCH_SIZE', DEFAULT_BATCH_SIZE)), pool_size=fee_workers)
+
+        # Own loop, the mempool state thread runs the default one
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.executor = ThreadPoolExecutor(
+            max_workers=decode_workers + fee_workers + persist_workers + 2)
         self.zmqContext = zmq.asyncio.Context()
 
         self.zmqSubSocket = self.zmqContext.socket(zmq.SUB)
         self.zmqSubSocket.setsockopt(zmq.RCVHWM, 0)
-        self.zmqSubSocket.setsockopt_string(zmq.SUBSCRIBE, "hashblock")
+        self.zmqSubSocket.setsockopt_string(zmq.SUBSCRIBE, "rawblock")
         self.zmqSubSocket.setsockopt_string(zmq.SUBSCRIBE, "rawtx")
         self.zmqSubSocket.connect(
             "tcp://%s:%s" % (os.environ['ZMQ_HOST'], os.environ['ZMQ_PORT']))
         self.logging = logging
         self.rocks = rocks
         self.mempool_state = mempool_state
+        self.prevout_cache = PrevoutCache(
+            int(os.environ.get('PREVOUT_CACHE_SIZE', DEFAULT_PREVOUT_CACHE_SIZE)))
+
+        # receive -> decode -> resolve fees -> persist, blocks are handled on their own
+        self.persist_stage = PipelineStage(
+            'persist', self.persist_tx, persist_workers, queue_size, logging)
+        self.fee_stage = PipelineStage(
+            'fees', self.resolve_tx, fee_workers, queue_size, logging, self.persist_stage)
+        self.decode_stage = PipelineStage(
+            'decode', self.decode_tx, decode_workers, queue_size, logging, self.fee_stage)
+        self.block_stage = PipelineStage(
+            'block', self.handle_block, 1, queue_size, logging)
+        self.stages = [self.decode_stage, self.fee_stage,
+                       self.persist_stage, self.block_stage]
+        # Sharded: receive -> worker processes -> admit -> persist, the db stays in this process
+        self.sharded_ingest = None
+        ingest_processes = int(os.environ.get(
+            'ZMQ_INGEST_PROCESSES', INGEST_PROCESSES))
+        if ingest_processes > 0:
+            self.sharded_ingest = ShardedIngest(ingest_processes, rpc_url, logging,
+                                                rpc_batch_size=int(os.environ.get(
+                                                    'RPC_BATCH_SIZE', DEFAULT_BATCH_SIZE)),
+                                                prevout_cache_size=int(os.environ.get('PREVOUT_CACHE_SIZE', DEFAULT_PREVOUT_CACHE_SIZE)))
+            self.admit_stage = PipelineStage(
+                'admit', self.admit_tx, 1, queue_size, logging, self.persist_stage)
+            self.stages = [self.admit_stage,
+                           self.persist_stage, self.block_stage]
+        self.received = 0
+        # Txids claimed by a message between decode (or admit) and persist. bitcoind
+        # publishes rawtx again for a block's txs, the copy is dropped instead of
+        # building a second record.
+        self.in_flight = set()
+        self.in_flight_lock = threading.Lock()
+        # txid -> conf time of recent blocks' txs, for txs persisted after their block.
+        # Blocks record it and look up stored txs under conf_lock, persist checks it and
+        # queues the record under it, so each tx gets its conf one way or the other.
+        self.recent_confs = OrderedDict()
+        self.conf_lock = threading.Lock()
+        self.started_at = started_at or time.time()
+        self.running = False
+        # Set once the event loop has exited
+        self.stopped = threading.Event()
+        self.first_tx_at = None
+        # topic -> last sequence number seen
+        self.sequences = {}
+        self.log_sampler = LogRateLimiter(
+            logging, int(os.environ.get('LOG_RATE_LIMIT', LOG_RATE_LIMIT)))
+        self.fee_resolver = FeeResolver(
+            self.prevout_cache, self.batch_rpc, self.rpc, self.log_sampler)
+        # Frames are recorded as received for offline replay, see run-zmq-replay.py
+        self.capture = None
+        if os.environ.get('ZMQ_CAPTURE_FILE'):
+            self.capture = CaptureWriter(os.environ['ZMQ_CAPTURE_FILE'])
+            logging.info('[ZMQ]: Capturing messages to %s' %
+                         os.environ['ZMQ_CAPTURE_FILE'])
+        self.register_metrics()
+
+    def register_metrics(self):
+        registry.gauge('btc_etl_pipeline_queue_depth', 'Items waiting in each pipeline stage', ['stage'],
+                       lambda: {(stage.name,): stage.queue.qsize() for stage in self.stages})
+        registry.gauge('btc_etl_pipeline_processed', 'Items each pipeline stage has handled', ['stage'],
+                       lambda: {(stage.name,): stage.processed for stage in self.stages})
+        registry.gauge('btc_etl_pipeline_errors', 'Items each pipeline stage failed on', ['stage'],
+                       lambda: {(stage.name,): stage.errors for stage in self.stages})
+        registry.gauge('btc_etl_zmq_lag_messages', 'rawtx messages received but not yet decoded',
+                       callback=self.lag)
+        registry.gauge('btc_etl_prevout_cache_hit_ratio', 'Prevout cache hit ratio',
+                       callback=self.prevout_cache.hit_ratio)
+        registry.gauge('btc_etl_prevout_cache_size', 'Prevout cache entries',
+                       callback=lambda: len(self.prevout_cache.entries))
+
+    def lag(self):
+        if self.sharded_ingest != None:
+            return self.sharded_ingest.submitted - self.sharded_ingest.processed
+        return ZMQ_MESSAGES.values.get(('rawtx',), 0) - self.decode_stage.processed - self.decode_stage.errors
 
-    def add_tx(self, serialized_tx):
+    def rpc(self):
+        if not hasattr(self.rpc_state, 'connection'):
+            self.rpc_state.connection = InstrumentedRPC(
+                rpc_url_from_environ())
+        return self.rpc_state.connection
+
+    def claim_tx(self, txid):
+        # False if another message of this tx is already in the pipeline
+        with self.in_flight_lock:
+            if txid in self.in_flight:
+                return False
+            self.in_flight.add(txid)
+            return True
+
+    def release_tx(self, txid):
+        with self.in_flight_lock:
+            self.in_flight.discard(txid)
+
+    def resolve_tx(self, item):
+        serialized_tx, received_at = item
+        txid = serialized_tx['txid']
         try:
-            # Skip coin base tx
-            if len(serialized_tx['vin']) == 1 and 'coinbase' in serialized_tx['vin'][0]:
-                return
-            # Decode tx id and save in rocks
-            fees = self.getTransactionFees(serialized_tx)
-            fee_rate = fees / serialized_tx['size']
-            # Delete inputs and outputs to perserve space
-            serialized_tx.pop('vin', None)
-            serialized_tx.pop('vout', None)
-            serialized_tx.pop('hex', None)
-            # Concat tx obj with mempool state
-            tx = (
-                {**{
-                    'feerate': float(fee_rate),
-                    'fee': float(fees),
-                    'mempooldate': int(time.time()),
-                    'mempoolgrowthrate': self.mempool_state.mempool_growth_rate_service.growth_rate,
-                    'networkdifficulty': self.mempool_state.network_difficulty.network_difficulty,
-                    'averageconfirmationtime': self.mempool_state.average_confirmation_time_service.average_confirmation_time,
-                    'mempoolsize': self.mempool_state.mempool_size_service.mempool_size,
-                    # TODO  'feeRateBuckets': self.mempool_state.fee_bucket_service.fee_buckets,
-                    'minerrevenue': self.mempool_state.miner_revenue_service.miner_revenue,
-                    'totalhashrate': self.mempool_state.total_hash_rate_service.total_hash_rate,
-                    'marketprice': self.mempool_state.market_price_service.market_price,
-                    'dayofweek': self.mempool_state.date_service.day_of_week,
-                    'hourofday': self.mempool_state.date_service.hour_of_day,
-                    'monthofyear': self.mempool_state.date_service.month_of_year,
-                    'averagemempoolfee': self.mempool_state.mempool_fee_service.average_fee,
-                    'averagemempoolfeerate': self.mempool_state.mempool_fee_service.average_fee_rate,
-                    'averagemempooltxsize': self.mempool_state.mempool_size_service.average_mempool_tx_size,
-                    'recommendedfeerates': self.mempool_state.fee_service.rates
-                }, **serialized_tx})
+            tx = self.build_tx(serialized_tx, received_at)
+        except Exception:
+            self.release_tx(txid)
+            raise
+        if tx == None:
+            self.release_tx(txid)
+        return tx
 
-            self.logging.info(
-                '[ZMQ]: persisting tx %s', tx)
-            self.rocks.write_mempool_tx(tx)
+    def build_tx(self, serialized_tx, received_at=None):
+        # Skip coin base tx
+        if is_coinbase(serialized_tx):
+            return None
+        # Decode tx id and save in rocks
+        fees = self.getTransactionFees(serialized_tx)
+        self.mempool_state.mempool_model.add(
+            serialized_tx['txid'], fees, serialized_tx['vsize'])
+        now = received_at or time.time()
+        # Network wide features live in a shared snapshot record, see RocksDBClient.join_features
+        if self.mempool_state.snapshot_id != None:
+            features = {'snapshotid': self.mempool_state.snapshot_id}
+        else:
+            features = self.mempool_state.get_features()
+        tx = build_tx_record(serialized_tx, fees, now, features,
+                             self.mempool_state.get_feature_age(now))
+        if received_at != None:
+            TX_INGEST_SECONDS.observe(time.time() - received_at)
+        return tx
 
-        except Exception as e:
-            self.logging.error(
-                '[ZMQ]: Failed to decode and persist tx %s' % e)
-            sys.exit(1)
-            return
+    def admit_tx(self, item):
+        # Built by a sharded ingest worker, dropped when already stored, e.g. from before a restart
+        tx, received_at = item
+        if not self.claim_tx(tx['txid']):
+            return None
+        try:
+            stored = self.rocks.get_tx(tx['txid']) != None
+        except Exception:
+            self.release_tx(tx['txid'])
+            raise
+        if stored:
+            self.release_tx(tx['txid'])
+            return None
+        self.mempool_state.mempool_model.add(
+            tx['txid'], tx['fee'], tx['vsize'])
+        TX_INGEST_SECONDS.observe(time.time() - received_at)
+        return tx
 
-    def getInputValue(self, txid, vout):
+    def persist_tx(self, tx):
+        self.log_sampler.info('persist', '[ZMQ]: persisting tx %s', tx['txid'])
+        try:
+            with self.conf_lock:
+                conf_time = self.recent_confs.get(tx['txid'])
+                if conf_time != None and 'conf' not in tx:
+                    # Its block arrived while it was in the pipeline
+                    self.mempool_state.mempool_model.remove_many([tx['txid']])
+                    tx.update(self.record_conf([tx], conf_time)[0][1])
+                    tx['conf'] = conf_time
+                self.rocks.queue_mempool_tx(tx)
+        finally:
+            self.release_tx(tx['txid'])
+        if self.first_tx_at == None:
+            self.first_tx_at = time.time()
+            TIME_TO_FIRST_TX.set(self.first_tx_at - self.started_at)
+            self.logging.info('[ZMQ]: First tx ingested %.2fs after start' %
+                              (self.first_tx_at - self.started_at))
 
-        serialized_tx = self.rpc_connection.decoderawtransaction(
-            self.rpc_connection.getrawtransaction(txid))
-        output = next((d for (index, d) in enumerate(
-            serialized_tx['vout']) if d["n"] == vout), None)
-        return output['value']
+    def getInputValue(self, txid, vout):
+        return self.fee_resolver.get_input_value(txid, vout)
 
     def getTransactionFees(self, tx):
-        # Add up output values
-        output_value = 0
-        [output_value := output_value + vout['value'] for vout in tx['vout']]
-        # Add up input values
-        input_value = 0
-        [input_value := input_value +
-            self.getInputValue(vin['txid'], vin['vout']) for vin in tx['vin']]
-
-        # Or equal case added, b/c some tx are not going to spend any funds
-        # assert(input_value >= output_value)
-        return float((input_value - output_value) * SATS_PER_BTC)
+        return self.fee_resolver.get_transaction_fees(tx)
 
     async def handle(self):
         self.logging.info('[ZMQ]: Starting to handel zmq topics')
-        topic, body, seq = await self.zmqSubSocket.recv_multipart()
-        self.logging.info('[ZMQ]: Body %s %s' % (topic, seq))
-        if topic == b"rawtx":
-            # Tx entering mempool
-            try:
-                self.logging.info('[ZMQ]: Recieved Raw TX')
-                serialized_tx = self.rpc_connection.decoderawtransaction(
-                    binascii.hexlify(body).decode("utf-8"))
-                # TODO use class cache for this check
-                existing_tx = self.rocks.get_tx(serialized_tx['txid'])
-                if existing_tx == None:
-                    self.add_tx(serialized_tx)
-                else:
-                    existing_tx = json.loads(existing_tx)
-                    self.logging.info(
-                        '[ZMQ]: Updating conf time for %s' % serialized_tx['txid'])
-                    conf_time = int(time.time())
-                    time_to_conf_time = conf_time - existing_tx['mempooldate']
-                    fee_rate = math.floor(existing_tx['feerate'])
-                    self.mempool_state.conf_time_per_fee_rate_service.update_conf_times_per_fee(
-                        fee_rate, time_to_conf_time)
-                    self.rocks.update_tx_conf_time(
-                        serialized_tx['txid'], conf_time, self.mempool_state.conf_time_per_fee_rate_service.conf_times_per_fee_bucket)
-
-            except Exception as e:
-                self.logging.info('[ZMQ]: Failed to write mempool entry')
-                self.logging.info(e)
-
-        asyncio.ensure_future(self.handle())
+        # Only receives and routes, so the socket is drained as fast as the stages allow
+        while True:
+            topic, body, seq = await self.zmqSubSocket.recv_multipart()
+            # Stamped on arrival so queueing in later stages doesn't skew mempool and conf times
+            received_at = time.time()
+            self.received += 1
+            if self.capture != None:
+                self.capture.write(topic, body, seq, received_at)
+            self.track_sequence(topic.decode('utf-8', 'replace'), seq)
+            self.log_sampler.info('zmq', '[ZMQ]: Body %s %s' % (topic, seq))
+            if topic == b"rawtx" and self.sharded_ingest != None:
+                if not self.sharded_ingest.submit(body, received_at):
+                    # A worker is behind, wait for room rather than buffering without bound
+                    while not self.sharded_ingest.flush(0):
+                        await asyncio.sleep(0.001)
+            elif topic == b"rawtx":
+                await self.decode_stage.put((body, received_at))
+            elif topic == b"rawblock":
+                await self.block_stage.put((body, received_at))
+
+    def track_sequence(self, topic, seq):
+        ZMQ_MESSAGES.inc(topic)
+        # Each topic has its own little-endian u32 counter, gaps are messages we never got
+        sequence = struct.unpack('<I', seq)[0] if len(seq) == 4 else None
+        last = self.sequences.get(topic)
+        if sequence != None and last != None:
+            missed = (sequence - last - 1) % 2 ** 32
+            if missed > 0:
+                ZMQ_MISSED.inc(topic, amount=missed)
+                self.log_sampler.info('zmq-missed', '[ZMQ]: Missed %d %s messages' % (missed, topic))
+        self.sequences[topic] = sequence
+
+    def decode_tx(self, item):
+        # Tx entering mempool
+        body, received_at = item
+        self.log_sampler.info('decode', '[ZMQ]: Recieved Raw TX')
+        # Parsed in process rather than round tripping through decoderawtransaction
+        serialized_tx = parse_tx(body)
+        self.prevout_cache.add_tx(serialized_tx)
+        txid = serialized_tx['txid']
+        if not self.claim_tx(txid):
+            return None
+        try:
+            # Unseen txids are ruled out by the in memory txid filter without a db read
+            stored = self.rocks.get_tx(txid) != None
+        except Exception:
+            self.release_tx(txid)
+            raise
+        if not stored:
+            # New tx, continues to fee resolution, claimed until persisted
+            return (serialized_tx, received_at)
+        # Already known, its conf time is set when its block arrives
+        self.release_tx(txid)
+        return None
+
+    def record_conf(self, confirmed, conf_time):
+        # Adds the txs to the conf time stats, returns (tx, conf summary) pairs. Each tx
+        # keeps its own bucket's conf time stats as of its block.
+        conf_time_service = self.mempool_state.conf_time_per_fee_rate_service
+        for tx in confirmed:
+            conf_time_service.update_conf_times_per_fee(
+                math.floor(tx['feerate']), conf_time - tx['mempooldate'], conf_time)
+        summaries = {}
+        for tx in confirmed:
+            rate = math.floor(tx['feerate'])
+            if rate not in summaries:
+                summaries[rate] = conf_time_service.summary(rate, conf_time)
+        return [(tx, summaries[math.floor(tx['feerate'])]) for tx in confirmed]
+
+    def remember_confs(self, txids, conf_time):
+        # Called with conf_lock held
+        for txid in txids:
+            self.recent_confs[txid] = conf_time
+            self.recent_confs.move_to_end(txid)
+        while len(self.recent_confs) > 0:
+            (txid, oldest) = next(iter(self.recent_confs.items()))
+            if oldest >= conf_time - RECENT_CONFS_SECONDS:
+                break
+            self.recent_confs.popitem(last=False)
+
+    def handle_block(self, item):
+        # Block connected, parsed in process so no getblock round trip is needed
+        body, received_at = item
+        conf_time = int(received_at)
+        block = parse_block(body)
+        txids = [block_tx['txid'] for block_tx in block['tx']]
+        # Cache its outputs for txs spending them later and drop its txs from the mempool model
+        self.prevout_cache.add_block(block)
+        if self.sharded_ingest != None:
+            # Ingest workers resolve fees with their own caches
+            self.sharded_ingest.share_outputs([tx_outputs(block_tx) for block_tx in block['tx']],
+                                              timeout=BLOCK_OUTPUTS_PUT_TIMEOUT)
+        self.mempool_state.mempool_model.remove_many(txids)
+
+        with self.conf_lock:
+            # Txs still in the pipeline pick their conf up in persist_tx
+            self.remember_confs(txids, conf_time)
+            confirmed = [existing_tx for existing_tx in self.rocks.get_txs(txids).values()
+                         if 'conf' not in existing_tx]
+        if len(confirmed) > 0:
+            self.rocks.queue_block_conf_times(
+                self.record_conf(confirmed, conf_time), conf_time)
+        try:
+            # Block stats, rolling features and difficulty follow the tip from here
+            self.mempool_state.tip_follower.on_block(block['hash'])
+        except JSONRPCException as e:
+            self.logging.info(
+                '[ZMQ]: Failed to follow tip %s' % e.error)
+        self.logging.info('[ZMQ]: Block %s confirmed %d of %d txs' %
+                          (block['hash'], len(confirmed), len(txids)))
+        self.logging.info('[ZMQ]: Prevout cache %s' %
+                          self.prevout_cache.stats())
+
+    def publish_features(self):
+        now = time.time()
+        refreshed_at = now - self.mempool_state.get_feature_age(now)
+        if self.mempool_state.snapshot_id != None:
+            self.sharded_ingest.publish_features(
+                self.mempool_state.snapshot_id, refreshed_at)
+        else:
+            self.sharded_ingest.publish_features(
+                None, refreshed_at, self.mempool_state.get_features())
+
+    async def run_sharded_ingest(self):
+        # Publishes features for the workers, sends partial batches and hands built txs to the admit stage
+        last_published_at = 0
+        while True:
+            if time.time() - last_published_at >= FEATURES_PUBLISH_INTERVAL:
+                self.publish_features()
+                last_published_at = time.time()
+            self.sharded_ingest.flush()
+            built = await self.loop.run_in_executor(self.executor, self.sharded_ingest.collect, INGEST_BATCH_INTERVAL)
+            for item in built:
+                await self.admit_stage.put(item)
+
+    def pipeline_stats(self):
+        stats = {**{stage.name: stage.stats() for stage in self.stages}, 'received': self.received,
+                 'txidfilter': self.rocks.txid_filter.stats(), 'tip': self.mempool_state.tip_follower.stats()}
+        if self.sharded_ingest != None:
+            stats['sharded'] = self.sharded_ingest.stats()
+        return stats
+
+    async def log_pipeline_stats(self):
+        while True:
+            await asyncio.sleep(PIPELINE_STATS_INTERVAL)
+            self.logging.info('[ZMQ]: Pipeline %s' % self.pipeline_stats())
 
     def start(self):
+        self.running = True
+        asyncio.set_event_loop(self.loop)
+        for stage in self.stages:
+            stage.start(self.loop, self.executor)
+        if self.sharded_ingest != None:
+            # Workers never see an unpublished feature block
+            self.publish_features()
+            self.sharded_ingest.start()
+            self.loop.create_task(self.run_sharded_ingest())
+        self.loop.create_task(self.log_pipeline_stats())
         self.loop.create_task(self.handle())
-        self.loop.run_forever()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.stopped.set()
 
     def stop(self):
-        self.loop.stop()
-        self.zmqContext.destroy()
+        # The loop's thread receives from the socket and writes the capture, so both
+        # are only torn down once it has exited
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.running and not self.stopped.wait(STOP_TIMEOUT):
+            self.logging.info(
+                '[ZMQ]: Event loop still running after %ds, stopping anyway' % STOP_TIMEOUT)
+        self.zmqContext.destroy(linger=0)
+        self.executor.shutdown(wait=False)
+        self.batch_rpc.close()
+        if self.sharded_ingest != None:
+            self.sharded_ingest.stop()
+        if self.capture != None:
+            self.capture.close()
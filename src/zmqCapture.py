@@ -0,0 +1,194 @@
+import decimal
+import json
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from batchRpc import _encode_decimal
+from txParser import parse_tx, parse_block
+
+# Capture file layout: magic, then per message
+#   f64 receive time | u16 topic length | u32 body length | u16 seq length | topic | body | seq
+CAPTURE_MAGIC = b'ZMQCAP\x00\x01'
+_record_header = struct.Struct('<dHIH')
+
+
+class CaptureWriter():
+    def __init__(self, path):
+        self.outfile = open(path, 'wb')
+        self.outfile.write(CAPTURE_MAGIC)
+        self.messages = 0
+
+    def write(self, topic, body, seq, received_at=None):
+        self.outfile.write(_record_header.pack(
+            received_at or time.time(), len(topic), len(body), len(seq)))
+        self.outfile.write(topic)
+        self.outfile.write(body)
+        self.outfile.write(seq)
+        self.messages += 1
+
+    def close(self):
+        self.outfile.close()
+
+
+def read_capture(path):
+    # Yields (received_at, topic, body, seq) in recorded order
+    with open(path, 'rb') as infile:
+        if infile.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise Exception('%s is not a ZMQ capture file' % path)
+        while True:
+            header = infile.read(_record_header.size)
+            if len(header) < _record_header.size:
+                return
+            received_at, topic_length, body_length, seq_length = _record_header.unpack(
+                header)
+            topic = infile.read(topic_length)
+            body = infile.read(body_length)
+            seq = infile.read(seq_length)
+            yield (received_at, topic, body, seq)
+
+
+def build_fixture(capture_path, batch_rpc):
+    # Everything the ingest path asks the node about the captured messages: raw txs,
+    # the parents their inputs spend, and headers and stats of captured blocks
+    transactions = {}
+    parents = set()
+    block_hashes = []
+    for (received_at, topic, body, seq) in read_capture(capture_path):
+        if topic == b'rawtx':
+            tx = parse_tx(body)
+            transactions[tx['txid']] = body.hex()
+            parents.update(vin['txid'] for vin in tx['vin'] if 'txid' in vin)
+        elif topic == b'rawblock':
+            block = parse_block(body)
+            block_hashes.append(block['hash'])
+            for block_tx in block['tx']:
+                parents.update(vin['txid']
+                               for vin in block_tx['vin'] if 'txid' in vin)
+    missing = sorted(parents - set(transactions))
+    for (txid, raw_tx) in zip(missing, batch_rpc.get_transactions(missing, verbose=False)):
+        if isinstance(raw_tx, str):
+            transactions[txid] = raw_tx
+    headers = batch_rpc.batch([('getblockheader', [block_hash])
+                               for block_hash in block_hashes])
+    stats = batch_rpc.batch([('getblockstats', [block_hash])
+                             for block_hash in block_hashes])
+    return {
+        'transactions': transactions,
+        'blockheaders': {block_hash: header for (block_hash, header) in zip(block_hashes, headers) if isinstance(header, dict)},
+        'blockstats': {block_hash: block_stats for (block_hash, block_stats) in zip(block_hashes, stats) if isinstance(block_stats, dict)}
+    }
+
+
+def write_fixture(path, fixture):
+    with open(path, 'w') as outfile:
+        json.dump(fixture, outfile, default=str)
+
+
+def read_fixture(path):
+    with open(path) as infile:
+        return json.load(infile, parse_float=decimal.Decimal)
+
+
+class StubRPC():
+    # Answers the node RPCs the ingest path uses from a fixture
+    def __init__(self, fixture):
+        self.transactions = fixture.get('transactions', {})
+        self.blockheaders = fixture.get('blockheaders', {})
+        self.blockstats = fixture.get('blockstats', {})
+        self.best_block_hash = None
+        for (block_hash, header) in self.blockheaders.items():
+            if self.best_block_hash == None or header['height'] > self.blockheaders[self.best_block_hash]['height']:
+                self.best_block_hash = block_hash
+        self.calls = 0
+
+    def decoded(self, raw_tx):
+        tx = parse_tx(bytes.fromhex(raw_tx))
+        for vout in tx['vout']:
+            vout.pop('valuesat')
+        return {**tx, 'hex': raw_tx}
+
+    def call(self, method, params):
+        self.calls += 1
+        if method == 'getrawtransaction':
+            raw_tx = self.transactions.get(params[0])
+            if raw_tx == None:
+                raise LookupError('No such mempool or blockchain transaction')
+            return self.decoded(raw_tx) if len(params) > 1 and params[1] else raw_tx
+        if method == 'decoderawtransaction':
+            return self.decoded(params[0])
+        if method == 'getblockheader':
+            return self.blockheaders[params[0]]
+        if method == 'getblockstats':
+            if isinstance(params[0], int):
+                return next(stats for stats in self.blockstats.values() if stats['height'] == params[0])
+            return self.blockstats[params[0]]
+        if method == 'getbestblockhash':
+            return self.best_block_hash
+        if method == 'getblockcount':
+            return self.blockheaders[self.best_block_hash]['height'] if self.best_block_hash else 0
+        if method == 'getmempoolinfo':
+            return {'size': 0, 'bytes': 0}
+        if method == 'getrawmempool':
+            return {} if len(params) > 0 and params[0] else []
+        raise NotImplementedError('Method not found')
+
+    def respond(self, request):
+        try:
+            result = self.call(request['method'], request.get('params', []))
+            return {'result': result, 'error': None, 'id': request.get('id')}
+        except NotImplementedError as e:
+            return {'result': None, 'error': {'code': -32601, 'message': str(e)}, 'id': request.get('id')}
+        except (LookupError, StopIteration) as e:
+            return {'result': None, 'error': {'code': -5, 'message': str(e)}, 'id': request.get('id')}
+
+
+class _StubRPCHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(
+            int(self.headers['Content-Length'])))
+        if isinstance(request, list):
+            response = [self.server.stub.respond(call) for call in request]
+        else:
+            response = self.server.stub.respond(request)
+        body = json.dumps(response, default=_encode_decimal).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_rpc_server(fixture, host='127.0.0.1', port=0):
+    # Port 0 picks a free one, see server.server_address
+    server = ThreadingHTTPServer((host, port), _StubRPCHandler)
+    server.daemon_threads = True
+    server.stub = StubRPC(fixture)
+    threading.Thread(target=server.serve_forever,
+                     name='StubRPC', daemon=True).start()
+    return server
+
+
+def replay(capture_path, socket, speed=1.0, topics=None):
+    # Publishes captured messages on a zmq PUB socket. speed scales the recorded gaps,
+    # 0 sends as fast as possible. Returns messages sent per topic.
+    sent = {}
+    first_received_at = None
+    started_at = time.time()
+    for (received_at, topic, body, seq) in read_capture(capture_path):
+        if topics != None and topic not in topics:
+            continue
+        if first_received_at == None:
+            first_received_at = received_at
+        if speed > 0:
+            delay = (received_at - first_received_at) / speed - (time.time() - started_at)
+            if delay > 0:
+                time.sleep(delay)
+        socket.send_multipart([topic, body, seq])
+        sent[topic] = sent.get(topic, 0) + 1
+    return sent
@@ -0,0 +1,51 @@
+import json
+import struct
+import pytest
+
+# MergeOp implements python-rocksdb's merge operator interface
+pytest.importorskip('rocksdb')
+
+from rocksclient import MergeOp, conf_operand, tx_key, index_entries, CONF_OPERAND_PREFIX, FEERATE_INDEX_PREFIX
+from txCodec import encode_tx, decode_tx
+
+TXID = 'e8151a2af31c368a35053ddd4bdb285a8595c769a3ad83e0fa02314a602d4609'
+TX = {'txid': TXID, 'size': 343, 'vsize': 261, 'fee': 2610.0, 'feerate': 7.6, 'mempooldate': 1700000000, 'snapshotid': 3}
+SUMMARY = {'confp50': 600, 'confp90': 1800, 'confsamples': 12.5}
+
+
+def test_conf_operand_format():
+    operand = conf_operand(1700000600.7, SUMMARY)
+    assert operand[:2] == CONF_OPERAND_PREFIX == b'\xffc'
+    assert json.loads(operand[2:]) == {**SUMMARY, 'conf': 1700000600}
+
+
+def test_merge_attaches_conf_time():
+    ok, merged = MergeOp().merge(tx_key(TXID), encode_tx(TX), conf_operand(1700000600, SUMMARY))
+    assert ok
+    assert decode_tx(merged, TXID) == {**TX, **SUMMARY, 'conf': 1700000600}
+
+
+def test_merge_keeps_existing_conf_time():
+    confirmed = encode_tx({**TX, 'conf': 1700000300})
+    ok, merged = MergeOp().merge(tx_key(TXID), confirmed, conf_operand(1700000600, SUMMARY))
+    assert decode_tx(merged, TXID)['conf'] == 1700000300
+
+
+def test_merge_without_record_keeps_first_operand():
+    first = conf_operand(1700000600, SUMMARY)
+    ok, merged = MergeOp().merge(tx_key(TXID), None, first)
+    assert merged == first
+    ok, merged = MergeOp().merge(tx_key(TXID), first, conf_operand(1700000900, {}))
+    assert merged == first
+
+
+def test_merge_onto_legacy_json_record():
+    legacy = json.dumps({k: v for (k, v) in TX.items() if k != 'txid'}).encode('utf-8')
+    ok, merged = MergeOp().merge(tx_key(TXID), legacy, conf_operand(1700000600, SUMMARY))
+    assert decode_tx(merged, TXID) == {**TX, **SUMMARY, 'conf': 1700000600}
+
+
+def test_feerate_index_is_bucketed_by_sat_per_vbyte():
+    # 2610 sats over 261 vbytes, the record's own feerate is 7.6 sat/B
+    feerate_key = [key for (key, value) in index_entries(TX) if key.startswith(FEERATE_INDEX_PREFIX)][0]
+    assert struct.unpack_from('>IQ', feerate_key, len(FEERATE_INDEX_PREFIX)) == (10, 1700000000)
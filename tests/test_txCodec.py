@@ -0,0 +1,59 @@
+import struct
+from txCodec import encode_tx, decode_tx, txid_to_key_bytes, key_bytes_to_txid, RECORD_VERSION
+
+TXID = '4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b'
+
+TX_FIELDS = {'txid': TXID, 'hash': TXID, 'version': 2, 'size': 225, 'vsize': 144, 'weight': 573, 'locktime': 0,
+             'feerate': 12.5, 'fee': 2812.0, 'mempooldate': 1700000000, 'featureage': 4}
+
+FEATURES = {'mempoolgrowthrate': 1520.5, 'networkdifficulty': 61030681983175.59, 'averageconfirmationtime': 9.8,
+            'mempoolsize': 41233, 'minerrevenue': 28450312.1, 'totalhashrate': 437259817.2, 'marketprice': 37012.5,
+            'dayofweek': 3, 'hourofday': 17, 'monthofyear': 11, 'averagemempoolfee': 14233.7,
+            'averagemempoolfeerate': 31.2, 'averagemempooltxsize': 402.1,
+            'recommendedfeerates': [40.0, 32.0, 25.0, 20.0, 12.0, 8.0, 5.0]}
+
+
+def test_snapshot_record_is_smaller_than_inline_features():
+    with_snapshot = encode_tx({**TX_FIELDS, 'snapshotid': 7})
+    inline = encode_tx({**TX_FIELDS, **FEATURES})
+    assert len(with_snapshot) < len(inline)
+    # Fixed layout plus an empty extras blob, no zero filled feature slots
+    assert len(with_snapshot) == 1 + 8 + 32 + 4 * 5 + 8 * 2 + 8 * 6 + 8 + 4
+
+
+def test_round_trip_with_snapshot():
+    tx = {**TX_FIELDS, 'snapshotid': 7}
+    data = encode_tx(tx)
+    assert data[0] == RECORD_VERSION
+    assert decode_tx(data, TXID) == tx
+
+
+def test_round_trip_inline_features():
+    tx = {**TX_FIELDS, **FEATURES}
+    assert decode_tx(encode_tx(tx), TXID) == tx
+
+
+def test_record_layout():
+    # u8 version | u64 presence mask | fixed fields | u32 extras length | extras JSON
+    tx = {'size': 225, 'vsize': 144, 'fee': 2812.0, 'mempooldate': 1700000000, 'snapshotid': 7, 'rbf': True}
+    mask = 1 << 2 | 1 << 3 | 1 << 7 | 1 << 8 | 1 << 11
+    extras = b'{"rbf": true}'
+    expected = (struct.pack('<BQ', 1, mask)
+                + struct.pack('<32siIIIIddqqqqqqd', b'', 0, 225, 144, 0, 0, 0.0, 2812.0, 1700000000, 0, 0, 7, 0, 0, 0.0)
+                + struct.pack('<I', len(extras)) + extras)
+    assert encode_tx(tx) == expected
+    assert decode_tx(expected) == tx
+
+
+def test_value_not_fitting_its_field_goes_to_extras():
+    tx = {**TX_FIELDS, 'version': 2 ** 40, 'hash': 'not hex', 'conf': None}
+    data = encode_tx(tx)
+    assert decode_tx(data, TXID) == tx
+
+
+def test_json_records_still_decode():
+    assert decode_tx(b'{"fee": 2812.0, "size": 225}') == {'fee': 2812.0, 'size': 225}
+
+
+def test_txid_key_round_trip():
+    assert key_bytes_to_txid(txid_to_key_bytes(TXID)) == TXID
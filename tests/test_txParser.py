@@ -0,0 +1,63 @@
+import pytest
+from txParser import parse_tx, parse_block, output_value_sats, TxParseError
+
+GENESIS_TX = bytes.fromhex(
+    '01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff4d04ffff001d0104455468652054696d65'
+    '732030332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b206f66207365636f6e64206261696c6f757420666f722062'
+    '616e6b73ffffffff0100f2052a01000000434104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4c'
+    'ef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac00000000')
+GENESIS_HEADER = bytes.fromhex(
+    '0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a'
+    '51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c')
+GENESIS_BLOCK = GENESIS_HEADER + b'\x01' + GENESIS_TX
+
+# Signed native P2WPKH example from BIP 143, one legacy and one segwit input
+SEGWIT_TX = bytes.fromhex(
+    '01000000000102fff7f7881a8099afa6940d42d1e7f6362bec38171ea3edf433541db4e4ad969f00000000494830450221008b9d1dc26ba6a9cb'
+    '62127b02742fa9d754cd3bebf337f7a55d114c8e5cdd30be022040529b194ba3f9281a99f2b1c0a19c0489bc22ede944ccf4ecbab4cc618ef3'
+    'ed01eeffffffef51e1b804cc89d182d279655c3aa89e815b1b309fe287d9b2b55d57b90ec68a0100000000ffffffff02202cb2060000000019'
+    '76a9148280b37df378db99f66f85c95a783a76ac7a6d5988ac9093510d000000001976a9143bde42dbee7e4dbe6a21b2d50ce2f0167faa8159'
+    '88ac000247304402203609e17b84f6a7d30c80bfa610b5b4542f32a8a0d5447a12fb1366d7f01cc44a0220573a954c4518331561406f90300e'
+    '8f3358f51928d43c212a8caed02de67eebee0121025476c2e83188368da1ff3e292e7acafcdb3566bb0ad253f62fc70f07aeee635711000000')
+
+
+def test_genesis_tx():
+    tx = parse_tx(GENESIS_TX)
+    assert tx['txid'] == '4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b'
+    assert tx['hash'] == tx['txid']
+    assert (tx['version'], tx['size'], tx['vsize'], tx['weight'], tx['locktime']) == (1, 204, 204, 816, 0)
+    assert tx['vin'][0]['coinbase'].startswith('04ffff001d0104455468652054696d6573')
+    assert tx['vin'][0]['sequence'] == 0xffffffff
+    assert len(tx['vout']) == 1
+    assert output_value_sats(tx['vout'][0]) == 5000000000
+    assert tx['vout'][0]['n'] == 0
+
+
+def test_genesis_block():
+    block = parse_block(GENESIS_BLOCK)
+    assert block['hash'] == '000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f'
+    assert block['previousblockhash'] == '00' * 32
+    assert block['merkleroot'] == '4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b'
+    assert (block['version'], block['time'], block['bits'], block['nonce']) == (1, 1231006505, '1d00ffff', 2083236893)
+    assert [tx['txid'] for tx in block['tx']] == [block['merkleroot']]
+
+
+def test_segwit_tx():
+    tx = parse_tx(SEGWIT_TX)
+    assert tx['txid'] == 'e8151a2af31c368a35053ddd4bdb285a8595c769a3ad83e0fa02314a602d4609'
+    assert tx['hash'] == 'c36c38370907df2324d9ce9d149d191192f338b37665a82e78e76a12c909b762'
+    assert (tx['size'], tx['weight'], tx['vsize'], tx['locktime']) == (343, 1042, 261, 17)
+    assert [(vin['txid'], vin['vout']) for vin in tx['vin']] == [
+        ('9f96ade4b41d5433f4eda31e1738ec2b36f6e7d1420d94a6af99801a88f7f7ff', 0),
+        ('8ac60eb9575db5b2d987e29f301b5b819ea83a5c6579d282d189cc04b8e151ef', 1)]
+    assert [(output_value_sats(vout), vout['n']) for vout in tx['vout']] == [(112340000, 0), (223450000, 1)]
+
+
+def test_trailing_bytes_are_rejected():
+    with pytest.raises(TxParseError):
+        parse_tx(GENESIS_TX + b'\x00')
+
+
+def test_truncated_tx_is_rejected():
+    with pytest.raises(TxParseError):
+        parse_tx(SEGWIT_TX[:100])
@@ -0,0 +1,30 @@
+import time
+from txidFilter import RotatingTxidFilter
+
+DAY = 86400
+NOW = time.time()
+
+
+def txid(n):
+    return n.to_bytes(32, 'little')
+
+
+def test_txids_inside_window_are_never_missed():
+    txid_filter = RotatingTxidFilter(capacity=10000, fp_rate=0.001, window_days=14, generations=4)
+    for n in range(1000):
+        txid_filter.add(txid(n), NOW - (n % 14) * DAY)
+    txid_filter.rotate(NOW)
+    assert all(txid_filter.might_contain(txid(n)) for n in range(1000))
+    assert txid_filter.stats()['generations'] <= 5
+
+
+def test_rotation_drops_generations_past_window():
+    txid_filter = RotatingTxidFilter(capacity=10000, fp_rate=0.001, window_days=14, generations=4)
+    txid_filter.add(txid(1), NOW - 20 * DAY)
+    txid_filter.add(txid(2), NOW - 1 * DAY)
+    txid_filter.rotate(NOW)
+    assert txid_filter.might_contain(txid(2))
+    assert not txid_filter.might_contain(txid(1))
+    txid_filter.rotate(NOW + 20 * DAY)
+    assert txid_filter.size == 0
+    assert not txid_filter.might_contain(txid(2))